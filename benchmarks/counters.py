@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Measure the increments per second of a `ShardedCounter` incremented by
+several threads, for different numbers of shards, with the number of
+conflicts and retries. One shard is a counter stored in one document.
+
+By default the in memory backend of `couchdbkit.memory` is used, so the
+results show the cost of conflicts in the client. Use `--uri` to run
+against a CouchDB server:
+
+    $ python benchmarks/counters.py --threads 8 --shards 1,4,16,64
+"""
+
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchdbkit import Server
+from couchdbkit.counter import ShardedCounter, map_total
+from couchdbkit.memory import MemoryBackend, MemoryResource
+
+DB_NAME = "couchdbkit_bench_counters"
+
+
+def run(server, shards, threads, increments, pick):
+    if DB_NAME in server:
+        server.delete_db(DB_NAME)
+    db = server.create_db(DB_NAME)
+    ShardedCounter.push_design(db)
+    counter = ShardedCounter("bench", db, shards=shards, pick=pick)
+
+    def worker():
+        for i in range(increments):
+            counter.increment()
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    seconds = time.time() - start
+
+    total = counter.value()
+    stats = db.update_stats()
+    server.delete_db(DB_NAME)
+    count = threads * increments
+    if total != count:
+        raise AssertionError("counter is %s instead of %s" % (total, count))
+    return {
+        "shards": shards,
+        "threads": threads,
+        "increments": count,
+        "seconds": seconds,
+        "increments_per_sec": count / seconds,
+        "conflicts": stats["conflicts"],
+        "retries": stats["retries"]
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--shards", default="1,4,16,64",
+            help="comma separated numbers of shards, 1,4,16,64 by default")
+    parser.add_option("-t", "--threads", type="int", default=8,
+            help="number of threads incrementing the counter")
+    parser.add_option("-n", "--number", type="int", default=200,
+            help="number of increments by thread")
+    parser.add_option("--pick", default="random",
+            help="shard picked by increment, random or thread")
+    parser.add_option("-o", "--output",
+            help="write the results as JSON to this file")
+    parser.add_option("--uri",
+            help="uri of a CouchDB server to use instead of the in memory "
+            "backend")
+    options, args = parser.parse_args()
+
+    if options.uri:
+        server = Server(options.uri)
+    else:
+        backend = MemoryBackend()
+        backend.add_view("counters/total", map_total, "_sum")
+        server = Server(resource_instance=MemoryResource(backend=backend))
+
+    results = []
+    for shards in [int(s) for s in options.shards.split(',')]:
+        result = run(server, shards, options.threads, options.number,
+                options.pick)
+        results.append(result)
+        print >>sys.stderr, "%4d shards %10.1f increments/s %6d conflicts" \
+                % (shards, result["increments_per_sec"],
+                        result["conflicts"])
+
+    data = json.dumps({"server": options.uri and "couchdb" or "memory",
+        "results": results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data)
+    else:
+        print data
+
+if __name__ == '__main__':
+    main()
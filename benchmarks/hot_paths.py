@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Measure the throughput and latency of the client hot paths against a
+local in-process CouchDB stand-in (see `stub_server.py`), so runs don't
+depend on the network or on a CouchDB install: `save_doc`, `save_docs`
+with several batch sizes, `open_doc`, view iteration with and without
+schema wrapping, `ChangesStream` parsing and attachment upload and
+download.
+
+Results are written as JSON and can be compared to a baseline saved by a
+previous run. The exit status is 1 if a benchmark is slower than the
+baseline by more than the threshold:
+
+    $ python benchmarks/hot_paths.py --output baseline.json
+    $ python benchmarks/hot_paths.py --baseline baseline.json
+
+Use `--uri` to run against a real CouchDB server instead, or `--memory`
+to measure the client alone with the in memory backend of
+`couchdbkit.memory`.
+"""
+
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchdbkit import Server, Document, StringProperty, \
+        IntegerProperty, ListProperty, __version__
+from couchdbkit.changes import ChangesStream
+from couchdbkit.jsoncodec import get_json_codec
+from couchdbkit.memory import MemoryResource
+
+from stub_server import StubServer
+
+DB_NAME = "couchdbkit_bench"
+
+BATCH_SIZES = (10, 100, 1000)
+
+
+class Article(Document):
+    title = StringProperty()
+    author = StringProperty()
+    tags = ListProperty()
+    score = IntegerProperty()
+    body = StringProperty()
+
+
+def make_doc(i):
+    return {
+        "_id": "doc-%08d" % i,
+        "doc_type": "Article",
+        "title": u"Title of the article number %d" % i,
+        "author": u"author%d@example.com" % i,
+        "tags": ["couchdb", "python", "json"],
+        "score": i,
+        "body": u"Lorem ipsum dolor sit amet, consectetur adipiscing "
+                u"élit. " * 5
+    }
+
+
+class Bench(object):
+    """ run one benchmark, timing each operation """
+
+    def __init__(self, name, func, setup=None, items=1):
+        """
+        @param name: str, name of the benchmark in the results
+        @param func: callable, called with the database and the index
+        of the operation
+        @param setup: callable, called with the database and the number
+        of operations before the operations
+        @param items: int, number of documents, rows or changes handled
+        by one operation
+        """
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.items = items
+
+    def run(self, server, number):
+        if DB_NAME in server:
+            server.delete_db(DB_NAME)
+        db = server.create_db(DB_NAME)
+        if self.setup is not None:
+            self.setup(db, number)
+
+        latencies = []
+        for i in range(number):
+            start = time.time()
+            self.func(db, i)
+            latencies.append(time.time() - start)
+        server.delete_db(DB_NAME)
+        return summarize(latencies, self.items)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+def summarize(latencies, items):
+    total = sum(latencies)
+    return {
+        "ops": len(latencies),
+        "seconds": total,
+        "ops_per_sec": len(latencies) / total if total else None,
+        "items_per_sec": len(latencies) * items / total if total else None,
+        "mean": total / len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "max": max(latencies)
+    }
+
+
+def fill(count):
+    def setup(db, number):
+        for start in range(0, count, 1000):
+            db.save_docs([make_doc(i) for i in range(start,
+                min(count, start + 1000))])
+    return setup
+
+
+def setup_attachment(size):
+    content = os.urandom(size)
+
+    def setup(db, number):
+        doc = {"_id": "with-attachment"}
+        db.save_doc(doc)
+        db.put_attachment(doc, content, "data.bin",
+                "application/octet-stream")
+    return setup
+
+
+def benchmarks(view_rows=1000, attachment_size=64 * 1024):
+    """ return the list of benchmarks """
+    content = os.urandom(attachment_size)
+
+    def save_doc(db, i):
+        db.save_doc(make_doc(i))
+
+    def save_docs(size):
+        def func(db, i):
+            db.save_docs([make_doc(i * size + j) for j in range(size)])
+        return func
+
+    def open_doc(db, i):
+        db.open_doc("doc-%08d" % (i % 100))
+
+    def view(db, i):
+        db.view('_all_docs', include_docs=True).all()
+
+    def view_schema(db, i):
+        db.view('_all_docs', schema=Article, include_docs=True).all()
+
+    def view_stream(db, i):
+        for row in db.view('_all_docs', include_docs=True, stream=True):
+            pass
+
+    def changes(db, i):
+        for change in ChangesStream(db):
+            pass
+
+    docs = []
+    def setup_put_attachment(db, number):
+        docs[:] = [{"_id": "att-%08d" % i} for i in range(number)]
+        db.save_docs(docs)
+
+    def put_attachment(db, i):
+        db.put_attachment(docs[i], content, "data.bin",
+                "application/octet-stream")
+
+    def fetch_attachment(db, i):
+        db.fetch_attachment("with-attachment", "data.bin")
+
+    result = [Bench("save_doc", save_doc)]
+    for size in BATCH_SIZES:
+        result.append(Bench("save_docs_%d" % size, save_docs(size),
+            items=size))
+    result.extend([
+        Bench("open_doc", open_doc, setup=fill(100)),
+        Bench("view", view, setup=fill(view_rows), items=view_rows),
+        Bench("view_schema", view_schema, setup=fill(view_rows),
+            items=view_rows),
+        Bench("view_stream", view_stream, setup=fill(view_rows),
+            items=view_rows),
+        Bench("changes", changes, setup=fill(view_rows), items=view_rows),
+        Bench("put_attachment", put_attachment,
+            setup=setup_put_attachment),
+        Bench("fetch_attachment", fetch_attachment,
+            setup=setup_attachment(attachment_size))
+    ])
+    return result
+
+
+def compare(results, baseline, threshold):
+    """ return a list of (name, ratio, regressed) comparing the items
+    per second of `results` to `baseline` """
+    comparison = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or not base.get("items_per_sec") or \
+                not result.get("items_per_sec"):
+            continue
+        ratio = result["items_per_sec"] / base["items_per_sec"]
+        comparison.append((name, ratio, ratio < 1 - threshold))
+    return comparison
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("-n", "--number", type="int", default=200,
+            help="number of operations by benchmark, divided by 10 for "
+            "view, changes and large batches")
+    parser.add_option("-o", "--output",
+            help="write the results as JSON to this file")
+    parser.add_option("-b", "--baseline",
+            help="compare the results with a JSON file written by a "
+            "previous run")
+    parser.add_option("-t", "--threshold", type="float", default=0.1,
+            help="slowdown compared to the baseline reported as a "
+            "regression, 0.1 by default (10%)")
+    parser.add_option("--uri",
+            help="uri of a CouchDB server to use instead of the stub")
+    parser.add_option("--memory", action="store_true",
+            help="use the in memory backend instead of the stub, no HTTP "
+            "request is sent")
+    parser.add_option("--codec", help="JSON codec to use")
+    options, names = parser.parse_args()
+
+    codec = get_json_codec(options.codec)
+    stub = None
+    if options.memory:
+        server = Server(json_codec=codec, resource_instance=MemoryResource())
+        server_name = "memory"
+    elif options.uri:
+        server = Server(options.uri, json_codec=codec)
+        server_name = "couchdb"
+    else:
+        stub = StubServer()
+        stub.start()
+        server = Server(stub.uri, json_codec=codec)
+        server_name = "stub"
+
+    results = {}
+    try:
+        for bench in benchmarks():
+            if names and bench.name not in names:
+                continue
+            number = options.number
+            if bench.items > 100:
+                number = max(1, number // 10)
+            results[bench.name] = result = bench.run(server, number)
+            print >>sys.stderr, "%-18s %10.1f items/s %10.3f ms p50 " \
+                    "%10.3f ms p95" % (bench.name, result["items_per_sec"],
+                    result["p50"] * 1000, result["p95"] * 1000)
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    report = {
+        "couchdbkit": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "codec": codec.name,
+        "server": server_name,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results
+    }
+
+    status = 0
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+        comparison = compare(results, baseline, options.threshold)
+        report["comparison"] = dict((name, {"ratio": ratio,
+            "regression": regressed}) for name, ratio, regressed in
+            comparison)
+        for name, ratio, regressed in comparison:
+            print >>sys.stderr, "%-18s %+7.1f%%%s" % (name,
+                    (ratio - 1) * 100, regressed and "  REGRESSION" or "")
+            if regressed:
+                status = 1
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data)
+    else:
+        print data
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Compare the speed of the available JSON codecs on payloads couchdbkit
+sends and receives: a document, a `_bulk_docs` request, a view response
+and a line of a continuous changes feed.
+
+Usage:
+
+    $ python benchmarks/json_codecs.py [--number N] [codec ...]
+
+"""
+
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchdbkit.jsoncodec import JSON_CODECS, get_json_codec
+
+
+def make_doc(i):
+    return {
+        "_id": "doc-%08d" % i,
+        "_rev": "1-967a00dff5e02add41819138abb3284d",
+        "doc_type": "Article",
+        "title": u"Title of the article number %d" % i,
+        "author": {"name": u"Benoît", "email": "author%d@example.com" % i},
+        "tags": ["couchdb", "python", "json"],
+        "published": True,
+        "score": i * 1.5,
+        "created_at": "2012-03-04T12:00:%02dZ" % (i % 60),
+        "body": u"Lorem ipsum dolor sit amet, consectetur adipiscing "
+                u"élit. " * 5
+    }
+
+
+def payloads():
+    docs = [make_doc(i) for i in range(1000)]
+    rows = [{"id": doc["_id"], "key": doc["_id"],
+            "value": {"rev": doc["_rev"]}, "doc": doc} for doc in docs]
+    return [
+        ("doc", docs[0]),
+        ("bulk_docs", {"docs": docs}),
+        ("view", {"total_rows": len(rows), "offset": 0, "rows": rows}),
+        ("change", {"seq": 42, "id": docs[0]["_id"],
+            "changes": [{"rev": docs[0]["_rev"]}]})
+    ]
+
+
+def bench(codec, number):
+    """ return a list of (payload, operation, seconds per call) """
+    results = []
+    for name, obj in payloads():
+        encoded = codec.dumps(obj)
+        count = number if name in ("doc", "change") else max(1,
+                number // 1000)
+        dumps = timeit.timeit(lambda: codec.dumps(obj), number=count)
+        loads = timeit.timeit(lambda: codec.loads(encoded), number=count)
+        results.append((name, "dumps", dumps / count))
+        results.append((name, "loads", loads / count))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [codec ...]")
+    parser.add_option("-n", "--number", type="int", default=10000,
+            help="number of calls for small payloads, large ones are "
+            "called number/1000 times")
+    options, names = parser.parse_args()
+
+    if not names:
+        names = [name for name, _ in JSON_CODECS]
+
+    print "%-12s %-10s %-6s %14s" % ("codec", "payload", "op", "usec/call")
+    for name in names:
+        try:
+            codec = get_json_codec(name)
+        except ImportError:
+            print "%-12s not installed" % name
+            continue
+
+        for payload, op, seconds in bench(codec, options.number):
+            print "%-12s %-10s %-6s %14.2f" % (name, payload, op,
+                    seconds * 1000000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+In-process stand-in for a CouchDB server used by the benchmarks. It
+serves the `MemoryBackend` of `couchdbkit.memory` over HTTP, so the
+client runs its whole network path against it.
+
+Usage:
+
+    >>> server = StubServer()
+    >>> server.start()
+    >>> couchdbkit.Server(server.uri)
+    >>> server.stop()
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+
+from couchdbkit.memory import MemoryBackend
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # send each response in one write, without waiting for ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def dispatch(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict((key, values[0]) for key, values in
+                urlparse.parse_qs(url.query).items())
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        status, headers, body = self.server.backend.handle(self.command,
+                url.path, params, body, dict(self.headers.items()))
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        self.send_response(status)
+        for name, value in headers.items():
+            if name.lower() != 'content-length':
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_COPY = dispatch
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubServer(object):
+    """ CouchDB stand-in serving requests from a thread """
+
+    def __init__(self, host="127.0.0.1", port=0, backend=None):
+        """ constructor for StubServer
+
+        @param host: str, address to listen on
+        @param port: int, port to listen on, 0 to pick a free one
+        @param backend: `MemoryBackend` answering the requests, a new one
+        is created if None
+        """
+        self.httpd = _HTTPServer((host, port), _Handler)
+        if backend is None:
+            backend = MemoryBackend()
+        self.httpd.backend = backend
+        self.uri = "http://%s:%s" % self.httpd.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                name="couchdbkit-stub-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
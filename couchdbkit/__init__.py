@@ -5,6 +5,7 @@
 
 from .version import version_info, __version__
 
+from .jsoncodec import set_json_codec, get_json_codec, register_json_codec
 from .resource import  RequestFailed, CouchdbResource
 from .exceptions import InvalidAttachment, DuplicatePropertyError,\
 BadValueError, MultipleResultsFound, NoResultFound, ReservedWordError,\
@@ -12,6 +13,7 @@ DocsPathNotFound, BulkSaveError, ResourceNotFound, ResourceConflict, \
 PreconditionFailed
 
 from .client import Server, Database, ViewResults
+from .cache import LRUCache
 from .changes import ChangesStream
 from .consumer import Consumer
 from .designer import document, push, pushdocs, pushapps, clone
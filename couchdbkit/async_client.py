@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Cooperative client for CouchDB built on gevent. `AsyncServer`,
+`AsyncDatabase` and `AsyncViewResults` mirror `Server`, `Database` and
+`ViewResults` but each call is spawned in a greenlet pool and returns a
+`gevent.Greenlet`. Call `get()` on it to wait for the result (errors are
+raised the same way the synchronous client raise them) or `link` it to a
+callback. Thousands of requests can then share one process without a big
+thread pool.
+
+Requests only run concurrently once the socket module is patched by
+gevent. The application should patch it at startup, before other
+modules are imported:
+
+    >>> from gevent import monkey; monkey.patch_all()
+
+Example:
+
+    >>> from couchdbkit.async_client import AsyncServer
+    >>> server = AsyncServer()
+    >>> db = server.get_db('couchdbkit_test')
+    >>> jobs = [db.open_doc(docid) for docid in docids]
+    >>> docs = [job.get() for job in jobs]
+    >>> for row in db.view('_all_docs'):
+    ...     print row
+
+"""
+
+import sys
+
+from gevent import monkey
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+from .client import Server, Database
+
+DEFAULT_POOL_SIZE = 100
+
+# rows read ahead of the iterating greenlet by `AsyncViewResults`
+DEFAULT_READ_AHEAD = 100
+
+# end of the rows of an `AsyncViewResults` iteration
+_END = object()
+
+
+def _spawned(name):
+    """ return a method spawning the call of the wrapped object method
+    `name` in the pool """
+    def _spawn(self, *args, **kwargs):
+        return self.pool.spawn(getattr(self.wrapped, name), *args, **kwargs)
+    _spawn.__name__ = name
+    return _spawn
+
+
+class AsyncServer(object):
+    """ Server object whose calls are run in a gevent pool. Methods
+    return a greenlet, except `get_db` and `__getitem__` which don't
+    perform any request. """
+
+    def __init__(self, uri='http://127.0.0.1:5984', pool=None,
+            pool_size=DEFAULT_POOL_SIZE, patch=False, **params):
+        """ constructor for AsyncServer object
+
+        @param uri: uri of CouchDb host
+        @param pool: `gevent.pool.Pool` instance to spawn requests in.
+        @param pool_size: max number of concurrent requests if pool is
+        not set.
+        @param patch: boolean, patch the socket module so restkit
+        connections are cooperative. Patching at the startup of the
+        application, before sockets are created, is safer.
+        @param params: `couchdbkit.client.Server` parameters
+        """
+        if patch:
+            monkey.patch_socket()
+        self.pool = pool or Pool(pool_size)
+        self.wrapped = Server(uri, **params)
+        self.uri = self.wrapped.uri
+
+    info = _spawned('info')
+    all_dbs = _spawned('all_dbs')
+    delete_db = _spawned('delete_db')
+    replicate = _spawned('replicate')
+    active_tasks = _spawned('active_tasks')
+    uuids = _spawned('uuids')
+
+    def get_db(self, dbname, **params):
+        """ return an AsyncDatabase object for dbname """
+        return AsyncDatabase(self.wrapped.get_db(dbname, **params),
+                pool=self.pool)
+
+    def create_db(self, dbname, **params):
+        """ create a database on CouchDb host. The greenlet returns an
+        AsyncDatabase instance """
+        def _create():
+            return AsyncDatabase(self.wrapped.create_db(dbname, **params),
+                    pool=self.pool)
+        return self.pool.spawn(_create)
+    get_or_create_db = create_db
+
+    def __getitem__(self, dbname):
+        return self.get_db(dbname)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.uri)
+
+
+class AsyncDatabase(object):
+    """ Database object whose calls are run in a gevent pool. Methods
+    return a greenlet, except views which return an `AsyncViewResults`
+    instance. """
+
+    def __init__(self, db, pool=None, pool_size=DEFAULT_POOL_SIZE):
+        """ constructor for AsyncDatabase
+
+        @param db: `couchdbkit.client.Database` instance
+        @param pool: `gevent.pool.Pool` instance to spawn requests in.
+        """
+        if not isinstance(db, Database):
+            raise TypeError('%s is not a couchdbkit.Database instance' %
+                    db.__class__.__name__)
+        self.wrapped = db
+        self.pool = pool or Pool(pool_size)
+        self.dbname = db.dbname
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.dbname)
+
+    info = _spawned('info')
+    doc_exist = _spawned('doc_exist')
+    open_doc = _spawned('open_doc')
+    get = open_doc
+    get_rev = _spawned('get_rev')
+    save_doc = _spawned('save_doc')
+    save_docs = _spawned('save_docs')
+    bulk_save = save_docs
+    delete_doc = _spawned('delete_doc')
+    delete_docs = _spawned('delete_docs')
+    bulk_delete = delete_docs
+    copy_doc = _spawned('copy_doc')
+    put_attachment = _spawned('put_attachment')
+    delete_attachment = _spawned('delete_attachment')
+    fetch_attachment = _spawned('fetch_attachment')
+    ensure_full_commit = _spawned('ensure_full_commit')
+    compact = _spawned('compact')
+
+    def replicate(self, target, **params):
+        """ replicate this database to `target`, a dbname or an URI """
+        return self.pool.spawn(self.wrapped.server.replicate,
+                self.dbname, target, **params)
+
+    def view(self, view_name, schema=None, wrapper=None, **params):
+        """ like `Database.view` but return an `AsyncViewResults` """
+        return AsyncViewResults(self.wrapped.view(view_name, schema=schema,
+                wrapper=wrapper, **params), pool=self.pool)
+
+    def all_docs(self, by_seq=False, **params):
+        """ like `Database.all_docs` but return an `AsyncViewResults` """
+        return AsyncViewResults(self.wrapped.all_docs(by_seq=by_seq,
+                **params), pool=self.pool)
+
+    def temp_view(self, design, schema=None, wrapper=None, **params):
+        return AsyncViewResults(self.wrapped.temp_view(design,
+                schema=schema, wrapper=wrapper, **params), pool=self.pool)
+
+
+class AsyncViewResults(object):
+    """ Wrap a `ViewResults` object. `fetch`, `all`, `first`, `one` and
+    `count` return a greenlet. Iterating the object streams the rows
+    with `ViewResults.iter_stream` in a greenlet of the pool: each row is
+    yielded as soon as it is read and the iterating greenlet only waits
+    for the next one. Like `iter_stream`, each iteration performs a new
+    request. """
+
+    def __init__(self, view, pool=None, pool_size=DEFAULT_POOL_SIZE):
+        self.wrapped = view
+        self.pool = pool or Pool(pool_size)
+
+    fetch = _spawned('fetch')
+    all = _spawned('all')
+    first = _spawned('first')
+    one = _spawned('one')
+    count = _spawned('count')
+
+    def __getitem__(self, key):
+        return AsyncViewResults(self.wrapped[key], pool=self.pool)
+
+    def __call__(self, **newparams):
+        return AsyncViewResults(self.wrapped(**newparams), pool=self.pool)
+
+    def __iter__(self):
+        rows = Queue(DEFAULT_READ_AHEAD)
+
+        def stream():
+            try:
+                for row in self.wrapped.iter_stream():
+                    rows.put((row, None))
+            except Exception:
+                rows.put((None, sys.exc_info()))
+            else:
+                rows.put((_END, None))
+
+        job = self.pool.spawn(stream)
+        try:
+            while True:
+                row, exc_info = rows.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                elif row is _END:
+                    return
+                yield row
+        finally:
+            # the iteration may be stopped before the last row
+            job.kill(block=False)
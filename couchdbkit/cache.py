@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+In-process caches used to avoid downloading and decoding again
+documents that didn't change on the server. Entries are validated with
+the server using their revision (or ETag) so a cache never returns stale
+data, it only saves the transfer and the JSON decoding.
+
+Example:
+
+    >>> from couchdbkit import Server, LRUCache
+    >>> server = Server()
+    >>> db = server.get_db('couchdbkit_test', cache=LRUCache(size=1000,
+    ...     ttl=300))
+    >>> doc = db.open_doc('config')
+    >>> doc = db.open_doc('config') # 304 Not Modified, returned from cache
+    >>> db.cache.stats()
+    {'hits': 1, 'misses': 1, 'revalidations': 0, 'size': 1}
+
+"""
+
+import threading
+import time
+
+DEFAULT_CACHE_SIZE = 1000
+
+
+def json_copy(obj):
+    """ copy of a decoded JSON object, faster than `copy.deepcopy` """
+    if isinstance(obj, dict):
+        return dict((k, json_copy(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [json_copy(v) for v in obj]
+    return obj
+
+
+class LRUCache(object):
+    """ Least recently used cache of (etag, value) entries. Values are
+    decoded JSON objects and are copied when they are stored and
+    returned, so callers can modify them.
+
+    `hits`, `misses` and `revalidations` are counted by the users of
+    the cache (see `incr`) and can be read with `stats()`:
+
+    * hits: entries still valid on the server (304 Not Modified)
+    * misses: keys not in the cache or expired
+    * revalidations: entries that changed on the server and were
+      downloaded again
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=None):
+        """ constructor for LRUCache
+
+        @param size: int, max number of entries
+        @param ttl: int, number of seconds an entry stays in the cache
+        """
+        if size < 1:
+            raise ValueError("cache size should be > 0")
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """ remove all entries """
+        with self._lock:
+            self._entries = {}
+            # circular doubly linked list of [prev, next, key] links,
+            # most recently used entries are next to the root
+            self._root = root = []
+            root[:] = [root, root, None]
+
+    def get(self, key):
+        """ return the (etag, value) entry of `key` or None. A miss is
+        counted if the key isn't in the cache """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    entry[1] < time.time():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            link, expires, etag, value = entry
+            self._unlink(link)
+            self._link(link)
+        return etag, json_copy(value)
+
+    def set(self, key, etag, value):
+        """ store `value` validated by `etag` """
+        value = json_copy(value)
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            elif len(self._entries) >= self.size:
+                # evict the least recently used entry
+                self._remove(self._root[0][2])
+
+            link = [None, None, key]
+            self._link(link)
+            self._entries[key] = (link, expires, etag, value)
+
+    def delete(self, key):
+        """ invalidate `key` """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def incr(self, counter):
+        """ increment one of the hits, misses or revalidations
+        counters """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        """ return counters and size of the cache """
+        with self._lock:
+            return {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "revalidations": self.revalidations,
+                    "size": len(self._entries)
+            }
+
+    def _link(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._unlink(entry[0])
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -7,8 +7,6 @@
 module to fetch and stream changes from a database
 """
 
-from .utils import json
-
 
 class ChangesStream(object):
     """\
@@ -69,7 +67,7 @@ class ChangesStream(object):
             return None
         else:
             try:
-                obj = json.loads(line)
+                obj = self.db.res.codec.loads(line)
                 return obj
             except ValueError:
                 return None
@@ -30,22 +30,46 @@ Example:
 UNKOWN_INFO = {}
 
 
+import base64
 from collections import deque
-from itertools import groupby
+from itertools import groupby, islice
+import logging
 from mimetypes import guess_type
+import random
+import threading
 import time
+import urlparse
 
+from restkit.errors import RequestError, RequestFailed
 from restkit.util import url_quote
 
+from .cache import json_copy
+from .cluster import Cluster
 from .exceptions import InvalidAttachment, NoResultFound, \
 ResourceNotFound, ResourceConflict, BulkSaveError, MultipleResultsFound
+from .jsoncodec import get_json_codec
 from . import resource
-from .utils import validate_dbname
+from .multipart import MultipartWriter, MultipartReader, \
+        has_inline_attachments, parse_boundary, save_attachments
+from .utils import validate_dbname, concurrent_map, concurrent_imap, json
+from .uuids import get_uuid_generator
+from .writer import BulkWriter, DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY
 
 from .schema.util import maybe_schema_wrapper
 
+# view queries slower than the `slow_query_threshold` of their database
+# are logged here
+slow_query_logger = logging.getLogger("couchdbkit.slow_query")
+
 
 DEFAULT_UUID_BATCH_COUNT = 1000
+DEFAULT_PAGE_SIZE = 1000
+
+# retries of update_doc after a conflict, and base delay in seconds
+# between them, doubled on each retry
+DEFAULT_UPDATE_RETRIES = 10
+DEFAULT_UPDATE_BACKOFF = 0.01
+MAX_UPDATE_BACKOFF = 1.0
 
 def _maybe_serialize(doc):
     if hasattr(doc, "to_json"):
@@ -71,25 +95,50 @@ class Server(object):
     def __init__(self, uri='http://127.0.0.1:5984',
             uuid_batch_count=DEFAULT_UUID_BATCH_COUNT,
             resource_class=None, resource_instance=None,
-            **client_opts):
+            uuid_algorithm=None, json_codec=None, **client_opts):
 
         """ constructor for Server object
 
-        @param uri: uri of CouchDb host
+        @param uri: uri of CouchDb host. A list of uris, or a
+            `couchdbkit.cluster.Cluster` instance, spreads requests over
+            the nodes of a cluster. The health checks of a cluster
+            created from a list of uris are stopped by `close`.
         @param uuid_batch_count: max of uuids to get in one time
         @param resource_instance: `restkit.resource.CouchdbDBResource` instance.
             It alows you to set a resource class with custom parameters.
+        @param uuid_algorithm: str, "random", "sequential" or "utc_random",
+            or an object with a `next_uuid` method. If set uuids are
+            generated locally instead of being requested to CouchDB. See
+            `couchdbkit.uuids`.
+        @param json_codec: name of a registered JSON codec or codec
+            instance used by this server instead of the default one. See
+            `couchdbkit.jsoncodec`.
         """
 
         if not uri or uri is None:
             raise ValueError("Server uri is missing")
 
+        self.cluster = None
+        self._owns_cluster = False
+        if isinstance(uri, (list, tuple)):
+            # health checks use the transport options of the requests
+            uri = Cluster(uri, **dict((name, value) for name, value in
+                client_opts.iteritems() if name not in
+                resource.COUCHDB_OPTIONS))
+            self._owns_cluster = True
+        if isinstance(uri, Cluster):
+            self.cluster = client_opts['cluster'] = uri
+            uri = uri.uris[0]
+
         if uri.endswith("/"):
             uri = uri[:-1]
 
         self.uri = uri
         self.uuid_batch_count = uuid_batch_count
         self._uuid_batch_count = uuid_batch_count
+        self.uuid_generator = None
+        if uuid_algorithm is not None:
+            self.uuid_generator = get_uuid_generator(uuid_algorithm)
 
         if resource_class is not None:
             self.resource_class = resource_class
@@ -97,12 +146,36 @@ class Server(object):
         if resource_instance and isinstance(resource_instance,
                                 resource.CouchdbResource):
             resource_instance.initial['uri'] = uri
+            # endpoints are found from paths relative to the server uri
+            resource_instance.initial['client_opts']['root_path'] = \
+                    urlparse.urlsplit(uri).path
+            if json_codec is not None:
+                resource_instance.initial['client_opts']['json_codec'] = \
+                        json_codec
+            if self.cluster is not None:
+                resource_instance.initial['client_opts']['cluster'] = \
+                        client_opts.pop('cluster')
             self.res = resource_instance.clone()
             if client_opts:
                 self.res.client_opts.update(client_opts)
         else:
+            if json_codec is not None:
+                client_opts['json_codec'] = json_codec
             self.res = self.resource_class(uri, **client_opts)
         self._uuids = deque()
+        self._uuids_lock = threading.Lock()
+
+    def close(self):
+        """ stop the health checks of the cluster created by this
+        server """
+        if self._owns_cluster:
+            self.cluster.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def info(self):
         """ info of server
@@ -191,16 +264,20 @@ class Server(object):
         """
         return an available uuid from couchdbkit
         """
-        if count is not None:
-            self._uuid_batch_count = count
-        else:
-            self._uuid_batch_count = self.uuid_batch_count
+        if self.uuid_generator is not None:
+            return self.uuid_generator.next_uuid()
 
-        try:
-            return self._uuids.pop()
-        except IndexError:
-            self._uuids.extend(self.uuids(count=self._uuid_batch_count)["uuids"])
-            return self._uuids.pop()
+        with self._uuids_lock:
+            if count is not None:
+                self._uuid_batch_count = count
+            else:
+                self._uuid_batch_count = self.uuid_batch_count
+
+            try:
+                return self._uuids.pop()
+            except IndexError:
+                self._uuids.extend(self.uuids(count=self._uuid_batch_count)["uuids"])
+                return self._uuids.pop()
 
     def __getitem__(self, dbname):
         return Database(self._db_uri(dbname), server=self)
@@ -239,13 +316,28 @@ class Database(object):
     A Database object can act as a Dict object.
     """
 
-    def __init__(self, uri, create=False, server=None, **params):
+    def __init__(self, uri, create=False, server=None, cache=None,
+            view_cache=None, loader=None, slow_query_threshold=None,
+            **params):
         """Constructor for Database
 
         @param uri: str, Database uri
         @param create: boolean, False by default,
         if True try to create the database.
         @param server: Server instance
+        @param cache: `couchdbkit.cache.LRUCache` instance, or any object
+        with the same interface, used to keep documents opened with
+        `open_doc`. Cached documents are revalidated with their
+        revision so they are only downloaded again when they changed.
+        @param view_cache: `couchdbkit.cache.LRUCache` instance used to keep
+        view results with their ETag. Results are only downloaded again
+        when the view changed.
+        @param loader: `couchdbkit.loader.DocLoader` instance. If set,
+        concurrent `open_doc` calls without params are fetched together
+        with one `_all_docs` request.
+        @param slow_query_threshold: float, view queries taking more
+        seconds are logged to the "couchdbkit.slow_query" logger with
+        their timing, see `ViewResults.explain`.
 
         """
         self.uri = uri.rstrip('/')
@@ -267,6 +359,13 @@ class Database(object):
                 self.server.res.put('/%s/' % self.dbname, **params).json_body
 
         self.res = server.res(self.dbname)
+        self.cache = cache
+        self.view_cache = view_cache
+        self.loader = loader
+        self.slow_query_threshold = slow_query_threshold
+        self._update_stats = {"updates": 0, "conflicts": 0, "retries": 0,
+                "failures": 0}
+        self._update_lock = threading.Lock()
 
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.dbname)
@@ -342,6 +441,9 @@ class Database(object):
             time.sleep(0.2)
             times += 1
 
+        if self.cache is not None:
+            self.cache.clear()
+
         # recreate db + ddocs
         self.server.create_db(self.dbname)
         self.bulk_save(ddocs)
@@ -359,6 +461,61 @@ class Database(object):
             return False
         return True
 
+    def docs_exist(self, ids, batch_size=DEFAULT_PAGE_SIZE, concurrency=1):
+        """ Test if documents exist with `_all_docs` requests instead of
+        one request per document.
+
+        @param ids: iterable of document ids
+        @param batch_size: int, number of ids sent by request
+        @param concurrency: int, number of requests sent in parallel
+
+        @return: dict, "exists", "deleted" or "missing" by document id
+        """
+        result = {}
+        for batch in self.iter_docs_exist(ids, batch_size=batch_size,
+                concurrency=concurrency):
+            result.update(batch)
+        return result
+
+    def iter_docs_exist(self, ids, batch_size=DEFAULT_PAGE_SIZE,
+            concurrency=1):
+        """ Like `docs_exist` but return an iterator of one dict by batch
+        of ids, yielded in order as soon as its request is done. `ids` is
+        consumed lazily, so a large stream of ids can be checked while
+        the previous batches are processed.
+        """
+        for rows in self._iter_all_docs_rows(ids, batch_size,
+                concurrency=concurrency):
+            result = {}
+            for row in rows:
+                value = row.get('value')
+                if value is None:
+                    result[row['key']] = "missing"
+                elif value.get('deleted'):
+                    result[row['key']] = "deleted"
+                else:
+                    result[row['key']] = "exists"
+            yield result
+
+    def _iter_all_docs_rows(self, keys, chunk_size=None, concurrency=1,
+            **params):
+        """ return an iterator of the rows of `_all_docs` for each chunk
+        of `chunk_size` keys (all the keys if None), in order. `keys` is
+        consumed lazily. """
+        def chunks():
+            it = iter(keys)
+            while True:
+                chunk = list(islice(it, chunk_size))
+                if not chunk:
+                    return
+                yield chunk
+
+        def fetch(chunk):
+            return self.raw_view('_all_docs', dict(params, keys=chunk)
+                    ).json_body.get('rows', [])
+
+        return concurrent_imap(fetch, chunks(), concurrency=concurrency)
+
     def open_doc(self, docid, **params):
         """Get document from database
 
@@ -366,12 +523,22 @@ class Database(object):
         @param docid: str, document id to retrieve
         @param wrapper: callable. function that takes dict as a param.
         Used to wrap an object.
+        @param multipart: boolean, if True the document is fetched with
+        its attachments in a multipart/related response. The `data` of
+        each attachment is then a file like object reading it lazily
+        from the response. Use the `atts_since` param (list of revisions)
+        to only get attachments changed since these revisions.
+        @param attachments_dir: str, fetch the document like `multipart`
+        and write its attachments in this directory. The `path` of each
+        written attachment is set in the document.
         @param **params: See doc api for parameters to use:
         http://wiki.apache.org/couchdb/HTTP_Document_API
 
         @return: dict, representation of CouchDB document as
          a dict.
         """
+        multipart = params.pop("multipart", False)
+        attachments_dir = params.pop("attachments_dir", None)
         wrapper = None
         if "wrapper" in params:
             wrapper = params.pop("wrapper")
@@ -381,8 +548,19 @@ class Database(object):
                 raise TypeError("invalid schema")
             wrapper = schema.wrap
 
-        docid = resource.escape_docid(docid)
-        doc = self.res.get(docid, **params).json_body
+        if multipart or attachments_dir is not None:
+            doc = self._open_multipart(docid, **params)
+            if attachments_dir is not None:
+                save_attachments(doc, attachments_dir)
+        elif self.loader is not None and \
+                all(value is None for value in params.values()):
+            doc = self.loader.load(self, docid)
+        elif self.cache is not None and \
+                all(value is None for value in params.values()):
+            doc = self._open_cached(docid)
+        else:
+            docid = resource.escape_docid(docid)
+            doc = self.res.get(docid, **params).json_body
         if wrapper is not None:
             if not callable(wrapper):
                 raise TypeError("wrapper isn't a callable")
@@ -392,6 +570,104 @@ class Database(object):
         return doc
     get = open_doc
 
+    def _open_multipart(self, docid, **params):
+        params.setdefault("attachments", True)
+        resp = self.res.get(resource.escape_docid(docid),
+                headers={"Accept": "multipart/related, application/json"},
+                **params)
+
+        boundary = None
+        content_type = resp.headers.get('content-type', '')
+        if content_type.startswith('multipart/related'):
+            boundary = parse_boundary(content_type)
+        if boundary is None:
+            # no attachment to send
+            return resp.json_body
+        return MultipartReader(resp.body_stream(), boundary,
+                codec=resp.json_codec).doc
+
+    def _open_cached(self, docid):
+        cache = self.cache
+        path = resource.escape_docid(docid)
+
+        entry = cache.get(docid)
+        if entry is None:
+            doc = self.res.get(path).json_body
+            cache.set(docid, doc['_rev'], doc)
+            return doc
+
+        rev, doc = entry
+        resp = self.res.get(path, headers={"If-None-Match": '"%s"' % rev})
+        if resp.status_int == 304:
+            resp.skip_body()
+            cache.incr('hits')
+            return doc
+
+        cache.incr('revalidations')
+        doc = resp.json_body
+        cache.set(docid, doc['_rev'], doc)
+        return doc
+
+    def _invalidate(self, docid):
+        if self.cache is not None and docid:
+            self.cache.delete(docid)
+
+    def open_docs(self, ids, schema=None, wrapper=None, batch_size=None,
+            concurrency=1, **params):
+        """ Get many documents from database. Documents are fetched with
+        one POST to `_all_docs?include_docs=true` per batch of ids.
+
+        @param ids: list of document ids
+        @param schema: schema, list of schemas or doc_type -> schema map
+        used to wrap documents.
+        @param wrapper: callable. function that takes dict as a param.
+        Used to wrap an object.
+        @param batch_size: int, if set ids are fetched by batches of
+        `batch_size` ids.
+        @param concurrency: int, number of batches fetched in parallel.
+        @param params: params of the `_all_docs` view.
+
+        @return: list of documents in the order of `ids`. Documents not
+        found or deleted are None. Repeated ids are fetched once, each
+        occurrence gets its own copy of the document.
+        """
+        if schema is not None:
+            wrapper = maybe_schema_wrapper(schema, params)
+        elif wrapper is not None and not callable(wrapper):
+            raise TypeError("wrapper isn't a callable")
+
+        ids = list(ids)
+        keys = []
+        seen = set()
+        for docid in ids:
+            if docid not in seen:
+                seen.add(docid)
+                keys.append(docid)
+
+        params['include_docs'] = True
+        docs = {}
+        for rows in self._iter_all_docs_rows(keys, batch_size or None,
+                concurrency=concurrency, **params):
+            for row in rows:
+                # missing docs have an error, deleted ones a null doc
+                doc = row.get('doc')
+                if doc is not None:
+                    docs[row['key']] = doc
+
+        results = []
+        used = set()
+        for docid in ids:
+            doc = docs.get(docid)
+            if doc is not None:
+                if docid in used:
+                    doc = json_copy(doc)
+                else:
+                    used.add(docid)
+                if wrapper is not None:
+                    doc = wrapper(doc)
+            results.append(doc)
+        return results
+
     def list(self, list_name, view_name, **params):
         """ Execute a list function on the server and return the response.
         If the response is json it will be deserialized, otherwise the string
@@ -444,6 +720,7 @@ class Database(object):
             update_path = '_design/%s/_update/%s' % (dname, uname)
             return self.res.post(update_path, **params).json_body
         else:
+            self._invalidate(doc_id)
             update_path = '_design/%s/_update/%s/%s' % (dname, uname, doc_id)
             return self.res.put(update_path, **params).json_body
 
@@ -473,6 +750,20 @@ class Database(object):
 
         return self.view('_all_docs', **params)
 
+    def iter_all_docs(self, batch=DEFAULT_PAGE_SIZE, **params):
+        """ iterate over all rows of `_all_docs`, fetching them `batch`
+        rows at a time with keyset pagination. Memory use and latency per
+        request stay the same whatever the size of the database.
+
+        @param batch: int, number of rows fetched per request
+        @param params: params of the view, like include_docs=True or schema
+
+        @return: iterator of rows
+        """
+        for rows, cursor in self.all_docs(**params).paginate(batch):
+            for row in rows:
+                yield row
+
     def get_rev(self, docid):
         """ Get last revision from docid (the '_rev' member)
         @param docid: str, undecoded document id.
@@ -482,8 +773,26 @@ class Database(object):
         response = self.res.head(resource.escape_docid(docid))
         return response['etag'].strip('"')
 
+    def get_revs(self, docids, chunk_size=DEFAULT_PAGE_SIZE):
+        """ Get the last revisions of many documents with `_all_docs`
+        requests instead of one request per document.
+
+        @param docids: list of undecoded document ids
+        @param chunk_size: int, number of ids sent by request
+
+        @return: dict, last revision by document id. Missing and deleted
+        documents aren't in it.
+        """
+        revs = {}
+        for rows in self._iter_all_docs_rows(docids, chunk_size):
+            for row in rows:
+                value = row.get('value')
+                if value is not None and not value.get('deleted'):
+                    revs[row['id']] = value['rev']
+        return revs
+
     def save_doc(self, doc, encode_attachments=True, force_update=False,
-            **params):
+            multipart=None, **params):
         """ Save a document. It will use the `_id` member of the document
         or request a new uuid from CouchDB. IDs are attached to
         documents on the client side because POST has the curious property of
@@ -495,6 +804,12 @@ class Database(object):
         by CouchDB server when you save.
         @param force_update: boolean, if there is conlict, try to update
         with latest revision
+        @param multipart: boolean, if True inline attachments are sent as
+        raw parts of a multipart/related request instead of being base64
+        encoded in the document. The `data` of an attachment can then be a
+        string or a file object which is streamed. By default multipart
+        is used when the data of an attachment is a file object. Saved
+        attachments are replaced by stubs in the document.
         @param params, list of optionnal params, like batch="ok"
 
         @return res: result of save. doc is updated in the mean time
@@ -504,20 +819,28 @@ class Database(object):
         else:
             doc1, schema = _maybe_serialize(doc)
 
+        writer = None
         if '_attachments' in doc1 and encode_attachments:
-            doc1['_attachments'] = resource.encode_attachments(doc['_attachments'])
+            if multipart is None:
+                multipart = has_inline_attachments(doc1['_attachments'],
+                        files_only=True)
+
+            if multipart and has_inline_attachments(doc1['_attachments']):
+                writer = MultipartWriter(doc1, codec=self.res.codec)
+                if '_id' not in doc1:
+                    doc1['_id'] = self.server.next_uuid()
+            else:
+                doc1['_attachments'] = resource.encode_attachments(doc['_attachments'])
 
-        if '_id' in doc:
+        if '_id' in doc1:
             docid = doc1['_id']
             docid1 = resource.escape_docid(doc1['_id'])
             try:
-                res = self.res.put(docid1, payload=doc1,
-                        **params).json_body
+                res = self._put_doc(docid1, doc1, writer, **params)
             except ResourceConflict:
                 if force_update:
                     doc1['_rev'] = self.get_rev(docid)
-                    res =self.res.put(docid1, payload=doc1,
-                            **params).json_body
+                    res = self._put_doc(docid1, doc1, writer, **params)
                 else:
                     raise
         else:
@@ -530,8 +853,19 @@ class Database(object):
 
         if 'batch' in params and 'id' in res:
             doc1.update({ '_id': res['id']})
+            self._invalidate(res['id'])
         else:
             doc1.update({'_id': res['id'], '_rev': res['rev']})
+            if writer is not None:
+                for att in doc1['_attachments'].itervalues():
+                    if att.pop('follows', False):
+                        att['stub'] = True
+            if self.cache is not None:
+                if '_attachments' in doc1:
+                    # the server keeps stubs of inline attachments
+                    self.cache.delete(res['id'])
+                else:
+                    self.cache.set(res['id'], res['rev'], doc1)
 
 
         if schema:
@@ -540,8 +874,16 @@ class Database(object):
             doc.update(doc1)
         return res
 
+    def _put_doc(self, docid, doc, writer=None, **params):
+        if writer is None:
+            return self.res.put(docid, payload=doc, **params).json_body
+
+        writer.reset()
+        return self.res.put(docid, payload=writer, headers=writer.headers(),
+                **params).json_body
+
     def save_docs(self, docs, use_uuids=True, all_or_nothing=False, new_edits=None,
-            **params):
+            chunk_size=None, concurrency=1, force_update=False, **params):
         """ bulk save. Modify Multiple Documents With a Single Request
 
         @param docs: list of docs
@@ -552,6 +894,14 @@ class Database(object):
         @param new_edits: When False, this saves existing revisions instead of
         creating new ones. Used in the replication Algorithm. Each document
         should have a _revisions property that lists its revision history.
+        @param chunk_size: int, if set docs are sent in batches of
+        `chunk_size` documents. all_or_nothing then only applies to each
+        batch. If a batch request fails, its documents are reported as
+        errors in the `BulkSaveError` raised once all batches are sent.
+        @param concurrency: int, number of batches sent in parallel.
+        @param force_update: boolean, if there are conflicts, the
+        conflicting documents are saved again with their latest
+        revisions, fetched with `get_revs`.
 
         .. seealso:: `HTTP Bulk Document API <http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API>`
 
@@ -579,18 +929,57 @@ class Database(object):
                 if nextid:
                     doc['_id'] = nextid
 
-        payload = { "docs": docs1 }
-        if all_or_nothing:
-            payload["all_or_nothing"] = True
-        if new_edits is not None:
-            payload["new_edits"] = new_edits
+        def save_chunk(chunk):
+            payload = { "docs": chunk }
+            if all_or_nothing:
+                payload["all_or_nothing"] = True
+            if new_edits is not None:
+                payload["new_edits"] = new_edits
+
+            try:
+                return self.res.post('/_bulk_docs',
+                        payload=payload, **params).json_body
+            except (RequestFailed, RequestError), e:
+                if not chunk_size:
+                    raise
+                return [{'id': doc.get('_id'), 'error': e.__class__.__name__,
+                    'reason': str(e)} for doc in chunk]
+
+        def save(docs):
+            if chunk_size:
+                chunks = [docs[i:i + chunk_size] for i in range(0,
+                    len(docs), chunk_size)]
+            else:
+                chunks = [docs]
+
+            results = []
+            for chunk_results in concurrent_map(save_chunk, chunks,
+                    concurrency=concurrency):
+                results.extend(chunk_results)
+            return results
 
         # update docs
-        results = self.res.post('/_bulk_docs',
-                payload=payload, **params).json_body
+        results = save(docs1)
+
+        if force_update:
+            conflicts = [i for i, res in enumerate(results)
+                    if res.get('error') == 'conflict']
+            if conflicts:
+                revs = self.get_revs([docs1[i]['_id'] for i in conflicts])
+                for i in conflicts:
+                    rev = revs.get(docs1[i]['_id'])
+                    if rev is None:
+                        # deleted since
+                        docs1[i].pop('_rev', None)
+                    else:
+                        docs1[i]['_rev'] = rev
+                retried = save([docs1[i] for i in conflicts])
+                for i, res in zip(conflicts, retried):
+                    results[i] = res
 
         errors = []
         for i, res in enumerate(results):
+            self._invalidate(res.get('id'))
             if 'error' in res:
                 errors.append(res)
             else:
@@ -609,6 +998,170 @@ class Database(object):
         return results
     bulk_save = save_docs
 
+    def update_doc(self, docid, fn, max_retries=DEFAULT_UPDATE_RETRIES,
+            backoff=DEFAULT_UPDATE_BACKOFF, create=False, **params):
+        """ Read-modify-write a document: fetch it, call `fn` with it and
+        save the result. On conflict the document is fetched again and
+        `fn` applied again after a random delay, so concurrent changes
+        aren't lost like with `save_doc(force_update=True)`.
+
+            >>> def incr(doc):
+            ...     doc['count'] = doc.get('count', 0) + 1
+            >>> db.update_doc('counter', incr, create=True)
+
+        @param docid: str, document id
+        @param fn: callable taking the document and returning the
+        document to save. If it returns None, the document it got is
+        saved. It may be called several times.
+        @param max_retries: int, number of retries after a conflict
+        before `ResourceConflict` is raised
+        @param backoff: float, delay in seconds before the first retry,
+        doubled on each retry and randomized
+        @param create: boolean, if True a missing document is created,
+        `fn` is then called with {'_id': docid}
+        @param params: params of `save_doc`
+
+        @return: the saved document
+        """
+        attempt = 0
+        while True:
+            try:
+                doc = self.open_doc(docid)
+            except ResourceNotFound:
+                if not create:
+                    raise
+                doc = {'_id': docid}
+
+            new_doc = fn(doc)
+            if new_doc is None:
+                new_doc = doc
+            try:
+                self.save_doc(new_doc, **params)
+            except ResourceConflict:
+                self._count_updates(conflicts=1)
+                if attempt >= max_retries:
+                    self._count_updates(failures=1)
+                    raise
+                attempt += 1
+                self._count_updates(retries=1)
+                self._backoff(backoff, attempt)
+                continue
+
+            self._count_updates(updates=1)
+            return new_doc
+
+    def update_docs(self, ids, fn, max_retries=DEFAULT_UPDATE_RETRIES,
+            backoff=DEFAULT_UPDATE_BACKOFF, create=False,
+            batch_size=DEFAULT_PAGE_SIZE, **params):
+        """ Bulk version of `update_doc`: fetch the documents with
+        `open_docs`, apply `fn` to each one and save them with
+        `save_docs`. Only the documents in conflict are fetched and
+        updated again.
+
+        @param ids: list of document ids
+        @param fn: callable taking a document and returning the document
+        to save, or None to save the document it got.
+        @param batch_size: int, number of documents by request
+        @param params: params of `save_docs`
+        See `update_doc` for the other params.
+
+        @return: list of `_bulk_docs` results in the order of `ids`.
+        Raise `BulkSaveError` if documents are missing or still in
+        conflict after `max_retries` retries.
+        """
+        ids = list(ids)
+        results = {}
+        pending = ids
+        attempt = 0
+        while pending:
+            docs = []
+            for docid, doc in zip(pending, self.open_docs(pending,
+                    batch_size=batch_size)):
+                if doc is None:
+                    if not create:
+                        results[docid] = {"id": docid, "error": "not_found",
+                                "reason": "missing"}
+                        self._count_updates(failures=1)
+                        continue
+                    doc = {'_id': docid}
+                new_doc = fn(doc)
+                docs.append(doc if new_doc is None else new_doc)
+            if not docs:
+                break
+
+            try:
+                saved = self.save_docs(docs, chunk_size=batch_size, **params)
+            except BulkSaveError, e:
+                saved = e.results
+
+            conflicts = []
+            updates = failures = 0
+            for res in saved:
+                results[res['id']] = res
+                error = res.get('error')
+                if error is None:
+                    updates += 1
+                elif error == 'conflict':
+                    conflicts.append(res['id'])
+                else:
+                    failures += 1
+            self._count_updates(updates=updates, conflicts=len(conflicts),
+                    failures=failures)
+            if not conflicts:
+                break
+            if attempt >= max_retries:
+                self._count_updates(failures=len(conflicts))
+                break
+            attempt += 1
+            self._count_updates(retries=len(conflicts))
+            self._backoff(backoff, attempt)
+            pending = conflicts
+
+        results = [results[docid] for docid in ids]
+        errors = [res for res in results if 'error' in res]
+        if errors:
+            raise BulkSaveError(errors, results)
+        return results
+
+    def update_stats(self):
+        """ return the counters of `update_doc` and `update_docs`: saved
+        updates, conflicts, retries and updates that failed, after all
+        their retries or because of another error """
+        with self._update_lock:
+            return dict(self._update_stats)
+
+    def _count_updates(self, **counts):
+        with self._update_lock:
+            for name, count in counts.iteritems():
+                self._update_stats[name] += count
+
+    def _backoff(self, backoff, attempt):
+        if backoff:
+            delay = min(MAX_UPDATE_BACKOFF, backoff * 2 ** (attempt - 1))
+            # jitter so concurrent writers don't retry together
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def writer(self, max_batch=DEFAULT_MAX_BATCH,
+            max_delay=DEFAULT_MAX_DELAY, max_queue=None, **params):
+        """ return a `couchdbkit.writer.BulkWriter` queuing documents
+        passed to its `save_doc` method and saving them in batches with
+        `_bulk_docs`. Use it as a context manager so queued documents are
+        written at the end of the block:
+
+            >>> with db.writer(max_batch=500, max_delay=0.05) as writer:
+            ...     future = writer.save_doc(doc)
+            >>> future.get()
+
+        @param max_batch: int, max number of documents by request
+        @param max_delay: float, max number of seconds a document waits
+        before its batch is sent
+        @param max_queue: int, max number of queued documents, `save_doc`
+        blocks until there is room. 10 * max_batch by default.
+        @param params: params of `save_docs`
+        """
+        return BulkWriter(self, max_batch=max_batch, max_delay=max_delay,
+                max_queue=max_queue, **params)
+
     def delete_docs(self, docs, all_or_nothing=False,
             empty_on_delete=False, **params):
         """ bulk delete.
@@ -660,10 +1213,12 @@ class Database(object):
 
             docid = resource.escape_docid(doc1['_id'])
             result = self.res.delete(docid, rev=doc1['_rev'], **params).json_body
+            self._invalidate(doc1['_id'])
         elif isinstance(doc1, basestring): # we get a docid
             rev = self.get_rev(doc1)
             docid = resource.escape_docid(doc1)
             result = self.res.delete(docid, rev=rev, **params).json_body
+            self._invalidate(doc1)
 
         if schema:
             doc._doc.update({
@@ -711,22 +1266,26 @@ class Database(object):
         if destination:
             headers.update({"Destination": str(destination)})
             result = self.res.copy('/%s' % docid, headers=headers).json_body
+            self._invalidate(result.get('id'))
             return result
 
         return { 'ok': False }
 
-    def raw_view(self, view_path, params):
+    def raw_view(self, view_path, params, headers=None):
         if 'keys' in params:
             keys = params.pop('keys')
-            return self.res.post(view_path, payload={ 'keys': keys }, **params)
+            return self.res.post(view_path, payload={ 'keys': keys },
+                    headers=headers, **params)
         else:
-            return self.res.get(view_path, **params)
+            return self.res.get(view_path, headers=headers, **params)
 
-    def raw_temp_view(db, design, params):
-        return db.res.post('_temp_view', payload=design,
-               headers={"Content-Type": "application/json"}, **params)
+    def raw_temp_view(db, design, params, headers=None):
+        headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        return db.res.post('_temp_view', payload=design, headers=headers,
+                **params)
 
-    def view(self, view_name, schema=None, wrapper=None, **params):
+    def view(self, view_name, schema=None, wrapper=None, stream=False,
+            **params):
         """ get view results from database. viewname is generally
         a string like `designname/viewname". It return an ViewResults
         object on which you could iterate, list, ... . You could wrap
@@ -740,6 +1299,8 @@ class Database(object):
         and beginning slash will be removed. Usefull with c-l for example.
         @param schema, Object with a wrapper function
         @param wrapper: function used to wrap results
+        @param stream: boolean, if True rows are parsed and wrapped one by
+        one while they are read from the response when iterating results.
         @param params: params of the view
 
         """
@@ -756,25 +1317,32 @@ class Database(object):
             vname = '/'.join(view_name)
             view_path = '_design/%s/_view/%s' % (dname, vname)
 
-        return ViewResults(self.raw_view, view_path, wrapper, schema, params)
+        return ViewResults(self.raw_view, view_path, wrapper, schema, params,
+                stream=stream, cache=self.view_cache,
+                slow_query_threshold=self.slow_query_threshold)
 
-    def temp_view(self, design, schema=None, wrapper=None, **params):
+    def temp_view(self, design, schema=None, wrapper=None, stream=False,
+            **params):
         """ get adhoc view results. Like view it reeturn a ViewResult object."""
-        return ViewResults(self.raw_temp_view, design, wrapper, schema, params)
+        return ViewResults(self.raw_temp_view, design, wrapper, schema, params,
+                stream=stream, slow_query_threshold=self.slow_query_threshold)
 
     def search( self, view_name, handler='_fti/_design', wrapper=None, schema=None, **params):
         """ Search. Return results from search. Use couchdb-lucene
         with its default settings by default."""
         return ViewResults(self.raw_view,
                     "/%s/%s" % (handler, view_name),
-                    wrapper=wrapper, schema=schema, params=params)
+                    wrapper=wrapper, schema=schema, params=params,
+                    slow_query_threshold=self.slow_query_threshold)
 
-    def documents(self, schema=None, wrapper=None, **params):
+    def documents(self, schema=None, wrapper=None, stream=False, **params):
         """ return a ViewResults objects containing all documents.
         This is a shorthand to view function.
         """
         return ViewResults(self.raw_view, '_all_docs',
-                wrapper=wrapper, schema=schema, params=params)
+                wrapper=wrapper, schema=schema, params=params, stream=stream,
+                cache=self.view_cache,
+                slow_query_threshold=self.slow_query_threshold)
     iterdocuments = documents
 
 
@@ -839,6 +1407,7 @@ class Database(object):
         docid = resource.escape_docid(doc1['_id'])
         res = self.res(docid).put(name, payload=content,
                 headers=headers, rev=doc1['_rev']).json_body
+        self._invalidate(doc1['_id'])
 
         if res['ok']:
             new_doc = self.get(doc1['_id'], rev=res['rev'])
@@ -860,6 +1429,7 @@ class Database(object):
 
         res = self.res(docid).delete(name, rev=doc1['_rev'],
                 headers=headers).json_body
+        self._invalidate(doc1['_id'])
         if res['ok']:
             new_doc = self.get(doc1['_id'], rev=res['rev'])
             doc.update(new_doc)
@@ -925,7 +1495,8 @@ class ViewResults(object):
     Object to retrieve view results.
     """
 
-    def __init__(self, fetch, arg, wrapper, schema, params):
+    def __init__(self, fetch, arg, wrapper, schema, params, stream=False,
+            cache=None, slow_query_threshold=None):
         """
         Constructor of ViewResults object
 
@@ -935,6 +1506,15 @@ class ViewResults(object):
         @param schema: schema or doc_type -> schema map to wrap rows with
         (only one of wrapper, schema must be set)
         @param params: params to apply when fetching view.
+        @param stream: boolean, if True iterating the results use
+        `iter_stream` instead of fetching and caching all rows.
+        @param cache: `couchdbkit.cache.LRUCache` instance. If set the
+        result is kept with its ETag. Next fetches of the same view with
+        the same params send it in If-None-Match and reuse the decoded
+        result if the view didn't change. fetch should then accept a
+        headers argument.
+        @param slow_query_threshold: float, queries taking more seconds
+        are logged to the "couchdbkit.slow_query" logger.
 
         """
         assert not (wrapper and schema)
@@ -968,13 +1548,31 @@ class ViewResults(object):
         self._total_rows = None
         self._offset = 0
         self._dynamic_keys = []
+        self._stream = stream
+        self._cache = cache
+        self.slow_query_threshold = slow_query_threshold
+        self._timing = None
 
     def iterator(self):
         self._fetch_if_needed()
         rows = self._result_cache.get('rows', [])
         wrapper = self.wrapper
-        for row in rows:
-            yield wrapper(row)
+        timing = self._timing
+        if timing['logged']:
+            # rows of this execution were already iterated and timed
+            for row in rows:
+                yield wrapper(row)
+            return
+
+        try:
+            for row in rows:
+                start = time.time()
+                obj = wrapper(row)
+                timing['wrap'] += time.time() - start
+                yield obj
+        finally:
+            # also logged when the iteration is stopped early
+            self._end_timing()
 
     def first(self):
         """
@@ -1018,9 +1616,240 @@ class ViewResults(object):
         self._fetch_if_needed()
         return len(self._result_cache.get('rows', []))
 
+    def explain(self):
+        """ return the timing of the last execution of the query, a dict
+        with the view `path`, `params`, number of `rows`, whether the
+        result came from the view cache (`cached`) and the seconds spent
+        in each phase: `request` (until the response headers are
+        received), `download` (reading the body), `decode` (JSON
+        decoding), `wrap` (wrapping rows, e.g. into `Document`
+        instances) and their `total`. Return None if the query wasn't
+        executed yet.
+        """
+        if self._timing is None:
+            return None
+        timing = self._timing.copy()
+        timing['params'] = timing['params'].copy()
+        timing['total'] = timing['request'] + timing['download'] + \
+                timing['decode'] + timing['wrap']
+        del timing['logged']
+        return timing
+
+    def _start_timing(self):
+        self._timing = {
+            "path": self._arg,
+            "params": self.params.copy(),
+            "rows": 0,
+            "cached": False,
+            "request": 0.0,
+            "download": 0.0,
+            "decode": 0.0,
+            "wrap": 0.0,
+            "logged": False
+        }
+        return self._timing
+
+    def _end_timing(self):
+        """ log the query if it was slow, once by execution, when its
+        rows have been wrapped or the first iteration stopped """
+        timing = self._timing
+        if self.slow_query_threshold is None or timing is None or \
+                timing['logged']:
+            return
+        timing['logged'] = True
+        info = self.explain()
+        if info['total'] >= self.slow_query_threshold:
+            slow_query_logger.warning("slow view query %s %s: %d rows in "
+                    "%.3fs (request %.3fs, download %.3fs, decode %.3fs, "
+                    "wrap %.3fs)" % (info['path'], info['params'],
+                        info['rows'], info['total'], info['request'],
+                        info['download'], info['decode'], info['wrap']),
+                    extra={"view_query": info})
+
+    def _timed_fetch(self, params, headers=None):
+        start = time.time()
+        if headers is None:
+            resp = self._fetch(self._arg, params)
+        else:
+            resp = self._fetch(self._arg, params, headers=headers)
+        self._timing['request'] += time.time() - start
+        return resp
+
+    def _decode(self, resp):
+        """ read and decode the body of `resp` """
+        timing = self._timing
+        start = time.time()
+        body = resp.body_string()
+        timing['download'] += time.time() - start
+
+        start = time.time()
+        try:
+            result = get_json_codec(resp.json_codec).loads(body)
+        except ValueError:
+            result = body
+        timing['decode'] += time.time() - start
+        return result
+
+    def iter_stream(self):
+        """ iterate wrapped rows while they are read from the response.
+        Only the row being parsed is kept in memory, so memory use depends
+        on the largest row rather than on the size of the results. Rows
+        aren't cached, each call performs a new request. `total_rows` and
+        `offset` are set as soon as the response header is read.
+        """
+        wrapper = self.wrapper
+        timing = self._start_timing()
+        # streamed responses aren't hedged
+        resp = self._timed_fetch(self.params.copy(),
+                headers={resource.NO_HEDGE_HEADER: "1"})
+        try:
+            for row in self._stream_rows(resp):
+                start = time.time()
+                obj = wrapper(row)
+                timing['wrap'] += time.time() - start
+                timing['rows'] += 1
+                yield obj
+        finally:
+            self._end_timing()
+
+    def _stream_rows(self, resp):
+        self._reset_meta()
+        codec_loads = resp.json_codec.loads
+        timing = self._timing
+
+        def loads(data):
+            start = time.time()
+            try:
+                return codec_loads(data)
+            finally:
+                timing['decode'] += time.time() - start
+
+        def readline():
+            start = time.time()
+            try:
+                return body.readline()
+            finally:
+                timing['download'] += time.time() - start
+
+        with resp.body_stream() as body:
+            header = readline().strip()
+            if not header.endswith('"rows":['):
+                # results aren't sent one row per line, decode them at once
+                start = time.time()
+                data = body.read()
+                timing['download'] += time.time() - start
+                result = loads(header + data)
+                self._update_meta(result)
+                for row in result.get('rows', []):
+                    yield row
+                return
+
+            self._update_meta(loads(header + ']}'))
+            while True:
+                line = readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith(']'):
+                    # end of rows, the footer may contain extra keys
+                    self._update_meta(loads('{"rows":[' + line))
+                    break
+                if line.endswith(','):
+                    line = line[:-1]
+                yield loads(line)
+
+    def paginate(self, page_size, cursor=None):
+        """ iterate the view page by page. Pages are fetched lazily using
+        `startkey`/`startkey_docid` of the row following the page
+        (`limit` is set to page_size + 1), so the server never has to
+        `skip` rows.
+
+        @param page_size: int, number of rows per page
+        @param cursor: str, token returned with a previous page. Pagination
+        is resumed from the page it points to.
+
+        @return: iterator of (rows, cursor) tuples, where rows is the list
+        of wrapped rows and cursor the token of the next page or None if
+        this is the last page.
+        """
+        if 'keys' in self.params:
+            raise ValueError("can't paginate a view queried with keys")
+
+        params = self.params.copy()
+        if cursor is not None:
+            params.pop('skip', None)
+            params.update(decode_cursor(cursor))
+
+        while True:
+            params['limit'] = page_size + 1
+            result = self._fetch(self._arg, params.copy()).json_body
+            rows = result.get('rows', [])
+
+            next_page = None
+            if len(rows) > page_size:
+                last = rows.pop()
+                next_page = {'startkey': last['key']}
+                if 'id' in last:
+                    next_page['startkey_docid'] = last['id']
+
+            wrapper = self.wrapper
+            if next_page is None:
+                yield [wrapper(row) for row in rows], None
+                break
+            yield [wrapper(row) for row in rows], encode_cursor(next_page)
+
+            params.pop('skip', None)
+            params.update(next_page)
+
     def fetch(self):
         """ fetch results and cache them """
-        # reset dynamic keys
+        self._reset_meta()
+        timing = self._start_timing()
+        if self._cache is not None:
+            self._result_cache = self._fetch_cached()
+        else:
+            self._result_cache = self._decode(self._timed_fetch(
+                    self.params.copy()))
+        assert isinstance(self._result_cache, dict), 'received an invalid ' \
+            'response of type %s: %s' % \
+            (type(self._result_cache), repr(self._result_cache))
+        self._update_meta(self._result_cache)
+        timing['rows'] = len(self._result_cache.get('rows', []))
+        if not timing['rows']:
+            # no row to wrap
+            self._end_timing()
+
+    def _fetch_cached(self):
+        cache = self._cache
+        key = (self._arg,
+                tuple(sorted(resource.encode_params(self.params).items())))
+
+        entry = cache.get(key)
+        if entry is None:
+            resp = self._timed_fetch(self.params.copy())
+            result = self._decode(resp)
+        else:
+            etag, result = entry
+            resp = self._timed_fetch(self.params.copy(),
+                    headers={"If-None-Match": etag})
+            if resp.status_int == 304:
+                resp.skip_body()
+                cache.incr('hits')
+                self._timing['cached'] = True
+                return result
+            cache.incr('revalidations')
+            result = self._decode(resp)
+
+        etag = resp.headers.get('etag')
+        if etag and isinstance(result, dict):
+            cache.set(key, etag, result)
+        return result
+
+    def _reset_meta(self):
+        self._total_rows = None
+        self._offset = 0
         for key in  self._dynamic_keys:
             try:
                 delattr(self, key)
@@ -1028,24 +1857,23 @@ class ViewResults(object):
                 pass
         self._dynamic_keys = []
 
-        self._result_cache = self.fetch_raw().json_body
-        assert isinstance(self._result_cache, dict), 'received an invalid ' \
-            'response of type %s: %s' % \
-            (type(self._result_cache), repr(self._result_cache))
-        self._total_rows = self._result_cache.get('total_rows')
-        self._offset = self._result_cache.get('offset', 0)
+    def _update_meta(self, result):
+        if 'total_rows' in result:
+            self._total_rows = result['total_rows']
+        if 'offset' in result:
+            self._offset = result['offset']
 
         # add key in view results that could be added by an external
         # like couchdb-lucene
-        for key in self._result_cache.keys():
+        for key in result.keys():
             if key not in ["total_rows", "offset", "rows"]:
                 self._dynamic_keys.append(key)
-                setattr(self, key, self._result_cache[key])
+                setattr(self, key, result[key])
 
 
     def fetch_raw(self):
         """ retrive the raw result """
-        return self._fetch(self._arg, self.params)
+        return self._fetch(self._arg, self.params.copy())
 
     def _fetch_if_needed(self):
         if not self._result_cache:
@@ -1054,6 +1882,8 @@ class ViewResults(object):
     @property
     def total_rows(self):
         """ return number of total rows in the view """
+        if self._stream and self._total_rows is not None:
+            return self._total_rows
         self._fetch_if_needed()
         # reduce case, count number of lines
         if self._total_rows is None:
@@ -1063,6 +1893,8 @@ class ViewResults(object):
     @property
     def offset(self):
         """ current position in the view """
+        if self._stream and self._total_rows is not None:
+            return self._offset
         self._fetch_if_needed()
         return self._offset
 
@@ -1078,7 +1910,10 @@ class ViewResults(object):
         else:
             params['key'] = key
 
-        return ViewResults(self._fetch, self._arg, wrapper=self.wrapper, params=params, schema=None)
+        return ViewResults(self._fetch, self._arg, wrapper=self.wrapper,
+                params=params, schema=None, stream=self._stream,
+                cache=self._cache,
+                slow_query_threshold=self.slow_query_threshold)
 
     def __call__(self, **newparams):
         return ViewResults(
@@ -1086,9 +1921,14 @@ class ViewResults(object):
             wrapper=self.wrapper,
             params=dict(self.params, **newparams),
             schema=None,
+            stream=self._stream,
+            cache=self._cache,
+            slow_query_threshold=self.slow_query_threshold,
         )
 
     def __iter__(self):
+        if self._stream and not self._result_cache:
+            return self.iter_stream()
         return self.iterator()
 
     def __len__(self):
@@ -1098,4 +1938,17 @@ class ViewResults(object):
         return bool(len(self))
 
 
+def encode_cursor(params):
+    """ encode view params of a page in an url safe token """
+    return base64.urlsafe_b64encode(json.dumps(params))
+
+def decode_cursor(cursor):
+    """ decode a token returned by `ViewResults.paginate` """
+    try:
+        params = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor: %r" % cursor)
 
+    if not isinstance(params, dict) or 'startkey' not in params:
+        raise ValueError("invalid cursor: %r" % cursor)
+    return params
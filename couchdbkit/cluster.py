@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Client side load balancing over the nodes of a CouchDB cluster. A
+`Server` created with a list of node URIs (or a `Cluster` instance) sends
+each request to one of the healthy nodes. All `Database` and
+`ViewResults` objects created from the server share its nodes.
+
+Nodes are selected by round-robin or by least outstanding requests. A
+node is taken out when a request to it fails with a connection error,
+safe requests (GET and HEAD) are then retried on another node. A
+background thread checks the nodes with `HEAD /_up` (or `HEAD /` on
+CouchDB 1.x) and puts recovered nodes back.
+
+Example:
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.cluster import Cluster
+    >>> server = Server(["http://node1:5984", "http://node2:5984"])
+    >>> server = Server(Cluster(["http://node1:5984", "http://node2:5984"],
+    ...     strategy="least_outstanding", health_check_interval=5))
+    >>> server.cluster.stats()
+    >>> server.close() # stop the health checks
+
+Reads can also be hedged: if a GET request didn't get an answer after a
+delay, by default the 95th percentile of the latency of previous
+requests, the same request is sent to another node. The first answer is
+used and the other request is cancelled. Only reads of documents, of
+views and of `_all_docs` are hedged, feeds, attachments and streamed
+views aren't. Pass `hedge=False` to a request to never hedge it:
+
+    >>> from couchdbkit.cluster import Hedging
+    >>> server = Server(["http://node1:5984", "http://node2:5984"],
+    ...     hedging=Hedging(percentile=95))
+    >>> server.res.hedging.stats()
+    {'requests': 1000, 'hedged': 52, 'hedge_wins': 31, 'delay': 0.012}
+
+"""
+
+from collections import deque
+import logging
+import Queue
+import sys
+import threading
+import time
+import urlparse
+
+from restkit.errors import RequestError, ResourceError
+
+from .instrument import endpoint
+from .utils import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEALTH_CHECK_INTERVAL = 10
+
+STRATEGIES = ("round_robin", "least_outstanding")
+
+# endpoints of `couchdbkit.instrument.endpoint` whose reads are hedged
+HEDGED_ENDPOINTS = ("server", "db", "doc", "_all_docs", "_view")
+
+DEFAULT_HEDGING_WORKERS = 16
+
+
+def strip_credentials(uri):
+    """ remove user and password of an uri """
+    u = urlparse.urlparse(uri)
+    return urlparse.urlunparse((u.scheme, u.netloc.split("@")[-1],
+        u.path, u.params, u.query, u.fragment)).rstrip('/')
+
+
+class Node(object):
+    """ a CouchDB node and its counters """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+                "healthy": self.healthy,
+                "outstanding": self.outstanding,
+                "requests": self.requests,
+                "failures": self.failures
+        }
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.uri,
+                self.healthy and "up" or "down")
+
+
+class Cluster(object):
+    """ nodes of a CouchDB cluster """
+
+    def __init__(self, uris, strategy="round_robin",
+            health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+            **client_opts):
+        """ constructor for Cluster
+
+        @param uris: list of node uris. The first one is used to build
+        the uris of databases.
+        @param strategy: str, "round_robin" or "least_outstanding"
+        @param health_check_interval: int, seconds between health checks
+        of the nodes, None to not check them. Nodes taken out are then
+        only put back when all nodes are down.
+        @param client_opts: options of the resources used to check
+        nodes.
+        """
+        if not uris:
+            raise ValueError("no node uri")
+        if strategy not in STRATEGIES:
+            raise ValueError("unknown strategy: %r" % strategy)
+
+        self.uris = [uri.rstrip('/') for uri in uris]
+        self.nodes = [Node(strip_credentials(uri)) for uri in self.uris]
+        self.strategy = strategy
+        self.health_check_interval = health_check_interval
+        self.client_opts = client_opts
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop = threading.Event()
+        self._checker = None
+        if health_check_interval:
+            self._checker = threading.Thread(target=self._run_checks,
+                    name="couchdbkit-health-check")
+            self._checker.daemon = True
+            self._checker.start()
+
+    def select(self, exclude=()):
+        """ return a node for the next request and increment its
+        outstanding requests. Nodes in `exclude` are only returned if
+        no other node is available. """
+        with self._lock:
+            nodes = [node for node in self.nodes if node.healthy and
+                    node not in exclude]
+            if not nodes:
+                nodes = [node for node in self.nodes if node not in
+                        exclude] or self.nodes
+
+            index = self._next % len(nodes)
+            self._next += 1
+            if self.strategy == "least_outstanding":
+                # round-robin between nodes with the same load
+                nodes = nodes[index:] + nodes[:index]
+                node = min(nodes, key=lambda node: node.outstanding)
+            else:
+                node = nodes[index]
+
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def release(self, node, failed=False):
+        """ the request sent to `node` is done """
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                if node.healthy:
+                    logger.warning("node %s is down" % node.uri)
+                node.healthy = False
+
+    def check(self, node):
+        """ check the health of `node` """
+        # import here to avoid a circular import
+        from .resource import CouchdbResource
+        res = CouchdbResource(node.uri, **self.client_opts)
+        try:
+            try:
+                res.head('/_up')
+            except ResourceError, e:
+                if e.status_int != 404:
+                    raise
+                # CouchDB 1.x
+                res.head('/')
+            healthy = True
+        except (RequestError, ResourceError):
+            healthy = False
+
+        with self._lock:
+            if healthy and not node.healthy:
+                logger.info("node %s is up" % node.uri)
+            elif not healthy and node.healthy:
+                logger.warning("node %s is down" % node.uri)
+            node.healthy = healthy
+        return healthy
+
+    def _run_checks(self):
+        while True:
+            self._stop.wait(self.health_check_interval)
+            if self._stop.is_set():
+                break
+            for node in self.nodes:
+                self.check(node)
+
+    def close(self):
+        """ stop health checks """
+        self._stop.set()
+        if self._checker is not None and \
+                self._checker is not threading.current_thread():
+            self._checker.join()
+
+    def stats(self):
+        """ return counters of each node """
+        with self._lock:
+            return dict((node.uri, node.stats()) for node in self.nodes)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.nodes)
+
+
+class Hedging(object):
+    """ send a second request when the first one is slower than a
+    percentile of the latency of previous requests. """
+
+    def __init__(self, percentile=95, delay=None, min_delay=0.001,
+            samples=1000, min_samples=20, endpoints=HEDGED_ENDPOINTS,
+            max_workers=DEFAULT_HEDGING_WORKERS):
+        """ constructor for Hedging
+
+        @param percentile: int, percentile of the previous latencies used
+        as delay.
+        @param delay: float, fixed delay in seconds, overrides percentile.
+        @param min_delay: float, min delay in seconds.
+        @param samples: int, number of latencies kept.
+        @param min_samples: int, requests aren't hedged until this number
+        of latencies is known.
+        @param endpoints: list of endpoints, as returned by
+        `couchdbkit.instrument.endpoint`, whose GET and HEAD requests are
+        hedged.
+        @param max_workers: int, max number of threads waiting for the
+        first request of hedged reads. Once they are all busy, requests
+        are sent without hedging.
+        """
+        self.percentile = percentile
+        self.fixed_delay = delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.endpoints = endpoints
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=samples)
+        self._delay = None
+        self._lock = threading.Lock()
+        self._workers = WorkerPool(max_workers, name="couchdbkit-hedging")
+
+    def hedges(self, method, path, params, headers, root=None):
+        """ return True if a request may be hedged: GET and HEAD requests
+        of `endpoints`, except feeds and documents fetched with their
+        attachments.
+
+        @param path: str, full path of the request
+        @param root: str, path of the server root in `path`
+        """
+        if method not in ('GET', 'HEAD'):
+            return False
+        if endpoint(path, root) not in self.endpoints:
+            return False
+        if 'feed' in params or params.get('attachments') == 'true':
+            return False
+        return 'multipart' not in headers.get('Accept', '')
+
+    def delay(self):
+        """ return the delay before sending the second request or None if
+        requests aren't hedged yet """
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        return self._delay
+
+    def record(self, latency):
+        """ add the latency of a request """
+        with self._lock:
+            self._latencies.append(latency)
+            count = len(self._latencies)
+            # the percentile is computed again every 10 requests
+            if count >= self.min_samples and (self._delay is None or
+                    count % 10 == 0):
+                latencies = sorted(self._latencies)
+                index = min(count - 1, count * self.percentile // 100)
+                self._delay = max(self.min_delay, latencies[index])
+
+    def run(self, send):
+        """ call `send` in a worker thread, and call it again in a new
+        thread if it didn't return after the delay. Return the first
+        result. """
+        delay = self.delay()
+        with self._lock:
+            self.requests += 1
+        if delay is None:
+            return self._run_once(send)
+
+        results = Queue.Queue()
+        state = {"done": False}
+        lock = threading.Lock()
+
+        def attempt(index):
+            result = exc_info = None
+            try:
+                result = send()
+            except Exception:
+                exc_info = sys.exc_info()
+
+            with lock:
+                lost = state["done"]
+                # a connection error isn't an answer, the other request
+                # may succeed
+                if exc_info is None or \
+                        not issubclass(exc_info[0], RequestError):
+                    state["done"] = True
+            if not lost:
+                results.put((index, result, exc_info))
+            elif result is not None:
+                # cancel the slowest request
+                result.close()
+
+        # the latency of a hedged request counts from the first attempt
+        start = time.time()
+        if self._workers.submit(attempt, 0) is None:
+            # all the workers are busy, the request isn't hedged
+            return self._run_once(send)
+
+        attempts = 1
+        try:
+            answer = results.get(timeout=delay)
+        except Queue.Empty:
+            with self._lock:
+                self.hedged += 1
+            self._spawn(attempt, 1)
+            attempts = 2
+            answer = results.get()
+
+        index, result, exc_info = answer
+        if exc_info is not None and attempts == 2 and \
+                issubclass(exc_info[0], RequestError):
+            other = results.get()
+            if other[2] is None:
+                index, result, exc_info = other
+
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.record(time.time() - start)
+        if index == 1:
+            with self._lock:
+                self.hedge_wins += 1
+        return result
+
+    def _run_once(self, send):
+        start = time.time()
+        result = send()
+        self.record(time.time() - start)
+        return result
+
+    def _spawn(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def stats(self):
+        """ return the number of requests, of hedged requests and of
+        requests won by the hedged request, and the current delay """
+        with self._lock:
+            return {
+                    "requests": self.requests,
+                    "hedged": self.hedged,
+                    "hedge_wins": self.hedge_wins,
+                    "delay": self.delay()
+            }
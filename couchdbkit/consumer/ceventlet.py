@@ -10,7 +10,6 @@ from eventlet import event
 
 from .base import check_callable
 from .sync import SyncConsumer
-from ..utils import json
 
 
 class ChangeConsumer(object):
@@ -74,7 +73,7 @@ class LongPollChangeConsumer(ChangeConsumer):
                 buf.append(data)
             change = "".join(buf)
             try:
-                change = json.loads(change)
+                change = resp.json_codec.loads(change)
             except ValueError:
                 pass
             self.process_change(change)
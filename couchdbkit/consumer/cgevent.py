@@ -11,7 +11,6 @@ from gevent import monkey
 
 from .base import check_callable
 from .sync import SyncConsumer
-from ..utils import json
 
 
 class ChangeConsumer(object):
@@ -76,7 +75,7 @@ class LongPollChangeConsumer(ChangeConsumer):
                 buf.append(data)
             change = "".join(buf)
             try:
-                change = json.loads(change)
+                change = resp.json_codec.loads(change)
             except ValueError:
                 pass
             self.process_change(change)
@@ -6,7 +6,6 @@
 from __future__ import with_statement
 
 from .base import ConsumerBase, check_callable
-from ..utils import json
 
 __all__ = ['SyncConsumer']
 
@@ -26,7 +25,7 @@ class SyncConsumer(ConsumerBase):
                     break
                 buf += data
 
-            ret = json.loads(buf)
+            ret = resp.json_codec.loads(buf)
             if cb is not None:
                 cb(ret)
                 return
@@ -51,6 +50,6 @@ class SyncConsumer(ConsumerBase):
                     if not line:
                         continue
 
-                    cb(json.loads(line))
+                    cb(resp.json_codec.loads(line))
                 except (KeyboardInterrupt, SystemExit,):
                     break
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Counters spread over several documents. Incrementing a counter stored in
+one document makes concurrent writers conflict all the time. A
+`ShardedCounter` writes each increment to one of its `shards`
+`CounterShard` documents, picked randomly or by thread, and reads its
+total with the `counters/total` view summing them.
+
+The revision of each shard written by a counter object is kept, so most
+increments are written without fetching the shard first. Conflicts are
+handled with `Database.update_doc`.
+
+    >>> from couchdbkit.counter import ShardedCounter
+    >>> ShardedCounter.push_design(db)
+    >>> views = ShardedCounter("page_views", db, shards=16)
+    >>> views.increment()
+    >>> views.value()
+    1
+
+The design document is in `couchdbkit/designs/counters`. With the memory
+backend of `couchdbkit.memory`, register `map_total` for it:
+
+    >>> backend.add_view("counters/total", map_total, "_sum")
+"""
+
+import os
+from itertools import count
+import random
+import threading
+import time
+
+from .designer import fs
+from .exceptions import ResourceConflict
+from .schema import Document, StringProperty, IntegerProperty
+from .client import DEFAULT_UPDATE_RETRIES, DEFAULT_UPDATE_BACKOFF
+
+DEFAULT_SHARDS = 16
+
+DESIGN_PATH = os.path.join(os.path.dirname(__file__), "designs", "counters")
+
+TOTAL_VIEW = "counters/total"
+
+PICKS = ("random", "thread")
+
+
+def map_total(doc):
+    """ Python version of the map function of the `counters/total` view
+    """
+    if doc.get('doc_type') == "CounterShard":
+        yield doc['counter'], doc['count']
+
+
+class CounterShard(Document):
+    """ one of the documents of a sharded counter """
+    counter = StringProperty(required=True)
+    shard = IntegerProperty(required=True)
+    count = IntegerProperty(default=0)
+
+
+class ShardedCounter(object):
+    """ counter whose increments are spread over several documents """
+
+    def __init__(self, name, db=None, shards=DEFAULT_SHARDS, pick="random",
+            cache_ttl=None, max_retries=DEFAULT_UPDATE_RETRIES,
+            backoff=DEFAULT_UPDATE_BACKOFF):
+        """ constructor for ShardedCounter
+
+        @param name: str, name of the counter
+        @param db: `couchdbkit.client.Database` instance, the database of
+        `CounterShard` by default
+        @param shards: int, number of shard documents. Changing it later
+        keeps the count of the shards already written.
+        @param pick: str, "random" to write each increment to a random
+        shard or "thread" to always use the same shard in a thread (or
+        greenlet)
+        @param cache_ttl: float, number of seconds the total read by
+        `value` is kept. Increments done with this object are added to
+        it. None to always query the view.
+        @param max_retries: int, retries on conflict, see
+        `Database.update_doc`
+        @param backoff: float, delay before the first retry in seconds
+        """
+        if pick not in PICKS:
+            raise ValueError("unknown pick: %r" % pick)
+        if shards < 1:
+            raise ValueError("shards should be at least 1")
+        self.name = name
+        self.db = db or CounterShard.get_db()
+        self.shards = shards
+        self.pick = pick
+        self.cache_ttl = cache_ttl
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # (rev, count) by shard id of the shards written by this object
+        self._known = {}
+        self._cached = None
+        self._lock = threading.Lock()
+        # shards are given to threads in turn
+        self._local = threading.local()
+        self._next_shard = count()
+
+    @staticmethod
+    def push_design(db):
+        """ push the `counters` design document to `db` """
+        fs.push(DESIGN_PATH, db)
+
+    def shard_id(self, shard):
+        """ return the document id of a shard """
+        return "counter.%s.%s" % (self.name, shard)
+
+    def _pick(self):
+        if self.pick == "thread":
+            shard = getattr(self._local, 'shard', None)
+            if shard is None:
+                with self._lock:
+                    shard = self._local.shard = next(self._next_shard) % \
+                            self.shards
+            return shard
+        return random.randrange(self.shards)
+
+    def increment(self, value=1):
+        """ add `value` to the counter """
+        shard = self._pick()
+        docid = self.shard_id(shard)
+        with self._lock:
+            known = self._known.get(docid)
+
+        doc = None
+        if known is not None:
+            # no read before the write
+            rev, current = known
+            doc = CounterShard(_id=docid, _rev=rev, counter=self.name,
+                    shard=shard, count=current + value)
+            try:
+                self.db.save_doc(doc)
+            except ResourceConflict:
+                doc = None
+
+        if doc is None:
+            def apply(data):
+                obj = CounterShard.wrap(data)
+                obj.counter = self.name
+                obj.shard = shard
+                obj.count = (obj.count or 0) + value
+                return obj
+            doc = self.db.update_doc(docid, apply, create=True,
+                    max_retries=self.max_retries, backoff=self.backoff)
+
+        with self._lock:
+            self._known[docid] = (doc._rev, doc.count)
+            if self._cached is not None:
+                self._cached = (self._cached[0] + value, self._cached[1])
+
+    def decrement(self, value=1):
+        """ remove `value` from the counter """
+        self.increment(-value)
+
+    def value(self, **params):
+        """ return the total of the counter
+
+        @param params: params of the view, like stale="update_after"
+        """
+        if self.cache_ttl is not None:
+            with self._lock:
+                cached = self._cached
+            if cached is not None and time.time() - cached[1] < \
+                    self.cache_ttl:
+                return cached[0]
+
+        row = self.db.view(TOTAL_VIEW, key=self.name, reduce=True,
+                **params).first()
+        total = row['value'] if row is not None else 0
+        if self.cache_ttl is not None:
+            with self._lock:
+                self._cached = (total, time.time())
+        return total
+
+    def __repr__(self):
+        return "<%s %s %s shards>" % (self.__class__.__name__, self.name,
+                self.shards)
@@ -14,8 +14,7 @@ import os.path
 import re
 
 from .. import client
-from ..exceptions import ResourceNotFound, DesignerError, \
-BulkSaveError
+from ..exceptions import ResourceNotFound, DesignerError
 from .macros import package_shows, package_views
 from .. import utils
 
@@ -88,8 +87,16 @@ class FSDoc(object):
         each attachments will be sent one by one."""
         for db in dbs:
             if atomic:
-                doc = self.doc(db, force=force)
-                db.save_doc(doc, force_update=True)
+                # attachments are streamed from their files in a
+                # multipart request instead of being base64 encoded
+                doc = self.doc(db, force=force, stream=True)
+                files = [att['data'] for att in doc['_attachments'].values()
+                        if hasattr(att.get('data'), 'read')]
+                try:
+                    db.save_doc(doc, force_update=True)
+                finally:
+                    for f in files:
+                        f.close()
             else:
                 doc = self.doc(db, with_attachments=False, force=force)
                 db.save_doc(doc, force_update=True)
@@ -106,22 +113,29 @@ class FSDoc(object):
                 self.docid, self.docdir))
 
 
-    def attachment_stub(self, name, filepath):
-        att = {}
+    def attachment_stub(self, name, filepath, stream=False):
+        """ return the attachment of `filepath`. If `stream` is True data
+        is the opened file, to be sent in a multipart request, else the
+        base64 encoded content of the file """
+        content_type = ';'.join(filter(None, mimetypes.guess_type(name)))
+        if stream:
+            return {"data": open(filepath, "rb"),
+                    "content_type": content_type}
+
         with open(filepath, "rb") as f:
-            re_sp = re.compile('\s')
             att = {
-                    "data": re_sp.sub('',base64.b64encode(f.read())),
-                    "content_type": ';'.join(filter(None,
-                                            mimetypes.guess_type(name)))
+                    "data": base64.b64encode(f.read()),
+                    "content_type": content_type
             }
 
         return att
 
-    def doc(self, db=None, with_attachments=True, force=False):
+    def doc(self, db=None, with_attachments=True, force=False,
+            stream=False):
         """ Function to reetrieve document object from
         document directory. If `with_attachments` is True
-        attachments will be included and encoded"""
+        attachments will be included and encoded. If `stream` is True
+        attachments data are opened files (see `attachment_stub`)"""
 
         manifest = []
         objects = {}
@@ -155,7 +169,8 @@ class FSDoc(object):
             signatures[name] = utils.sign_file(filepath)
             if with_attachments and not old_signatures:
                 logger.debug("attach %s " % name)
-                attachments[name] = self.attachment_stub(name, filepath)
+                attachments[name] = self.attachment_stub(name, filepath,
+                        stream=stream)
 
         if old_signatures:
             for name, signature in old_signatures.items():
@@ -173,7 +188,8 @@ class FSDoc(object):
                 for name, filepath in self.attachments():
                     if old_signatures.get(name) != signatures.get(name) or force:
                         logger.debug("attach %s " % name)
-                        attachments[name] = self.attachment_stub(name, filepath)
+                        attachments[name] = self.attachment_stub(name,
+                                filepath, stream=stream)
 
         self._doc['_attachments'] = attachments
 
@@ -421,20 +437,8 @@ def pushapps(path, dbs, atomic=True, export=False, couchapprc=False):
             return jsonobj
         else:
             for db in dbs:
-                docs = []
                 docs = [doc.doc(db) for doc in apps]
-                try:
-                    db.save_docs(docs)
-                except BulkSaveError, e:
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.get_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass
-                    if docs1:
-                        db.save_docs(docs1)
+                db.save_docs(docs, force_update=True)
 
 
 def pushdocs(path, dbs, atomic=True, export=False):
@@ -476,36 +480,28 @@ def pushdocs(path, dbs, atomic=True, export=False):
             return jsonobj
         else:
             for db in dbs:
+                # revisions of all the json docs in one request
+                revs = db.get_revs([doc['_id'] for doc in docs
+                    if not hasattr(doc, 'doc')])
                 docs1 = []
                 for doc in docs:
                     if hasattr(doc, 'doc'):
                         docs1.append(doc.doc(db))
                     else:
                         newdoc = doc.copy()
-                        try:
-                            rev = db.get_rev(doc['_id'])
-                            newdoc.update({'_rev': rev})
-                        except ResourceNotFound:
-                            pass
+                        if doc['_id'] in revs:
+                            newdoc['_rev'] = revs[doc['_id']]
                         docs1.append(newdoc)
-                try:
-                    db.save_docs(docs1)
-                except BulkSaveError, e:
-                    # resolve conflicts
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.get_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass
-                if docs1:
-                    db.save_docs(docs1)
-
-def clone(db, docid, dest=None, rev=None):
+                db.save_docs(docs1, force_update=True)
+
+def clone(db, docid, dest=None, rev=None, multipart=False):
     """
     Clone a CouchDB document to the fs.
 
+    If multipart is True, all the attachments are downloaded with the
+    document in one multipart response, even the ones whose files are
+    already up to date. By default the document is fetched with stubs
+    and only changed attachments are downloaded.
     """
     if not dest:
         dest = docid
@@ -515,9 +511,9 @@ def clone(db, docid, dest=None, rev=None):
         os.makedirs(path)
 
     if not rev:
-        doc = db.open_doc(docid)
+        doc = db.open_doc(docid, multipart=multipart)
     else:
-        doc = db.open_doc(docid, rev=rev)
+        doc = db.open_doc(docid, rev=rev, multipart=multipart)
     docid = doc['_id']
 
 
@@ -669,7 +665,7 @@ def clone(db, docid, dest=None, rev=None):
         if not os.path.isdir(attachdir):
             os.makedirs(attachdir)
 
-        for filename in doc['_attachments'].iterkeys():
+        for filename, att in doc['_attachments'].iteritems():
             if filename.startswith('vendor'):
                 attach_parts = utils.split_path(filename)
                 vendor_attachdir = os.path.join(path, attach_parts.pop(0),
@@ -682,12 +678,17 @@ def clone(db, docid, dest=None, rev=None):
             if not os.path.isdir(currentdir):
                 os.makedirs(currentdir)
 
+            stream = att.get('data')
             if signatures.get(filename) != utils.sign_file(filepath):
-                stream = db.fetch_attachment(docid, filename, stream=True)
+                if stream is None:
+                    stream = db.fetch_attachment(docid, filename,
+                            stream=True)
                 with open(filepath, 'wb') as f:
                     for chunk in stream:
                         f.write(chunk)
                 logger.debug("clone attachment: %s" % filename)
+            elif stream is not None:
+                stream.close()
 
     logger.debug("%s/%s cloned in %s" % (db.uri, docid, dest))
 
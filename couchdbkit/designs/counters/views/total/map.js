@@ -0,0 +1,5 @@
+function(doc) {
+    if (doc.doc_type == "CounterShard") {
+        emit(doc.counter, doc.count);
+    }
+}
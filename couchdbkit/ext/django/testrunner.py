@@ -7,7 +7,9 @@ from django.test.simple import DjangoTestSuiteRunner
 from django.conf import settings
 
 from . import loading
+from ...client import Server
 from ...exceptions import ResourceNotFound
+from ...memory import MemoryBackend, MemoryResource
 
 class CouchDbKitTestSuiteRunner(DjangoTestSuiteRunner):
     """
@@ -18,6 +20,10 @@ class CouchDbKitTestSuiteRunner(DjangoTestSuiteRunner):
     line to your settings.py file:
     
     TEST_RUNNER = 'myproject.testrunner.CouchDbKitTestSuiteRunner'
+
+    Set COUCHDB_TEST_IN_MEMORY = True in settings.py to run the tests
+    against an in memory database (see couchdbkit.memory) instead of
+    CouchDB.
     """
     
     dbs = []
@@ -50,6 +56,8 @@ class CouchDbKitTestSuiteRunner(DjangoTestSuiteRunner):
 
         old_handler = loading.couchdbkit_handler
         couchdbkit_handler = loading.CouchdbkitHandler(self.dbs)
+        if getattr(settings, "COUCHDB_TEST_IN_MEMORY", False):
+            self.use_memory_backend(couchdbkit_handler)
         loading.couchdbkit_handler = couchdbkit_handler
         loading.register_schema = couchdbkit_handler.register_schema
         loading.get_schema = couchdbkit_handler.get_schema
@@ -63,6 +71,15 @@ class CouchDbKitTestSuiteRunner(DjangoTestSuiteRunner):
                 
         return super(CouchDbKitTestSuiteRunner, self).setup_databases(**kwargs)
     
+    def use_memory_backend(self, handler):
+        """ replace the servers of the handler by servers sharing one
+        in memory backend """
+        backend = MemoryBackend()
+        for app_label, (server, dbname) in handler._databases.items():
+            res = MemoryResource(server.uri, backend=backend)
+            handler._databases[app_label] = (Server(server.uri,
+                resource_instance=res), dbname)
+
     def teardown_databases(self, old_config, **kwargs):
         deleted_databases = []
         skipcount = 0
@@ -15,18 +15,28 @@ def init_from_config(config):
     primary database.
 
     This prefixes the database name with test_ if we're running unit tests.
+    Set couchdb.in_memory to true to use an in memory database instead of
+    CouchDB.
     """
     uri = config['couchdb.uri']
     dbname = config['couchdb.dbname']
 
-    config['couchdb.db'] = init_db(uri, dbname)
+    resource_instance = None
+    if str(config.get('couchdb.in_memory', '')).lower() in ('true', '1'):
+        from ...memory import MemoryResource
+        resource_instance = MemoryResource(uri)
+
+    config['couchdb.db'] = init_db(uri, dbname,
+            resource_instance=resource_instance)
     config['couchdb.fixtures'] = os.path.join(config['pylons.paths']['root'], "fixtures")
 
-def init_db(uri, dbname, main_db=True):
+def init_db(uri, dbname, main_db=True, resource_instance=None):
     """Returns a db object and syncs the design documents on demand.
     If main_db is set to true then all models will use that one by default.
+    resource_instance is passed to the Server, a
+    couchdbkit.memory.MemoryResource runs the tests without CouchDB.
     """
-    server = Server(uri)
+    server = Server(uri, resource_instance=resource_instance)
 
     db = server.get_or_create_db(dbname)
     if main_db:
@@ -46,7 +46,10 @@ class TestCase(unittest.TestCase):
         except ResourceNotFound:
             pass
 
-        self._config['couchdb.db'] = init_db(self._config['couchdb.uri'], dbname)
+        # reuse the resource of the server, a MemoryResource keeps its
+        # backend
+        self._config['couchdb.db'] = init_db(self._config['couchdb.uri'],
+                dbname, resource_instance=self._config['couchdb.db'].server.res)
         sync_design(self._config['couchdb.db'], default_design_path(self._config))
 
         if hasattr(self, 'fixtures'):
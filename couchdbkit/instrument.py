@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Instrumentation of the requests sent to CouchDB. Hooks passed to a
+`CouchdbResource` (or a `Server`) are called before each request and
+once its response has been read, with a `RequestInfo` object describing
+the request: method, path, params, sizes, status, time to first byte,
+total time and exception.
+
+`RequestStats` is a hook keeping latency histograms by endpoint (document,
+`_bulk_docs`, `_view`, `_changes`, attachment, ...):
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.instrument import RequestStats
+    >>> stats = RequestStats()
+    >>> server = Server(hooks=[stats])
+    >>> server['mydb'].open_doc('mydoc')
+    >>> stats.stats()['GET doc']['count']
+    1
+    >>> print stats.prometheus()
+
+"""
+
+import bisect
+import threading
+
+# latency buckets in seconds, same as the default buckets of Prometheus
+# clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0)
+
+_DB_ENDPOINTS = ("_all_docs", "_bulk_docs", "_changes", "_temp_view",
+        "_compact", "_view_cleanup", "_revs_diff", "_missing_revs",
+        "_ensure_full_commit", "_purge", "_security", "_revs_limit")
+
+_DESIGN_ENDPOINTS = ("_view", "_list", "_show", "_update", "_info",
+        "_search", "_rewrite")
+
+
+def server_path(path, root=None):
+    """ return `path` relative to the server root `root`, the path of
+    the server uri when CouchDB is served under a prefix """
+    root = (root or '').rstrip('/')
+    if root and (path == root or path.startswith(root + '/')):
+        path = path[len(root):] or '/'
+    return path
+
+
+def endpoint(path, root=None):
+    """ return the endpoint of a request path: "server", "db", "doc",
+    "attachment", "_view", "_bulk_docs", ...
+
+    @param root: str, path of the server root, removed from `path`
+    """
+    path = server_path(path, root)
+    parts = [part for part in path.split('/') if part]
+    if not parts:
+        return "server"
+    elif parts[0].startswith('_'):
+        return parts[0]
+    elif len(parts) == 1:
+        return "db"
+
+    name = parts[1]
+    if name in ('_design', '_local'):
+        if len(parts) <= 3 or name == '_local':
+            return "doc"
+        elif parts[3] in _DESIGN_ENDPOINTS:
+            return parts[3]
+        return "attachment"
+    elif name in _DB_ENDPOINTS or name.startswith('_'):
+        return name
+    elif len(parts) == 2:
+        return "doc"
+    return "attachment"
+
+
+class RequestInfo(object):
+    """ a request sent to CouchDB. Sizes are in bytes and times in
+    seconds. `request_size` is None if the size of a streamed body isn't
+    known, `response_size` is the size of the decoded body. """
+
+    def __init__(self, method, path, params, request_size=None, root=None):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.endpoint = endpoint(path, root)
+        self.request_size = request_size
+        self.response_size = None
+        self.status = None
+        self.start = None
+        self.ttfb = None
+        self.total_time = None
+        self.exception = None
+
+    def __repr__(self):
+        return "<%s %s %s %s>" % (self.__class__.__name__, self.method,
+                self.path, self.status)
+
+
+class RequestHook(object):
+    """ base class of request hooks """
+
+    def pre_request(self, info):
+        """ called before the request is sent """
+
+    def post_request(self, info):
+        """ called once the response is read or the request failed """
+
+
+class Histogram(object):
+    """ latency histogram """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ return a list of (upper bound, count of values lower or equal
+        than it). The last bound is "+Inf". """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class _EndpointStats(object):
+
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.ttfb = Histogram(buckets)
+        self.errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.statuses = {}
+
+    def to_dict(self):
+        return {
+                "count": self.latency.count,
+                "errors": self.errors,
+                "sum": self.latency.sum,
+                "ttfb_sum": self.ttfb.sum,
+                "request_bytes": self.request_bytes,
+                "response_bytes": self.response_bytes,
+                "statuses": dict(self.statuses),
+                "buckets": self.latency.cumulative()
+        }
+
+
+class RequestStats(RequestHook):
+    """ hook keeping, for each method and endpoint, histograms of the
+    total time and time to first byte of requests, the number of errors
+    and the number of bytes sent and received. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="couchdbkit"):
+        """ constructor for RequestStats
+
+        @param buckets: list of upper bounds of the histogram buckets,
+        in seconds
+        @param prefix: str, prefix of the Prometheus metric names
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def post_request(self, info):
+        key = (info.method, info.endpoint)
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = _EndpointStats(self.buckets)
+
+            stats.latency.observe(info.total_time)
+            if info.ttfb is not None:
+                stats.ttfb.observe(info.ttfb)
+            if info.exception is not None:
+                stats.errors += 1
+            if info.status is not None:
+                stats.statuses[info.status] = \
+                        stats.statuses.get(info.status, 0) + 1
+            stats.request_bytes += info.request_size or 0
+            stats.response_bytes += info.response_size or 0
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def stats(self):
+        """ return a dict of counters by "METHOD endpoint" """
+        with self._lock:
+            return dict(("%s %s" % key, stats.to_dict()) for key, stats in
+                    self._endpoints.items())
+
+    def prometheus(self):
+        """ return the counters in the Prometheus text format """
+        prefix = self.prefix
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = []
+            for name, attr, doc in (
+                    ("request_duration_seconds", "latency",
+                        "Total time of CouchDB requests"),
+                    ("request_ttfb_seconds", "ttfb",
+                        "Time to first byte of CouchDB requests")):
+                lines.append("# HELP %s_%s %s." % (prefix, name, doc))
+                lines.append("# TYPE %s_%s histogram" % (prefix, name))
+                for (method, ep), stats in endpoints:
+                    histogram = getattr(stats, attr)
+                    labels = 'method="%s",endpoint="%s"' % (method, ep)
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_%s_bucket{%s,le="%s"} %d' % (prefix,
+                            name, labels, bound, count))
+                    lines.append("%s_%s_sum{%s} %r" % (prefix, name, labels,
+                        histogram.sum))
+                    lines.append("%s_%s_count{%s} %d" % (prefix, name, labels,
+                        histogram.count))
+
+            for name, attr, doc in (
+                    ("request_errors_total", "errors",
+                        "Number of failed CouchDB requests"),
+                    ("request_bytes_total", "request_bytes",
+                        "Bytes sent to CouchDB"),
+                    ("response_bytes_total", "response_bytes",
+                        "Bytes received from CouchDB")):
+                lines.append("# HELP %s_%s %s." % (prefix, name, doc))
+                lines.append("# TYPE %s_%s counter" % (prefix, name))
+                for (method, ep), stats in endpoints:
+                    lines.append('%s_%s{method="%s",endpoint="%s"} %d' % (
+                        prefix, name, method, ep, getattr(stats, attr)))
+        return "\n".join(lines) + "\n"
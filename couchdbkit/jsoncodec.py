@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+JSON codecs used to encode requests and decode responses. A codec wraps
+a JSON library and encodes straight to UTF-8 bytes, so request bodies
+aren't copied again before being sent, and decodes strings, unicode,
+`bytearray`, `buffer` or `memoryview` objects.
+
+Codecs for `ujson`, `simplejson` and `json` are registered. The fastest
+available one is used by default. It can be changed globally or for one
+server:
+
+    >>> import couchdbkit
+    >>> couchdbkit.set_json_codec("simplejson")
+    >>> server = couchdbkit.Server(json_codec="json")
+
+Other libraries can be used by registering a codec, any object with
+`dumps` and `loads` methods:
+
+    >>> couchdbkit.register_json_codec("mycodec", MyCodec())
+
+"""
+
+import threading
+
+
+class JsonCodec(object):
+    """ codec using the stdlib `json` module API. `module` is imported
+    lazily """
+
+    module_name = "json"
+    dumps_options = {"separators": (',', ':')}
+
+    def __init__(self):
+        self.name = self.module_name
+        self.module = __import__(self.module_name, {}, {}, [], 0)
+
+    def dumps(self, obj):
+        """ encode `obj` to UTF-8 bytes """
+        data = self.module.dumps(obj, **self.dumps_options)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+
+    def loads(self, data):
+        """ decode JSON from a string, unicode or a buffer object """
+        if not isinstance(data, basestring):
+            data = to_bytes(data)
+        return self.module.loads(data)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+class SimpleJsonCodec(JsonCodec):
+    module_name = "simplejson"
+
+
+class UJsonCodec(JsonCodec):
+    module_name = "ujson"
+    dumps_options = {"ensure_ascii": False, "escape_forward_slashes": False}
+
+    def __init__(self):
+        JsonCodec.__init__(self)
+        try:
+            self.module.dumps("", **self.dumps_options)
+        except TypeError:
+            # old ujson versions don't support all options
+            self.dumps_options = {"ensure_ascii": False}
+
+
+def to_bytes(data):
+    """ return the bytes of a buffer object """
+    if hasattr(data, 'tobytes'):
+        # memoryview
+        return data.tobytes()
+    return str(data)
+
+
+_lock = threading.Lock()
+_default = None
+_codecs = {}
+
+# bundled codecs by order of preference
+JSON_CODECS = [
+    ("ujson", UJsonCodec),
+    ("simplejson", SimpleJsonCodec),
+    ("json", JsonCodec)
+]
+
+def register_json_codec(name, codec):
+    """ register `codec`, a codec instance or a callable returning one,
+    as `name` """
+    with _lock:
+        _codecs[name] = codec
+
+
+for _name, _codec_class in JSON_CODECS:
+    register_json_codec(_name, _codec_class)
+
+
+def get_json_codec(codec=None):
+    """ return a codec instance. `codec` can be the name of a registered
+    codec or a codec instance. The default codec is returned if it's
+    None. """
+    if codec is None:
+        return _default or set_json_codec(None)
+    elif hasattr(codec, "dumps") and hasattr(codec, "loads"):
+        return codec
+
+    with _lock:
+        try:
+            codec_obj = _codecs[codec]
+        except KeyError:
+            raise ValueError("unknown json codec: %r" % codec)
+
+        if isinstance(codec_obj, type) or not hasattr(codec_obj, "loads"):
+            # create the codec on first use
+            codec_obj = _codecs[codec] = codec_obj()
+    return codec_obj
+
+
+def set_json_codec(codec):
+    """ set the default codec, a name or a codec instance. If `codec` is
+    None the first available bundled codec is used. Return the codec
+    instance. """
+    global _default
+
+    if codec is not None:
+        _default = get_json_codec(codec)
+        return _default
+
+    for name, _ in JSON_CODECS:
+        try:
+            _default = get_json_codec(name)
+        except ImportError:
+            continue
+        return _default
+    raise ImportError("no JSON library available")
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Coalescing of concurrent document reads. A `DocLoader` collects the
+`open_doc` calls made by threads or greenlets during a short window and
+fetches all the documents with one `_all_docs?include_docs=true` POST.
+Duplicate ids are fetched once. Each caller gets its own copy of the
+document or a `ResourceNotFound` error.
+
+Example:
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.loader import DocLoader
+    >>> server = Server()
+    >>> db = server.get_db('couchdbkit_test', loader=DocLoader(window=0.005))
+    >>> db.open_doc('doc1') # batched with concurrent reads
+
+Use `green=True` with gevent if the threading module isn't patched, like
+with `couchdbkit.consumer.cgevent` which only patches sockets.
+"""
+
+import threading
+
+from .cache import json_copy
+from .exceptions import ResourceNotFound
+
+DEFAULT_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 100
+
+
+class _Batch(object):
+
+    def __init__(self, event_class):
+        self.keys = []
+        self.results = None
+        self.error = None
+        self.full = event_class()
+        self.done = event_class()
+
+    def add(self, docid):
+        if docid not in self.keys:
+            self.keys.append(docid)
+
+    def fetch(self, db):
+        try:
+            rows = db.raw_view('_all_docs', {"keys": self.keys,
+                "include_docs": True}).json_body.get('rows', [])
+            self.results = dict((row['key'], row) for row in rows)
+        except Exception, e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def result(self, docid):
+        if self.error is not None:
+            raise self.error
+
+        row = self.results.get(docid)
+        if row is None or row.get('error') is not None:
+            raise ResourceNotFound("missing", http_code=404)
+        elif row.get('value', {}).get('deleted') or row.get('doc') is None:
+            raise ResourceNotFound("deleted", http_code=404)
+        return json_copy(row['doc'])
+
+
+class DocLoader(object):
+    """ Batch `open_doc` calls. The first call of a batch waits `window`
+    seconds, or until `max_batch` ids are collected, then fetches the
+    documents for all the calls of the batch. """
+
+    def __init__(self, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH,
+            green=False):
+        """ constructor for DocLoader
+
+        @param window: float, number of seconds to wait for other calls
+        @param max_batch: int, max number of ids fetched in one request
+        @param green: boolean, use gevent primitives to wait
+        """
+        self.window = window
+        self.max_batch = max_batch
+        if green:
+            from gevent.event import Event
+            self._event_class = Event
+        else:
+            self._event_class = threading.Event
+        self._lock = threading.Lock()
+        self._batches = {}
+        self.calls = 0
+        self.batches = 0
+
+    def load(self, db, docid):
+        """ return the document `docid` of `db` """
+        leader = False
+        with self._lock:
+            self.calls += 1
+            batch = self._batches.get(db.uri)
+            if batch is None:
+                batch = self._batches[db.uri] = _Batch(self._event_class)
+                leader = True
+            batch.add(docid)
+            if len(batch.keys) >= self.max_batch:
+                # next calls start a new batch
+                del self._batches[db.uri]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batches.get(db.uri) is batch:
+                    del self._batches[db.uri]
+                self.batches += 1
+            batch.fetch(db)
+        else:
+            batch.done.wait()
+        return batch.result(docid)
+
+    def stats(self):
+        """ return the number of calls and of requests made """
+        with self._lock:
+            return {"calls": self.calls, "batches": self.batches}
@@ -0,0 +1,1475 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+In-process CouchDB backend for tests and benchmarks. A `MemoryResource`
+answers requests from memory instead of sending them over HTTP, so a
+`Server` using it works without a CouchDB server:
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.memory import MemoryResource
+    >>> server = Server(resource_instance=MemoryResource())
+    >>> db = server.create_db('mydb')
+    >>> db.save_doc({'_id': 'mydoc', 'type': 'post'})
+
+It implements databases, documents with revisions and conflicts,
+`_local` documents, `_bulk_docs`, `_all_docs`, `_changes`, attachments,
+`COPY`, `_revs_diff`, local replication and views. Views run Python
+map/reduce functions, either from design documents with
+`"language": "python"` (functions are written like for the couchpy
+view server) or registered for a design document written in another
+language:
+
+    >>> def by_type(doc):
+    ...     yield doc['type'], None
+    >>> backend = MemoryBackend()
+    >>> backend.add_view('blog/by_type', by_type, '_count')
+    >>> server = Server(resource_instance=MemoryResource(backend=backend))
+
+The builtin `_sum`, `_count` and `_stats` reduce functions are
+supported. Show, list and update functions, validation functions and
+authentication aren't, and `_changes` feeds return at once: continuous
+and longpoll feeds don't wait for changes.
+
+Resources created from the same `MemoryResource` share its backend.
+Databases of a backend are kept until it's garbage collected.
+"""
+
+import ast
+import base64
+from cStringIO import StringIO
+import hashlib
+import httplib
+import threading
+import urllib
+import urlparse
+import uuid
+import zlib
+
+from http_parser.util import IOrderedDict
+from restkit.errors import ResourceNotFound, Unauthorized, RequestFailed, \
+ResourceGone
+
+from .jsoncodec import get_json_codec
+from .multipart import MultipartReader, MultipartWriter, parse_boundary
+from .resource import CouchdbResource, CouchDBResponse
+
+# document members reserved by CouchDB
+SPECIAL_MEMBERS = ('_id', '_rev', '_attachments', '_deleted', '_revisions',
+        '_revs_info', '_conflicts', '_deleted_conflicts', '_local_seq')
+
+
+class HTTPError(Exception):
+    """ error returned as an HTTP response by the backend """
+
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+def not_found(reason="missing"):
+    return HTTPError(404, "not_found", reason)
+
+
+def conflict():
+    return HTTPError(409, "conflict", "Document update conflict.")
+
+
+def bad_request(reason):
+    return HTTPError(400, "bad_request", reason)
+
+
+def collation_key(value):
+    """ return a key sorting JSON values like CouchDB views: null,
+    false, true, numbers, strings, arrays then objects """
+    if value is None:
+        return (0, )
+    elif value is False:
+        return (1, )
+    elif value is True:
+        return (2, )
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        # lower case before upper case, like ICU
+        return (4, value.lower(), value.swapcase())
+    elif isinstance(value, (list, tuple)):
+        return (5, [collation_key(item) for item in value])
+    elif isinstance(value, dict):
+        return (6, [(collation_key(k), collation_key(v)) for k, v in
+            value.iteritems()])
+    raise TypeError("%r isn't a JSON value" % value)
+
+
+def compile_function(source):
+    """ return the function defined by the Python `source` of a view
+    function: the last function defined or a lambda expression """
+    if callable(source):
+        return source
+    try:
+        tree = ast.parse(source.strip())
+    except SyntaxError, e:
+        raise HTTPError(500, "compilation_error", str(e))
+
+    namespace = {}
+    if len(tree.body) == 1 and isinstance(tree.body[0], ast.Expr):
+        return eval(source.strip(), namespace)
+
+    exec compile(tree, "<view function>", "exec") in namespace
+    names = [node.name for node in tree.body
+            if isinstance(node, ast.FunctionDef)]
+    if not names:
+        raise HTTPError(500, "compilation_error",
+                "no function defined in %r" % source)
+    return namespace[names[-1]]
+
+
+def _sum(keys, values, rereduce=False):
+    if values and isinstance(values[0], list):
+        return [sum(items) for items in zip(*values)]
+    return sum(values)
+
+
+def _count(keys, values, rereduce=False):
+    if rereduce:
+        return sum(values)
+    return len(values)
+
+
+def _stats(keys, values, rereduce=False):
+    if rereduce:
+        return {
+            "sum": sum(value['sum'] for value in values),
+            "count": sum(value['count'] for value in values),
+            "min": min(value['min'] for value in values),
+            "max": max(value['max'] for value in values),
+            "sumsqr": sum(value['sumsqr'] for value in values)
+        }
+    return {
+        "sum": sum(values),
+        "count": len(values),
+        "min": min(values),
+        "max": max(values),
+        "sumsqr": sum(value * value for value in values)
+    }
+
+BUILTIN_REDUCES = {"_sum": _sum, "_count": _count, "_stats": _stats}
+
+
+def _json_param(params, name, default=None):
+    if name not in params:
+        return default
+    value = params[name]
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return get_json_codec("json").loads(value)
+    except ValueError:
+        raise HTTPError(400, "query_parse_error",
+                "Invalid value for %s: %r" % (name, value))
+
+
+def _bool_param(params, name, default=False):
+    value = params.get(name)
+    if value is None:
+        return default
+    return value in (True, "true")
+
+
+def _int_param(params, name, default=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPError(400, "query_parse_error",
+                "Invalid value for %s: %r" % (name, value))
+
+
+class _Revision(object):
+    """ a leaf of the revision tree of a document """
+
+    def __init__(self, rev, body, deleted, history, attachments):
+        self.rev = rev
+        self.pos = int(rev.split('-', 1)[0])
+        self.body = body
+        self.deleted = deleted
+        # revisions from this one to the first one
+        self.history = history
+        self.attachments = attachments
+
+
+class _Document(object):
+
+    def __init__(self, docid):
+        self.id = docid
+        self.leaves = {}
+        # bodies of all revisions, for GET with a rev param
+        self.revisions = {}
+        self.seq = 0
+
+    def winner(self):
+        return max(self.leaves.itervalues(), key=lambda leaf: (
+            not leaf.deleted, leaf.pos, leaf.rev))
+
+    @property
+    def deleted(self):
+        return self.winner().deleted
+
+    def known(self, rev):
+        for leaf in self.leaves.itervalues():
+            if rev in leaf.history:
+                return True
+        return False
+
+    def add(self, revision, replace=None):
+        if replace is not None:
+            self.leaves.pop(replace, None)
+        self.leaves[revision.rev] = revision
+        self.revisions[revision.rev] = revision
+
+
+class _Database(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.local = {}
+        self.seq = 0
+        self.security = {}
+        self.revs_limit = 1000
+        self.instance = uuid.uuid4().hex
+        self.views = {}
+
+    def next_seq(self, doc):
+        self.seq += 1
+        doc.seq = self.seq
+
+    def info(self):
+        docs = self.docs.values()
+        deleted = len([doc for doc in docs if doc.deleted])
+        return {
+            "db_name": self.name,
+            "doc_count": len(docs) - deleted,
+            "doc_del_count": deleted,
+            "update_seq": self.seq,
+            "committed_update_seq": self.seq,
+            "purge_seq": 0,
+            "compact_running": False,
+            "disk_size": 0,
+            "data_size": 0,
+            "instance_start_time": "0",
+            "disk_format_version": 6
+        }
+
+
+class MemoryBackend(object):
+    """ in memory CouchDB server, shared by the resources created from
+    a `MemoryResource` """
+
+    def __init__(self, json_codec=None):
+        """ constructor for MemoryBackend
+
+        @param json_codec: name of a registered JSON codec or codec
+        instance used to decode requests and encode responses.
+        """
+        self.codec = get_json_codec(json_codec)
+        self.databases = {}
+        self.attachments = {}
+        self._views = {}
+        self._lock = threading.RLock()
+
+    def add_view(self, path, map_fun, reduce_fun=None):
+        """ register a Python view for all the databases. It's used in
+        place of the view of the design document.
+
+        @param path: str, "designname/viewname"
+        @param map_fun: callable or Python source of a function taking a
+        document and returning or yielding (key, value) tuples
+        @param reduce_fun: callable, Python source of a function taking
+        keys, values and rereduce, or "_sum", "_count" or "_stats"
+        """
+        self._views[path] = (map_fun, reduce_fun)
+
+    def handle(self, method, path, params, body, headers):
+        """ answer a request
+
+        @param method: str, HTTP method
+        @param path: str, path of the request
+        @param params: dict, query parameters, JSON encoded like
+        `couchdbkit.resource.encode_params` does.
+        @param body: str, body of the request
+        @param headers: dict, headers of the request
+
+        @return: tuple (status, headers, body)
+        """
+        headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+        parts = [urllib.unquote(part).decode('utf-8') for part in
+                path.split('/') if part]
+        if len(parts) > 1:
+            # "_design%2Fname" is the same as "_design/name"
+            for prefix in (u'_design/', u'_local/'):
+                if parts[1].startswith(prefix):
+                    parts[1:2] = parts[1].split('/', 1)
+        request = _Request(method, parts, params or {}, body, headers)
+        try:
+            with self._lock:
+                result = self._route(request)
+        except HTTPError, e:
+            return self._json(e.status, {"error": e.error,
+                "reason": e.reason})
+
+        if len(result) == 2:
+            return self._json(*result)
+        return result
+
+    def _json(self, status, obj, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "application/json")
+        return status, headers, self.codec.dumps(obj)
+
+    def _decode(self, request):
+        if not request.body:
+            raise bad_request("Request body is empty")
+        try:
+            return self.codec.loads(request.body)
+        except ValueError:
+            raise bad_request("invalid UTF-8 JSON")
+
+    def _route(self, request):
+        parts = request.parts
+        method = request.method
+        if not parts:
+            return 200, {"couchdb": "Welcome", "version": "1.6.1",
+                    "vendor": {"name": "couchdbkit memory backend"}}
+
+        name = parts[0]
+        if name == '_all_dbs':
+            return 200, sorted(self.databases)
+        elif name == '_uuids':
+            count = _int_param(request.params, 'count', 1)
+            return 200, {"uuids": [uuid.uuid4().hex for i in range(count)]}
+        elif name == '_active_tasks':
+            return 200, []
+        elif name == '_replicate':
+            return self._replicate(self._decode(request))
+        elif name.startswith('_') and name not in ('_users',
+                '_replicator'):
+            raise not_found()
+
+        if len(parts) == 1:
+            return self._database(request, name)
+
+        db = self.databases.get(name)
+        if db is None:
+            raise not_found("no_db_file")
+
+        action = parts[1]
+        if action == '_all_docs':
+            return self._all_docs(request, db)
+        elif action == '_bulk_docs':
+            return self._bulk_docs(request, db)
+        elif action == '_changes':
+            return self._changes(request, db)
+        elif action == '_temp_view':
+            spec = self._decode(request)
+            return self._view(request, db, None, spec)
+        elif action in ('_compact', '_view_cleanup', '_ensure_full_commit'):
+            if method != 'POST':
+                raise HTTPError(405, "method_not_allowed",
+                        "Only POST allowed")
+            return 202, {"ok": True, "instance_start_time": "0"}
+        elif action == '_security':
+            if method == 'PUT':
+                db.security = self._decode(request)
+                return 200, {"ok": True}
+            return 200, db.security
+        elif action == '_revs_limit':
+            if method == 'PUT':
+                db.revs_limit = self._decode(request)
+                return 200, {"ok": True}
+            return 200, db.revs_limit
+        elif action in ('_revs_diff', '_missing_revs'):
+            return self._revs_diff(request, db, action)
+        elif action == '_local':
+            if len(parts) != 3:
+                raise not_found()
+            return self._local_doc(request, db, u"_local/" + parts[2])
+        elif action == '_design':
+            if len(parts) < 3:
+                raise not_found()
+            docid = u"_design/" + parts[2]
+            rest = parts[3:]
+            if rest and rest[0] == '_view' and len(rest) == 2:
+                return self._design_view(request, db, parts[2], rest[1])
+            elif rest and rest[0] == '_info':
+                return 200, {"name": parts[2], "view_index": {
+                    "signature": hashlib.md5(docid).hexdigest(),
+                    "update_seq": db.seq, "updater_running": False}}
+            elif rest and rest[0] in ('_show', '_list', '_update',
+                    '_rewrite'):
+                raise HTTPError(500, "not_implemented", "%s functions "
+                        "aren't supported by the memory backend" % rest[0])
+        elif action.startswith('_'):
+            raise HTTPError(400, "bad_request", "Only reserved document "
+                    "ids may start with underscore.")
+        else:
+            docid = action
+            rest = parts[2:]
+
+        if rest:
+            return self._attachment(request, db, docid, '/'.join(rest))
+        return self._document(request, db, docid)
+
+    # databases
+
+    def _database(self, request, name):
+        method = request.method
+        db = self.databases.get(name)
+        if method == 'PUT':
+            if db is not None:
+                raise HTTPError(412, "file_exists", "The database could not "
+                        "be created, the file already exists.")
+            self.databases[name] = _Database(name)
+            return 201, {"ok": True}
+        elif db is None:
+            raise not_found("no_db_file")
+        elif method == 'DELETE':
+            del self.databases[name]
+            return 200, {"ok": True}
+        elif method == 'POST':
+            doc = self._decode(request)
+            if not isinstance(doc, dict):
+                raise bad_request("Document must be a JSON object")
+            if '_id' not in doc:
+                doc['_id'] = uuid.uuid4().hex
+            return self._put(request, db, doc['_id'], doc)
+        return 200, db.info()
+
+    # documents
+
+    def _document(self, request, db, docid):
+        method = request.method
+        if method in ('GET', 'HEAD'):
+            return self._get(request, db, docid)
+        elif method == 'PUT':
+            doc = self._read_doc(request)
+            return self._put(request, db, docid, doc)
+        elif method == 'DELETE':
+            rev = request.params.get('rev') or \
+                    request.headers.get('if-match', '').strip('"')
+            doc = {"_id": docid, "_deleted": True}
+            if rev:
+                doc['_rev'] = rev
+            status, result = self._put(request, db, docid, doc)
+            return 200, result
+        elif method == 'COPY':
+            return self._copy(request, db, docid)
+        raise HTTPError(405, "method_not_allowed",
+                "Only DELETE,GET,HEAD,PUT,COPY allowed")
+
+    def _read_doc(self, request):
+        content_type = request.headers.get('content-type', '')
+        if not content_type.startswith('multipart/related'):
+            doc = self._decode(request)
+            if not isinstance(doc, dict):
+                raise bad_request("Document must be a JSON object")
+            return doc
+
+        boundary = parse_boundary(content_type)
+        reader = MultipartReader(StringIO(request.body), boundary,
+                codec=self.codec)
+        doc = reader.doc
+        for att in (doc.get('_attachments') or {}).itervalues():
+            if 'data' in att:
+                att['data'] = _Raw(att['data'].read())
+        return doc
+
+    def _get(self, request, db, docid):
+        params = request.params
+        entry = db.docs.get(docid)
+        if entry is None:
+            raise not_found()
+
+        rev = params.get('rev')
+        if rev is not None:
+            revision = entry.revisions.get(rev)
+            if revision is None:
+                raise not_found()
+        else:
+            revision = entry.winner()
+            if revision.deleted:
+                raise not_found("deleted")
+
+            etag = '"%s"' % revision.rev
+            if request.headers.get('if-none-match') == etag:
+                return 304, {"ETag": etag}, ""
+
+        if 'open_revs' in params:
+            return self._open_revs(request, db, entry)
+
+        attachments = _bool_param(params, 'attachments')
+        multipart = attachments and 'multipart/related' in \
+                request.headers.get('accept', '') and revision.attachments
+        doc = self._render(db, entry, revision, params,
+                raw_attachments=multipart)
+        headers = {"ETag": '"%s"' % revision.rev}
+        if multipart:
+            writer = MultipartWriter(doc, codec=self.codec)
+            headers.update(writer.headers())
+            return 200, headers, writer.read()
+        return self._json(200, doc, headers)
+
+    def _open_revs(self, request, db, entry):
+        open_revs = request.params['open_revs']
+        if open_revs == 'all':
+            revs = sorted(entry.leaves)
+        else:
+            revs = _json_param(request.params, 'open_revs')
+
+        results = []
+        for rev in revs:
+            revision = entry.revisions.get(rev)
+            if revision is None:
+                results.append({"missing": rev})
+            else:
+                results.append({"ok": self._render(db, entry, revision,
+                    request.params)})
+        return 200, results
+
+    def _render(self, db, entry, revision, params, raw_attachments=False):
+        doc = {"_id": entry.id, "_rev": revision.rev}
+        doc.update(revision.body)
+        if revision.deleted:
+            doc['_deleted'] = True
+
+        if revision.attachments:
+            inline = _bool_param(params, 'attachments')
+            attachments = {}
+            for name, att in revision.attachments.iteritems():
+                att = dict(att)
+                if inline:
+                    data = self.attachments[att['digest']]
+                    if not raw_attachments:
+                        data = base64.b64encode(data)
+                    att['data'] = data
+                else:
+                    att['stub'] = True
+                attachments[name] = att
+            doc['_attachments'] = attachments
+
+        if _bool_param(params, 'revs'):
+            doc['_revisions'] = {"start": revision.pos, "ids": [
+                rev.split('-', 1)[1] for rev in revision.history]}
+        if _bool_param(params, 'revs_info'):
+            doc['_revs_info'] = [{"rev": rev, "status": "available"
+                if rev in entry.revisions else "missing"}
+                for rev in revision.history]
+        if _bool_param(params, 'conflicts') or _bool_param(params, 'meta'):
+            conflicts = self._conflicts(entry, revision, False)
+            if conflicts:
+                doc['_conflicts'] = conflicts
+        if _bool_param(params, 'deleted_conflicts') or \
+                _bool_param(params, 'meta'):
+            conflicts = self._conflicts(entry, revision, True)
+            if conflicts:
+                doc['_deleted_conflicts'] = conflicts
+        if _bool_param(params, 'local_seq'):
+            doc['_local_seq'] = entry.seq
+        return doc
+
+    def _conflicts(self, entry, revision, deleted):
+        leaves = [leaf for leaf in entry.leaves.itervalues() if
+                leaf is not revision and leaf.deleted == deleted]
+        leaves.sort(key=lambda leaf: (leaf.pos, leaf.rev), reverse=True)
+        return [leaf.rev for leaf in leaves]
+
+    def _put(self, request, db, docid, doc):
+        params = request.params
+        doc['_id'] = docid
+        if 'rev' in params and '_rev' not in doc:
+            doc['_rev'] = params['rev']
+
+        if params.get('new_edits') == 'false':
+            self._replicated(db, doc)
+            return 201, {"ok": True, "id": docid, "rev": doc['_rev']}
+
+        rev = self._update(db, doc)
+        if params.get('batch') == 'ok':
+            return 202, {"ok": True, "id": docid}
+        return 201, {"ok": True, "id": docid, "rev": rev}
+
+    def _update(self, db, doc, all_or_nothing=False):
+        """ save `doc` as a new revision, return its rev """
+        docid = doc['_id']
+        rev = doc.get('_rev')
+        entry = db.docs.get(docid)
+
+        parent = None
+        history = []
+        if entry is not None:
+            if rev:
+                parent = entry.leaves.get(rev)
+                if parent is None:
+                    if not all_or_nothing:
+                        raise conflict()
+                    # create a conflict
+                    history = [rev]
+            else:
+                winner = entry.winner()
+                if winner.deleted:
+                    parent = winner
+                elif not all_or_nothing:
+                    raise conflict()
+        elif rev:
+            if not all_or_nothing:
+                raise conflict()
+            history = [rev]
+
+        if parent is not None:
+            history = parent.history
+        pos = int(history[0].split('-', 1)[0]) + 1 if history else 1
+
+        body, attachments = self._prepare(doc, parent, pos)
+        deleted = bool(doc.get('_deleted'))
+        digests = sorted(att['digest'] for att in attachments.itervalues())
+        new_rev = "%d-%s" % (pos, hashlib.md5("%s%s%s%s" % (history and
+            history[0] or '', self.codec.dumps(body), deleted,
+            digests)).hexdigest())
+        if entry is None:
+            entry = db.docs[docid] = _Document(docid)
+        elif new_rev in entry.leaves:
+            # same edit done again
+            return new_rev
+
+        entry.add(_Revision(new_rev, body, deleted, [new_rev] + history,
+            attachments), replace=parent and parent.rev)
+        db.next_seq(entry)
+        return new_rev
+
+    def _replicated(self, db, doc):
+        """ save a revision created elsewhere """
+        docid = doc['_id']
+        rev = doc.get('_rev')
+        if not rev:
+            raise bad_request("_rev is required with new_edits=false")
+
+        revisions = doc.get('_revisions')
+        if revisions:
+            start = revisions['start']
+            history = ["%d-%s" % (start - i, rev_id) for i, rev_id in
+                    enumerate(revisions['ids'])]
+        else:
+            history = [rev]
+
+        entry = db.docs.get(docid)
+        if entry is None:
+            entry = db.docs[docid] = _Document(docid)
+        elif entry.known(rev):
+            return
+
+        replace = None
+        for leaf in entry.leaves.itervalues():
+            if leaf.rev in history:
+                replace = leaf.rev
+                break
+
+        body, attachments = self._prepare(doc, entry.revisions.get(replace),
+                int(rev.split('-', 1)[0]))
+        entry.add(_Revision(rev, body, bool(doc.get('_deleted')), history,
+            attachments), replace=replace)
+        db.next_seq(entry)
+
+    def _prepare(self, doc, parent, pos):
+        """ return the body and attachments of a new revision of `doc` """
+        body = {}
+        for key, value in doc.iteritems():
+            if not key.startswith('_'):
+                body[key] = value
+            elif key not in SPECIAL_MEMBERS:
+                raise HTTPError(400, "doc_validation",
+                        "Bad special document member: %s" % key)
+
+        attachments = {}
+        for name, att in (doc.get('_attachments') or {}).iteritems():
+            if att.get('stub'):
+                old = None
+                if parent is not None:
+                    old = parent.attachments.get(name)
+                if old is None and att.get('digest') in self.attachments:
+                    old = dict((k, v) for k, v in att.iteritems()
+                            if k != 'stub')
+                if old is None:
+                    raise HTTPError(412, "missing_stub", "Invalid "
+                            "attachment stub in %s for %s" % (doc['_id'],
+                                name))
+                attachments[name] = old
+            elif 'data' in att:
+                data = att['data']
+                if isinstance(data, _Raw):
+                    data = data.data
+                else:
+                    try:
+                        data = base64.b64decode(data)
+                    except TypeError:
+                        raise bad_request("Invalid attachment data for %s"
+                                % name)
+                attachments[name] = self._store_attachment(data,
+                        att.get('content_type'), pos)
+            else:
+                raise bad_request("Invalid attachment %s" % name)
+        return body, attachments
+
+    def _store_attachment(self, data, content_type, revpos):
+        digest = "md5-%s" % base64.b64encode(hashlib.md5(data).digest())
+        self.attachments[digest] = data
+        return {
+            "content_type": content_type or "application/octet-stream",
+            "digest": digest,
+            "length": len(data),
+            "revpos": revpos
+        }
+
+    def _copy(self, request, db, docid):
+        entry = db.docs.get(docid)
+        if entry is None or entry.deleted:
+            raise not_found(entry and "deleted" or "missing")
+        revision = entry.winner()
+        if request.params.get('rev'):
+            revision = entry.revisions.get(request.params['rev'])
+            if revision is None:
+                raise not_found()
+
+        destination = request.headers.get('destination')
+        if not destination:
+            raise bad_request("Destination header is mandatory for COPY.")
+        dest_id, _, query = destination.partition('?')
+        dest_id = urllib.unquote(dest_id).decode('utf-8')
+        dest_rev = urlparse.parse_qs(query).get('rev', [None])[0]
+
+        doc = dict(revision.body)
+        doc['_id'] = dest_id
+        if dest_rev:
+            doc['_rev'] = dest_rev
+        if revision.attachments:
+            doc['_attachments'] = dict((name, dict(att, stub=True))
+                    for name, att in revision.attachments.iteritems())
+        rev = self._update(db, doc)
+        return 201, {"ok": True, "id": dest_id, "rev": rev}
+
+    def _local_doc(self, request, db, docid):
+        method = request.method
+        if method in ('GET', 'HEAD'):
+            doc = db.local.get(docid)
+            if doc is None:
+                raise not_found()
+            return 200, doc
+        elif method in ('PUT', 'DELETE'):
+            current = db.local.get(docid)
+            if method == 'PUT':
+                doc = self._decode(request)
+                rev = doc.get('_rev')
+            else:
+                doc = None
+                rev = request.params.get('rev')
+            if current is not None and rev != current['_rev']:
+                raise conflict()
+
+            pos = int(current['_rev'].split('-')[1]) if current else 0
+            new_rev = "0-%d" % (pos + 1)
+            if doc is None:
+                db.local.pop(docid, None)
+            else:
+                doc.update({"_id": docid, "_rev": new_rev})
+                db.local[docid] = doc
+            return 201, {"ok": True, "id": docid, "rev": new_rev}
+        raise HTTPError(405, "method_not_allowed",
+                "Only DELETE,GET,HEAD,PUT allowed")
+
+    # attachments
+
+    def _attachment(self, request, db, docid, name):
+        method = request.method
+        entry = db.docs.get(docid)
+        rev = request.params.get('rev')
+
+        if method in ('GET', 'HEAD'):
+            if entry is None:
+                raise not_found()
+            revision = entry.winner()
+            if rev:
+                revision = entry.revisions.get(rev)
+            if revision is None or revision.deleted:
+                raise not_found(revision and "deleted" or "missing")
+            att = revision.attachments.get(name)
+            if att is None:
+                raise not_found("Document is missing attachment")
+            headers = {"Content-Type": att['content_type'],
+                    "ETag": '"%s"' % att['digest']}
+            if request.headers.get('if-none-match') == headers['ETag']:
+                return 304, headers, ""
+            return 200, headers, self.attachments[att['digest']]
+        elif method not in ('PUT', 'DELETE'):
+            raise HTTPError(405, "method_not_allowed",
+                    "Only DELETE,GET,HEAD,PUT allowed")
+
+        if entry is not None and not entry.deleted:
+            if not rev:
+                raise conflict()
+            parent = entry.leaves.get(rev)
+            if parent is None:
+                raise conflict()
+            doc = dict(parent.body)
+            attachments = dict((k, dict(v, stub=True)) for k, v in
+                    parent.attachments.iteritems())
+        elif method == 'DELETE':
+            raise not_found()
+        else:
+            doc = {}
+            attachments = {}
+
+        doc.update({"_id": docid})
+        if rev:
+            doc['_rev'] = rev
+        if method == 'PUT':
+            attachments[name] = {"data": _Raw(request.body),
+                    "content_type": request.headers.get('content-type')}
+        elif attachments.pop(name, None) is None:
+            raise not_found("Document is missing attachment")
+        doc['_attachments'] = attachments
+
+        new_rev = self._update(db, doc)
+        status = method == 'PUT' and 201 or 200
+        return status, {"ok": True, "id": docid, "rev": new_rev}
+
+    # bulk operations
+
+    def _bulk_docs(self, request, db):
+        if request.method != 'POST':
+            raise HTTPError(405, "method_not_allowed", "Only POST allowed")
+        payload = self._decode(request)
+        docs = payload.get('docs')
+        if not isinstance(docs, list):
+            raise bad_request("Missing JSON list of 'docs'")
+        new_edits = payload.get('new_edits', True)
+        all_or_nothing = payload.get('all_or_nothing', False)
+
+        results = []
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = uuid.uuid4().hex
+            try:
+                if new_edits:
+                    rev = self._update(db, doc, all_or_nothing)
+                    results.append({"id": doc['_id'], "rev": rev})
+                else:
+                    self._replicated(db, doc)
+            except HTTPError, e:
+                results.append({"id": doc['_id'], "error": e.error,
+                    "reason": e.reason})
+        return 201, results
+
+    def _revs_diff(self, request, db, action):
+        revs = self._decode(request)
+        results = {}
+        for docid, doc_revs in revs.iteritems():
+            entry = db.docs.get(docid)
+            missing = [rev for rev in doc_revs if entry is None or
+                    not entry.known(rev)]
+            if missing:
+                results[docid] = {"missing": missing}
+
+        if action == '_missing_revs':
+            return 200, {"missing_revs": dict((docid, result['missing'])
+                for docid, result in results.iteritems())}
+        return 200, results
+
+    def _replicate(self, options):
+        def database(name):
+            # a full uri of a database of this backend
+            name = urllib.unquote(name.rstrip('/').rsplit('/', 1)[-1])
+            return name
+
+        source = self.databases.get(database(options.get('source', '')))
+        if source is None:
+            raise not_found("Source database not found")
+        target_name = database(options.get('target', ''))
+        target = self.databases.get(target_name)
+        if target is None:
+            if not options.get('create_target'):
+                raise not_found("Target database not found")
+            target = self.databases[target_name] = _Database(target_name)
+
+        doc_ids = options.get('doc_ids')
+        written = 0
+        for docid in sorted(source.docs, key=lambda d: source.docs[d].seq):
+            if doc_ids is not None and docid not in doc_ids:
+                continue
+            entry = source.docs[docid]
+            for leaf in entry.leaves.values():
+                target_entry = target.docs.get(docid)
+                if target_entry is not None and target_entry.known(leaf.rev):
+                    continue
+                doc = dict(leaf.body)
+                doc.update({"_id": docid, "_rev": leaf.rev,
+                    "_revisions": {"start": leaf.pos, "ids": [
+                        rev.split('-', 1)[1] for rev in leaf.history]}})
+                if leaf.deleted:
+                    doc['_deleted'] = True
+                if leaf.attachments:
+                    doc['_attachments'] = dict((name, dict(att, stub=True))
+                            for name, att in leaf.attachments.iteritems())
+                self._replicated(target, doc)
+                written += 1
+
+        return 200, {"ok": True, "session_id": uuid.uuid4().hex,
+                "source_last_seq": source.seq, "docs_written": written,
+                "no_changes": written == 0}
+
+    # _all_docs
+
+    def _all_docs(self, request, db):
+        params = request.params
+        keys = None
+        if request.method == 'POST':
+            keys = self._decode(request).get('keys')
+        elif 'keys' in params:
+            keys = _json_param(params, 'keys')
+
+        etag = '"%s"' % hashlib.md5("%s-%s" % (db.instance,
+            db.seq)).hexdigest()
+        if request.headers.get('if-none-match') == etag:
+            return 304, {"ETag": etag}, ""
+
+        include_docs = _bool_param(params, 'include_docs')
+        live = sorted(docid for docid, entry in db.docs.iteritems()
+                if not entry.deleted)
+        rows = []
+        if keys is not None:
+            for key in keys:
+                entry = db.docs.get(key)
+                if entry is None:
+                    rows.append({"key": key, "error": "not_found"})
+                    continue
+                revision = entry.winner()
+                row = {"id": key, "key": key,
+                        "value": {"rev": revision.rev}}
+                if revision.deleted:
+                    row['value']['deleted'] = True
+                    if include_docs:
+                        row['doc'] = None
+                elif include_docs:
+                    row['doc'] = self._render(db, entry, revision, params)
+                rows.append(row)
+            offset = 0
+        else:
+            ids = live
+            descending = _bool_param(params, 'descending')
+            if descending:
+                ids = ids[::-1]
+            startkey = _json_param(params, 'startkey',
+                    _json_param(params, 'start_key'))
+            endkey = _json_param(params, 'endkey',
+                    _json_param(params, 'end_key'))
+            if 'key' in params:
+                startkey = endkey = _json_param(params, 'key')
+            inclusive_end = _bool_param(params, 'inclusive_end', True)
+
+            def in_range(docid):
+                if startkey is not None:
+                    if (docid < startkey) if not descending else \
+                            (docid > startkey):
+                        return False
+                if endkey is not None:
+                    if descending:
+                        return docid > endkey or (inclusive_end and
+                                docid == endkey)
+                    return docid < endkey or (inclusive_end and
+                            docid == endkey)
+                return True
+
+            selected = [docid for docid in ids if in_range(docid)]
+            offset = selected and ids.index(selected[0]) or 0
+            selected = self._skip_limit(selected, params)
+            if selected:
+                offset = ids.index(selected[0])
+            for docid in selected:
+                entry = db.docs[docid]
+                revision = entry.winner()
+                row = {"id": docid, "key": docid,
+                        "value": {"rev": revision.rev}}
+                if include_docs:
+                    row['doc'] = self._render(db, entry, revision, params)
+                rows.append(row)
+
+        header = {"total_rows": len(live), "offset": offset}
+        if _bool_param(params, 'update_seq'):
+            header['update_seq'] = db.seq
+        return self._rows(header, rows, {"ETag": etag})
+
+    def _skip_limit(self, rows, params):
+        skip = _int_param(params, 'skip', 0)
+        limit = _int_param(params, 'limit')
+        rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def _rows(self, header, rows, headers=None):
+        """ encode view rows one by line, like CouchDB """
+        dumps = self.codec.dumps
+        header = dumps(header)[:-1]
+        if header != '{':
+            header += ','
+        body = '%s"rows":[\r\n%s\r\n]}\n' % (header,
+                ',\r\n'.join(dumps(row) for row in rows))
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/json"
+        return 200, headers, body
+
+    # _changes
+
+    def _changes(self, request, db):
+        params = request.params
+        payload = {}
+        if request.method == 'POST' and request.body:
+            payload = self._decode(request)
+
+        since = params.get('since', 0)
+        if since == 'now':
+            since = db.seq
+        else:
+            try:
+                since = int(since)
+            except ValueError:
+                raise bad_request("invalid since: %r" % since)
+
+        doc_filter = self._changes_filter(request, db, payload)
+        include_docs = _bool_param(params, 'include_docs')
+        all_docs = params.get('style') == 'all_docs'
+        limit = _int_param(params, 'limit')
+        entries = sorted((entry for entry in db.docs.itervalues()
+            if entry.seq > since), key=lambda entry: entry.seq,
+            reverse=_bool_param(params, 'descending'))
+
+        changes = []
+        for entry in entries:
+            revision = entry.winner()
+            if doc_filter is not None and not doc_filter(entry, revision):
+                continue
+            if all_docs:
+                revs = sorted(entry.leaves, reverse=True)
+            else:
+                revs = [revision.rev]
+            change = {"seq": entry.seq, "id": entry.id,
+                    "changes": [{"rev": rev} for rev in revs]}
+            if revision.deleted:
+                change['deleted'] = True
+            if include_docs:
+                change['doc'] = self._render(db, entry, revision, params)
+            changes.append(change)
+            if limit is not None and len(changes) >= limit:
+                break
+
+        last_seq = changes and max(change['seq'] for change in changes) \
+                or max(since, 0)
+        if not changes and limit is None:
+            last_seq = db.seq
+
+        dumps = self.codec.dumps
+        if params.get('feed') == 'continuous':
+            body = "".join("%s\n" % dumps(change) for change in changes)
+            body += "%s\n" % dumps({"last_seq": last_seq})
+        else:
+            body = '{"results":[\n%s\n],\n"last_seq":%s}\n' % (
+                    ",\n".join(dumps(change) for change in changes),
+                    dumps(last_seq))
+        return 200, {"Content-Type": "application/json"}, body
+
+    def _changes_filter(self, request, db, payload):
+        params = request.params
+        name = params.get('filter')
+        if not name:
+            return None
+
+        if name == '_doc_ids':
+            doc_ids = payload.get('doc_ids') or _json_param(params,
+                    'doc_ids', [])
+            doc_ids = set(doc_ids)
+            return lambda entry, revision: entry.id in doc_ids
+        elif name == '_design':
+            return lambda entry, revision: entry.id.startswith('_design/')
+        elif name == '_view':
+            path = params.get('view', '')
+            if '/' not in path:
+                raise bad_request("filter parameter must be of the form "
+                        "`designname/viewname`")
+            design, view = path.split('/', 1)
+            map_fun = self._view_functions(db, design, view)[0]
+
+            def view_filter(entry, revision):
+                if revision.deleted:
+                    return False
+                doc = self._map_doc(db, entry, revision)
+                return bool(list(map_fun(doc) or []))
+            return view_filter
+
+        if '/' not in name:
+            raise bad_request("filter parameter must be of the form "
+                    "`designname/filtername`")
+        design, filter_name = name.split('/', 1)
+        ddoc = self._design_doc(db, design)
+        source = (ddoc.body.get('filters') or {}).get(filter_name)
+        if source is None:
+            raise not_found("missing json key: %s" % filter_name)
+        if ddoc.body.get('language', 'javascript') != 'python':
+            raise HTTPError(500, "unknown_query_language",
+                    ddoc.body.get('language', 'javascript'))
+        fun = compile_function(source)
+        req = {"query": dict(params)}
+
+        def design_filter(entry, revision):
+            return fun(self._map_doc(db, entry, revision), req)
+        return design_filter
+
+    # views
+
+    def _design_doc(self, db, design):
+        entry = db.docs.get(u"_design/" + design)
+        if entry is None or entry.deleted:
+            raise not_found("missing")
+        return entry.winner()
+
+    def _view_functions(self, db, design, view):
+        path = "%s/%s" % (design, view)
+        if path in self._views:
+            map_fun, reduce_fun = self._views[path]
+        else:
+            ddoc = self._design_doc(db, design)
+            spec = (ddoc.body.get('views') or {}).get(view)
+            if spec is None:
+                raise not_found("missing_named_view")
+            language = ddoc.body.get('language', 'javascript')
+            if language != 'python':
+                raise HTTPError(500, "unknown_query_language", "%s, "
+                        "register Python functions for %s with "
+                        "MemoryBackend.add_view" % (language, path))
+            map_fun, reduce_fun = spec.get('map'), spec.get('reduce')
+        return self._compile_view(map_fun, reduce_fun)
+
+    def _compile_view(self, map_fun, reduce_fun):
+        if map_fun is None:
+            raise HTTPError(500, "compilation_error", "missing map function")
+        map_fun = compile_function(map_fun)
+        if reduce_fun is not None:
+            if reduce_fun in BUILTIN_REDUCES:
+                reduce_fun = BUILTIN_REDUCES[reduce_fun]
+            else:
+                reduce_fun = compile_function(reduce_fun)
+        return map_fun, reduce_fun
+
+    def _map_doc(self, db, entry, revision):
+        # map functions get their own copy of the document
+        doc = self._render(db, entry, revision, {})
+        return self.codec.loads(self.codec.dumps(doc))
+
+    def _index(self, db, map_fun, design=True):
+        """ return the sorted rows of the view: list of (collation key,
+        docid, key, value) """
+        rows = []
+        for docid, entry in db.docs.iteritems():
+            revision = entry.winner()
+            if revision.deleted or (not design and
+                    docid.startswith('_design/')):
+                continue
+            doc = self._map_doc(db, entry, revision)
+            try:
+                emitted = map_fun(doc)
+            except Exception:
+                # like CouchDB, documents raising errors are skipped
+                continue
+            for key, value in emitted or []:
+                # keys and values are stored as JSON
+                key = self.codec.loads(self.codec.dumps(key))
+                value = self.codec.loads(self.codec.dumps(value))
+                rows.append((collation_key(key), docid, key, value))
+        rows.sort(key=lambda row: (row[0], row[1]))
+        return rows
+
+    def _design_view(self, request, db, design, view):
+        map_fun, reduce_fun = self._view_functions(db, design, view)
+        etag = '"%s"' % hashlib.md5("%s-%s-%s/%s" % (db.instance, db.seq,
+            design, view)).hexdigest()
+        if request.headers.get('if-none-match') == etag:
+            return 304, {"ETag": etag}, ""
+
+        cache_key = (design, view)
+        cached = db.views.get(cache_key)
+        if cached is not None and cached[0] == db.seq and \
+                cached[1] is map_fun:
+            index = cached[2]
+        else:
+            ddoc = db.docs.get(u"_design/" + design)
+            include_design = False
+            if ddoc is not None and not ddoc.deleted:
+                include_design = (ddoc.winner().body.get('options') or
+                        {}).get('include_design', False)
+            index = self._index(db, map_fun, include_design)
+            if "%s/%s" % (design, view) in self._views:
+                # registered functions aren't compiled again, the index
+                # can be kept
+                db.views[cache_key] = (db.seq, map_fun, index)
+        return self._query(request, db, index, reduce_fun, {"ETag": etag})
+
+    def _view(self, request, db, design, spec):
+        """ temporary view """
+        if spec.get('language', 'javascript') != 'python':
+            raise HTTPError(500, "unknown_query_language",
+                    spec.get('language', 'javascript'))
+        map_fun, reduce_fun = self._compile_view(spec.get('map'),
+                spec.get('reduce'))
+        return self._query(request, db, self._index(db, map_fun, False),
+                reduce_fun)
+
+    def _query(self, request, db, index, reduce_fun, headers=None):
+        params = request.params
+        keys = None
+        if request.method == 'POST' and request.body:
+            keys = self._decode(request).get('keys')
+        elif 'keys' in params:
+            keys = _json_param(params, 'keys')
+
+        descending = _bool_param(params, 'descending')
+        rows = index[::-1] if descending else index
+        if keys is not None:
+            rows = [row for key in keys for row in rows
+                    if row[2] == key and collation_key(key) == row[0]]
+        else:
+            rows = self._range(rows, params, descending)
+
+        reduce_rows = reduce_fun is not None and \
+                _bool_param(params, 'reduce', True)
+        include_docs = _bool_param(params, 'include_docs')
+        if reduce_rows:
+            if include_docs:
+                raise HTTPError(400, "query_parse_error",
+                        "`include_docs` is invalid for reduce")
+            return self._rows({}, self._skip_limit(self._reduce(rows,
+                reduce_fun, params), params), headers)
+
+        offset = 0
+        selected = self._skip_limit(rows, params)
+        if selected:
+            offset = rows.index(selected[0]) + (index.index(rows[0])
+                    if not descending else index[::-1].index(rows[0]))
+        result = []
+        for ckey, docid, key, value in selected:
+            row = {"id": docid, "key": key, "value": value}
+            if include_docs:
+                row['doc'] = None
+                linked = docid
+                if isinstance(value, dict) and '_id' in value:
+                    linked = value['_id']
+                entry = db.docs.get(linked)
+                if entry is not None and not entry.deleted:
+                    row['doc'] = self._render(db, entry, entry.winner(),
+                            {})
+            result.append(row)
+
+        header = {"total_rows": len(index), "offset": offset}
+        if _bool_param(params, 'update_seq'):
+            header['update_seq'] = db.seq
+        return self._rows(header, result, headers)
+
+    def _range(self, rows, params, descending):
+        if 'key' in params:
+            key = collation_key(_json_param(params, 'key'))
+            return [row for row in rows if row[0] == key]
+
+        start = end = None
+        if 'startkey' in params or 'start_key' in params:
+            start = collation_key(_json_param(params, 'startkey',
+                _json_param(params, 'start_key')))
+        if 'endkey' in params or 'end_key' in params:
+            end = collation_key(_json_param(params, 'endkey',
+                _json_param(params, 'end_key')))
+        start_docid = params.get('startkey_docid',
+                params.get('start_key_doc_id'))
+        end_docid = params.get('endkey_docid', params.get('end_key_doc_id'))
+        inclusive_end = _bool_param(params, 'inclusive_end', True)
+        sign = -1 if descending else 1
+
+        def compare(row, key, docid):
+            c = cmp(row[0], key)
+            if c == 0 and docid is not None:
+                c = cmp(row[1], docid)
+            return c * sign
+
+        result = []
+        for row in rows:
+            if start is not None and compare(row, start, start_docid) < 0:
+                continue
+            if end is not None:
+                c = compare(row, end, end_docid)
+                if c > 0 or (c == 0 and not inclusive_end):
+                    continue
+            result.append(row)
+        return result
+
+    def _reduce(self, rows, reduce_fun, params):
+        group_level = _int_param(params, 'group_level')
+        if _bool_param(params, 'group'):
+            group_level = -1
+
+        def group_key(key):
+            if group_level is None:
+                return None
+            if group_level == -1 or not isinstance(key, list):
+                return key
+            return key[:group_level]
+
+        groups = []
+        for ckey, docid, key, value in rows:
+            gkey = group_key(key)
+            if groups and groups[-1][0] == gkey:
+                groups[-1][1].append([key, docid])
+                groups[-1][2].append(value)
+            else:
+                groups.append((gkey, [[key, docid]], [value]))
+
+        return [{"key": gkey, "value": reduce_fun(keys, values, False)}
+                for gkey, keys, values in groups]
+
+
+class _Raw(object):
+    """ attachment data which isn't base64 encoded """
+
+    def __init__(self, data):
+        self.data = data
+
+
+class _Request(object):
+
+    def __init__(self, method, parts, params, body, headers):
+        self.method = method
+        self.parts = parts
+        self.params = params
+        self.body = body
+        self.headers = headers
+
+
+class _Connection(object):
+    """ connection of a memory response, there is nothing to release """
+
+    def release(self, should_close=False):
+        pass
+
+
+class _Parser(object):
+    """ parsed response given to the restkit response constructor, with
+    the methods it uses from `http_parser` """
+
+    def __init__(self, status, headers, body):
+        self._status = status
+        self._headers = IOrderedDict(headers)
+        self._headers.setdefault("Content-Length", str(len(body)))
+        self._body = body
+
+    def headers(self):
+        return self._headers
+
+    def status(self):
+        return "%d %s" % (self._status,
+                httplib.responses.get(self._status, ""))
+
+    def status_code(self):
+        return self._status
+
+    def version(self):
+        return (1, 1)
+
+    def should_keep_alive(self):
+        return True
+
+    def body_file(self):
+        return StringIO(self._body)
+
+
+class _MemoryRequest(object):
+    """ request given to the restkit response constructor """
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class MemoryResponse(CouchDBResponse):
+    """ response of the memory backend """
+
+    def __init__(self, method, uri, status, headers, body):
+        CouchDBResponse.__init__(self, _Connection(),
+                _MemoryRequest(method, uri), _Parser(status, headers, body))
+
+
+class MemoryResource(CouchdbResource):
+    """ CouchdbResource answering requests with a `MemoryBackend` """
+
+    def __init__(self, uri="http://127.0.0.1:5984", backend=None,
+            **client_opts):
+        """ constructor for MemoryResource
+
+        @param uri: str, uri of the server, only the path of requests
+        relative to it is used
+        @param backend: `MemoryBackend` instance, a new one is created if
+        None
+        @param client_opts: options of `CouchdbResource`
+        """
+        CouchdbResource.__init__(self, uri=uri, **client_opts)
+        if backend is None:
+            backend = MemoryBackend()
+        # keep the backend on resources created by `clone` and `__call__`
+        self.initial['client_opts']['backend'] = backend
+        self.backend = backend
+
+    def _send(self, method, path, payload, headers, params, selected=None):
+        uri = self.uri
+        if path:
+            uri = "%s/%s" % (uri.rstrip('/'), path.lstrip('/'))
+
+        if payload is None:
+            body = ""
+        elif isinstance(payload, unicode):
+            body = payload.encode('utf-8')
+        elif isinstance(payload, str):
+            body = payload
+        elif hasattr(payload, 'read'):
+            body = payload.read()
+        else:
+            body = "".join(payload)
+
+        headers = headers or {}
+        for name, value in headers.items():
+            if name.lower() == 'content-encoding' and value == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        status, resp_headers, resp_body = self.backend.handle(method,
+                self._server_path(path), params, body, headers)
+        resp = MemoryResponse(method, uri, status, resp_headers, resp_body)
+
+        # same errors as `restkit.Resource.request`
+        if status >= 400:
+            if status == 404:
+                raise ResourceNotFound(resp.body_string(), response=resp)
+            elif status in (401, 403):
+                raise Unauthorized(resp.body_string(), http_code=status,
+                        response=resp)
+            elif status == 410:
+                raise ResourceGone(resp.body_string(), response=resp)
+            raise RequestFailed(resp.body_string(), http_code=status,
+                    response=resp)
+        return resp
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Encoding and decoding of documents and their attachments as
+`multipart/related` bodies. The document is the first JSON part and each
+attachment is a raw part marked by a `follows` stub in the document, so
+attachments don't have to be base64 encoded and file objects are
+streamed.
+"""
+
+from collections import deque
+import os
+import re
+import tempfile
+import uuid
+import zlib
+
+from .exceptions import InvalidAttachment
+from .jsoncodec import get_json_codec
+
+CHUNK_SIZE = 16 * 1024
+
+# max size of an attachment kept in memory when it has to be buffered
+SPOOL_SIZE = 1024 * 1024
+
+
+def attachment_length(data):
+    """ return the number of bytes that will be read from `data`, a
+    string or a file object """
+    if isinstance(data, basestring):
+        return len(data)
+
+    if hasattr(data, 'fileno'):
+        try:
+            return os.fstat(data.fileno()).st_size - data.tell()
+        except (AttributeError, IOError, OSError):
+            pass
+
+    if hasattr(data, 'seek') and hasattr(data, 'tell'):
+        pos = data.tell()
+        data.seek(0, 2)
+        length = data.tell() - pos
+        data.seek(pos)
+        return length
+
+    raise InvalidAttachment("can't find the length of attachment data, "
+            "set the 'length' member of the attachment")
+
+
+def has_inline_attachments(attachments, files_only=False):
+    """ return True if one of the attachments has inline data. If
+    files_only is True data should be a file object """
+    for att in (attachments or {}).itervalues():
+        if att.get('stub', False) or 'data' not in att:
+            continue
+        if not files_only or hasattr(att['data'], 'read'):
+            return True
+    return False
+
+
+class MultipartWriter(object):
+    """ file like object reading a document and its inline attachments
+    as a multipart/related body.
+
+    Inline attachments of the document (the ones with a `data` member,
+    a string or a file object) are replaced by `follows` stubs. The body
+    can be read again after a call to `reset`, the JSON part is then
+    encoded again so changes of the document (like a new `_rev`) are
+    sent.
+    """
+
+    def __init__(self, doc, boundary=None, codec=None):
+        self.doc = doc
+        self.boundary = boundary or uuid.uuid4().hex
+        self.codec = get_json_codec(codec)
+
+        inline = {}
+        attachments = {}
+        for name, att in (doc.get('_attachments') or {}).iteritems():
+            if att.get('stub', False) or 'data' not in att:
+                attachments[name] = att
+                continue
+
+            data = att['data']
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            length = att.get('length')
+            if length is None:
+                length = attachment_length(data)
+
+            stub = dict((k, v) for k, v in att.iteritems() if k != 'data')
+            stub.update({"follows": True, "length": length})
+            attachments[name] = stub
+
+            start = None
+            if hasattr(data, 'tell'):
+                start = data.tell()
+            inline[name] = (data, length, start)
+
+        doc['_attachments'] = attachments
+        # parts have to follow the order of the stubs in the document
+        self.attachments = [(name, ) + inline[name] for name in attachments
+                if name in inline]
+        self.reset()
+
+    def reset(self):
+        """ rewind the body """
+        segments = deque()
+        body = self.codec.dumps(self.doc)
+        segments.append("--%s\r\nContent-Type: application/json\r\n\r\n%s" %
+                (self.boundary, body))
+
+        for name, data, length, start in self.attachments:
+            segments.append("\r\n--%s\r\nContent-Disposition: attachment; "
+                    "filename=\"%s\"\r\n\r\n" % (self.boundary,
+                        quote_filename(name)))
+            if isinstance(data, basestring):
+                segments.append(data)
+            else:
+                if start is not None:
+                    data.seek(start)
+                segments.append([data, length])
+        segments.append("\r\n--%s--" % self.boundary)
+
+        length = 0
+        for seg in segments:
+            if isinstance(seg, basestring):
+                length += len(seg)
+            else:
+                length += seg[1]
+        self.content_length = length
+        self._segments = segments
+
+    def headers(self):
+        """ headers of the request """
+        return {
+                "Content-Type": 'multipart/related; boundary="%s"' % \
+                        self.boundary,
+                "Content-Length": str(self.content_length)
+        }
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("multipart body can only be rewinded")
+        self.reset()
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        segments = self._segments
+        while segments and (size < 0 or remaining > 0):
+            seg = segments[0]
+            if isinstance(seg, basestring):
+                if size < 0 or len(seg) <= remaining:
+                    chunk = segments.popleft()
+                else:
+                    chunk = seg[:remaining]
+                    segments[0] = seg[remaining:]
+            else:
+                data, left = seg
+                if size < 0:
+                    chunk = data.read(min(left, CHUNK_SIZE))
+                else:
+                    chunk = data.read(min(left, remaining))
+                if not chunk and left:
+                    raise InvalidAttachment("attachment is shorter than "
+                            "its length")
+                seg[1] = left - len(chunk)
+                if not seg[1]:
+                    segments.popleft()
+
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return "".join(chunks)
+
+
+FILENAME_RE = re.compile(r'filename=(?:"((?:[^"\\]|\\.)*)"|([^;\s]+))',
+        re.I)
+
+
+def quote_filename(name):
+    """ return an attachment name as a quoted-string content of a
+    Content-Disposition header """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def parse_filename(disposition):
+    """ return the attachment name of a Content-Disposition header or
+    None """
+    match = FILENAME_RE.search(disposition)
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        name = re.sub(r'\\(.)', r'\1', match.group(1))
+    else:
+        name = match.group(2)
+    return name.decode('utf-8')
+
+
+def parse_boundary(content_type):
+    """ return the boundary of a multipart content type or None """
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def save_attachments(doc, directory):
+    """ write the attachments streams of `doc` in `directory`. Names
+    with slashes are saved in sub-directories. The data of the
+    attachments is replaced by their `path`. """
+    root = os.path.abspath(directory)
+    for name, att in (doc.get('_attachments') or {}).iteritems():
+        data = att.get('data')
+        if not isinstance(data, AttachmentStream):
+            continue
+
+        path = os.path.abspath(os.path.join(root, *name.split('/')))
+        if not path.startswith(root + os.sep):
+            raise InvalidAttachment("invalid attachment name: %s" % name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(path, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+        del att['data']
+        att.update({"stub": True, "path": path})
+
+
+class AttachmentStream(object):
+    """ file like object reading an attachment part of a multipart
+    response. Data is read lazily from the response. If a following
+    attachment is read first, the remaining data of this one is buffered
+    in a temporary file. gzip encoded attachments are decoded. """
+
+    def __init__(self, reader, name, length, encoding=None):
+        self.name = name
+        self.length = length
+        self._reader = reader
+        self._left = length
+        self._started = False
+        self._closed = False
+        self._spool = None
+        self._buf = ''
+        self._decoder = None
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_raw(self, size):
+        if not self._started:
+            self._reader._start(self)
+        size = min(size, self._left)
+        if size <= 0:
+            return ''
+
+        data = self._reader.stream.read(size)
+        if not data:
+            raise InvalidAttachment("attachment %s is truncated" %
+                    self.name)
+        self._left -= len(data)
+        if not self._left:
+            self._reader._done(self)
+        return data
+
+    def read(self, size=-1):
+        if self._spool is not None:
+            return self._spool.read(size)
+        elif self._closed:
+            return ''
+
+        chunks = [self._buf]
+        length = len(self._buf)
+        self._buf = ''
+        while size < 0 or length < size:
+            data = self._read_raw(CHUNK_SIZE)
+            if not data:
+                if self._decoder is not None:
+                    data = self._decoder.flush()
+                    self._decoder = None
+                    chunks.append(data)
+                    length += len(data)
+                break
+
+            if self._decoder is not None:
+                data = self._decoder.decompress(data)
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size >= 0 and len(data) > size:
+            self._buf = data[size:]
+            data = data[:size]
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        """ skip the remaining data of the attachment """
+        if self._spool is not None:
+            self._spool.close()
+        elif not self._closed and self._started:
+            while self._read_raw(CHUNK_SIZE):
+                pass
+        self._closed = True
+        self._buf = ''
+        self._reader._release_skipped()
+
+    def _buffer(self):
+        """ read the remaining data in a temporary file """
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        for chunk in self:
+            spool.write(chunk)
+        spool.seek(0)
+        self._spool = spool
+
+
+class MultipartReader(object):
+    """ decode a multipart/related document from the file object
+    `stream`. The document is read at once, attachments parts are
+    available as `AttachmentStream` objects. Parts are matched to their
+    attachment with the filename of their Content-Disposition header, or
+    by the order of the stubs in the document if they have none.
+    """
+
+    def __init__(self, stream, boundary, codec=None):
+        self.stream = stream
+        self.codec = get_json_codec(codec)
+        self.delimiter = "--" + boundary
+        self.parts = []
+        self._by_name = {}
+        self._current = None
+        self._at_part = False
+
+        self._next_part()
+        lines = []
+        while True:
+            line = self._readline()
+            if line.startswith(self.delimiter):
+                break
+            lines.append(line)
+        self._at_part = True
+        body = "".join(lines)
+        if body.endswith("\r\n"):
+            body = body[:-2]
+        self.doc = self.codec.loads(body)
+
+        attachments = self.doc.get('_attachments') or {}
+        for name in self._attachments_order(body, attachments):
+            att = attachments[name]
+            if not att.pop('follows', False):
+                continue
+            length = att.get('length')
+            encoding = att.get('encoding')
+            if encoding is not None:
+                length = att.get('encoded_length', length)
+            stream = AttachmentStream(self, name, length, encoding)
+            att['data'] = stream
+            self.parts.append(stream)
+            self._by_name[name] = stream
+
+        if not self.parts:
+            self.close()
+
+    def _attachments_order(self, body, attachments):
+        # parts without a filename follow the order of the stubs in the
+        # JSON part
+        if len(attachments) < 2:
+            return list(attachments)
+
+        start = body.find('"_attachments"')
+        def position(name):
+            key = self.codec.dumps(name).replace('\\/', '/')
+            return body.find(key, start)
+        return sorted(attachments, key=position)
+
+    def _readline(self):
+        line = self.stream.readline()
+        if not line:
+            raise InvalidAttachment("multipart response is truncated")
+        return line
+
+    def _next_part(self):
+        """ go to the data of the next part and return the filename of
+        its Content-Disposition header or None """
+        if not self._at_part:
+            while not self._readline().startswith(self.delimiter):
+                pass
+        filename = None
+        while True:
+            line = self._readline().strip()
+            if not line:
+                break
+            header, _, value = line.partition(':')
+            if header.strip().lower() == 'content-disposition':
+                filename = parse_filename(value)
+        self._at_part = False
+        return filename
+
+    def _start(self, part):
+        """ read the response until the data of `part`. Parts sent
+        before it are buffered, or skipped if they are closed. """
+        while not part._started:
+            previous = self._current
+            if previous is not None:
+                if previous._closed:
+                    while previous._left:
+                        previous._read_raw(CHUNK_SIZE)
+                else:
+                    previous._buffer()
+                continue
+
+            filename = self._next_part()
+            if filename is None:
+                following = [p for p in self.parts if not p._started][0]
+            elif filename in self._by_name:
+                following = self._by_name[filename]
+                if following._started:
+                    raise InvalidAttachment("attachment %s is sent twice" %
+                            filename)
+            else:
+                raise InvalidAttachment("unknown attachment %s" % filename)
+
+            self._current = following
+            following._started = True
+            if not following._left:
+                self._done(following)
+
+    def _done(self, part):
+        self._current = None
+        if all(p._started for p in self.parts):
+            self.close()
+
+    def _release_skipped(self):
+        if self._current is None and \
+                all(p._closed for p in self.parts if not p._started):
+            self.close()
+
+    def close(self):
+        """ release the response """
+        self.stream.close()
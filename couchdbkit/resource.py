@@ -18,55 +18,233 @@ Example:
     >>> info['couchdb']
     u'Welcome'
 
+Request bodies and responses can be gzip compressed:
+
+    >>> def report(info):
+    ...     print info['direction'], info['size'] - info['encoded_size']
+    >>> resource = CouchdbResource(compress=True, on_compress=report)
+
+Requests can be instrumented with hooks, see `couchdbkit.instrument`:
+
+    >>> from couchdbkit.instrument import RequestStats
+    >>> stats = RequestStats()
+    >>> resource = CouchdbResource(hooks=[stats])
+
 """
 import base64
+import copy
+import logging
 import re
+import time
+import urlparse
+import zlib
 
 from restkit import Resource, ClientResponse
-from restkit.errors import ResourceError, RequestFailed, RequestError
+from restkit.errors import ResourceError, RequestFailed, RequestError, \
+AlreadyRead
 from restkit.util import url_quote
+from restkit.wrappers import BodyWrapper
 
 from . import __version__
 from .exceptions import ResourceNotFound, ResourceConflict, \
 PreconditionFailed
-from .utils import json
+from .cluster import strip_credentials
+from .instrument import RequestInfo, server_path
+from .jsoncodec import get_json_codec
+
+logger = logging.getLogger(__name__)
 
 USER_AGENT = 'couchdbkit/%s' % __version__
 
+# request bodies smaller than this aren't compressed
+COMPRESS_MIN_SIZE = 1024
+
+# options of CouchdbResource, the other options are passed to restkit
+COUCHDB_OPTIONS = ("compress", "compress_min_size", "on_compress",
+        "json_codec", "cluster", "hedging", "hooks", "root_path")
+
+# header of requests that shouldn't be hedged, removed before they are
+# sent
+NO_HEDGE_HEADER = "X-Couchdbkit-No-Hedge"
+
 RequestFailed = RequestFailed
 
+def gzip_encode(data, level=6):
+    """ gzip compress a string """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CountingBodyWrapper(BodyWrapper):
+    """ body stream counting the bytes read. `on_close` is called with
+    the number of bytes when the stream is released. """
+
+    def __init__(self, resp, connection, on_close):
+        BodyWrapper.__init__(self, resp, connection)
+        self.on_close = on_close
+        self.size = 0
+
+    def close(self):
+        if not self._closed:
+            if not self.eof:
+                self.size += len(self.body.read())
+            self.on_close(self.size)
+        BodyWrapper.close(self)
+
+    def next(self):
+        data = BodyWrapper.next(self)
+        self.size += len(data)
+        return data
+
+    def read(self, n=-1):
+        data = BodyWrapper.read(self, n)
+        self.size += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        data = BodyWrapper.readline(self, limit)
+        self.size += len(data)
+        return data
+
+    def readlines(self, hint=None):
+        lines = self.body.readlines(hint)
+        self.size += sum(len(line) for line in lines)
+        self.eof = True
+        self.close()
+        return lines
+
+
 class CouchDBResponse(ClientResponse):
 
+    # set by CouchdbResource on compressed or instrumented responses,
+    # called with the decoded size of the body once it is read.
+    on_decoded = None
+
+    # codec used to decode the body, set by CouchdbResource
+    json_codec = None
+
     @property
     def json_body(self):
         body = self.body_string()
 
         # try to decode json
         try:
-            return json.loads(body)
+            return get_json_codec(self.json_codec).loads(body)
         except ValueError:
             return body
 
+    def skip_body(self):
+        if self.on_decoded is None or not self.can_read():
+            return ClientResponse.skip_body(self)
+
+        size = len(self._body.read())
+        self._already_read = True
+        self.connection.release(self.should_close)
+        self.on_decoded(size)
+
+    def body_string(self, charset=None, unicode_errors="strict"):
+        if self.on_decoded is None:
+            return ClientResponse.body_string(self, charset=charset,
+                    unicode_errors=unicode_errors)
+
+        # the size is counted in bytes, before the charset is decoded
+        body = ClientResponse.body_string(self)
+        self.on_decoded(len(body))
+        if charset is not None:
+            try:
+                body = body.decode(charset, unicode_errors)
+            except UnicodeDecodeError:
+                pass
+        return body
+
+    def body_stream(self):
+        if self.on_decoded is None:
+            return ClientResponse.body_stream(self)
+
+        if not self.can_read():
+            raise AlreadyRead()
+        self._already_read = True
+        return CountingBodyWrapper(self, self.connection, self.on_decoded)
+
 
 class CouchdbResource(Resource):
 
-    def __init__(self, uri="http://127.0.0.1:5984", **client_opts):
+    def __init__(self, uri="http://127.0.0.1:5984", compress=False,
+            compress_min_size=COMPRESS_MIN_SIZE, on_compress=None,
+            json_codec=None, cluster=None, hedging=None, hooks=None,
+            root_path=None, **client_opts):
         """Constructor for a `CouchdbResource` object.
 
         CouchdbResource represent an HTTP resource to CouchDB.
 
         @param uri: str, full uri to the server.
+        @param compress: boolean, if True request bodies larger than
+        `compress_min_size` are gzip encoded and gzip encoded responses
+        are accepted. Responses, streamed ones too, are decoded
+        transparently.
+        @param compress_min_size: int, min size in bytes of a compressed
+        request body.
+        @param on_compress: callable, called with a dict for each
+        compressed request body and each compressed response with a
+        Content-Length, once its body is read: `direction` ("request"
+        or "response"), `method`, `uri`, `size` (decoded bytes) and
+        `encoded_size` (bytes on the wire).
+        @param json_codec: name of a registered JSON codec or codec
+        instance used by this resource, see `couchdbkit.jsoncodec`. By
+        default the codec set with `couchdbkit.set_json_codec` is used.
+        @param cluster: `couchdbkit.cluster.Cluster` instance. Requests
+        are sent to one of its nodes, `uri` should start with the uri of
+        its first node.
+        @param hedging: `couchdbkit.cluster.Hedging` instance. Reads of
+        documents and views slower than its delay are sent again, to
+        another node of the cluster if there is one.
+        @param hooks: list of hooks, objects with `pre_request` and
+        `post_request` methods called with a
+        `couchdbkit.instrument.RequestInfo` object before each request
+        and once its response is read or it failed.
+        @param root_path: str, path of the server root, when CouchDB is
+        served under a prefix. By default the path of `uri`, so the
+        resource created for the server uri should be the first one.
         """
         client_opts['response_class'] = CouchDBResponse
 
         Resource.__init__(self, uri=uri, **client_opts)
+        if root_path is None:
+            root_path = urlparse.urlsplit(uri).path
+        root_path = root_path.rstrip('/')
+        # keep options on resources created by `clone` and `__call__`
+        self.initial['client_opts'].update({
+            "compress": compress,
+            "compress_min_size": compress_min_size,
+            "on_compress": on_compress,
+            "json_codec": json_codec,
+            "cluster": cluster,
+            "hedging": hedging,
+            "hooks": hooks,
+            "root_path": root_path
+        })
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.on_compress = on_compress
+        self.json_codec = json_codec
+        self.cluster = cluster
+        self.hedging = hedging
+        self.hooks = hooks or []
+        self.root_path = root_path
+        self._node_resources = {}
         self.safe = ":/%"
 
+    @property
+    def codec(self):
+        """ JSON codec of the resource """
+        return get_json_codec(self.json_codec)
+
     def copy(self, path=None, headers=None, **params):
         """ add copy to HTTP verbs """
         return self.request('COPY', path=path, headers=headers, **params)
 
-    def request(self, method, path=None, payload=None, headers=None, **params):
+    def request(self, method, path=None, payload=None, headers=None,
+            hedge=True, **params):
         """ Perform HTTP call to the couchdb server and manage
         JSON conversions, support GET, POST, PUT and DELETE.
 
@@ -86,6 +264,9 @@ class CouchdbResource(Resource):
         @param headers: dict, optional headers that will
             be added to HTTP request.
         @param raw: boolean, response return a Response object
+        @param hedge: boolean, if False the request isn't hedged, see
+        `couchdbkit.cluster.Hedging`. Callers which can only set headers
+        set the `NO_HEDGE_HEADER` header instead.
         @param params: Optional parameterss added to the request.
             Parameterss are for example the parameters for a view. See
             `CouchDB View API reference
@@ -96,26 +277,106 @@ class CouchdbResource(Resource):
         """
 
         headers = headers or {}
+        if headers.pop(NO_HEDGE_HEADER, None) is not None:
+            hedge = False
         headers.setdefault('Accept', 'application/json')
         headers.setdefault('User-Agent', USER_AGENT)
 
+        codec = self.codec
         if payload is not None:
             #TODO: handle case we want to put in payload json file.
             if not hasattr(payload, 'read') and not isinstance(payload, basestring):
-                payload = json.dumps(payload).encode('utf-8')
+                payload = codec.dumps(payload)
                 headers.setdefault('Content-Type', 'application/json')
 
-        params = encode_params(params)
+        if self.compress:
+            headers.setdefault('Accept-Encoding', 'gzip')
+            if isinstance(payload, str) and \
+                    len(payload) >= self.compress_min_size and \
+                    'Content-Encoding' not in headers:
+                encoded = gzip_encode(payload)
+                headers['Content-Encoding'] = 'gzip'
+                self._report_compress("request", method, path, len(payload),
+                        len(encoded))
+                payload = encoded
+
+        params = encode_params(params, codec=codec)
+        hedge = hedge and self.hedging is not None and \
+                self.hedging.hedges(method, self._full_path(path), params,
+                        headers, root=self.root_path)
+        if not self.hooks:
+            resp = self._do_request(method, path, payload, headers, params,
+                    hedge)
+        else:
+            info = self._pre_request(method, path, payload, headers, params)
+            try:
+                resp = self._do_request(method, path, payload, headers,
+                        params, hedge)
+            except Exception, e:
+                info.exception = e
+                response = getattr(e, 'response', None)
+                if response is not None:
+                    info.status = response.status_int
+                self._post_request(info)
+                raise
+            info.ttfb = time.time() - info.start
+            info.status = resp.status_int
+
+        resp.json_codec = codec
+        callbacks = []
+        if self.compress and self.on_compress is not None and \
+                method != 'HEAD' and resp.status_int not in (204, 304):
+            # the parser may remove the Content-Encoding header once the
+            # body is decoded, the decoded size is compared with the size
+            # on the wire instead.
+            encoded_size = resp.headers.get('content-length')
+            if encoded_size is not None:
+                encoded_size = int(encoded_size)
+                def report(size):
+                    if size != encoded_size:
+                        self._report_compress("response", method, path,
+                                size, encoded_size)
+                callbacks.append(report)
+
+        if self.hooks:
+            if method == 'HEAD' or resp.status_int in (204, 304):
+                info.response_size = 0
+                self._post_request(info)
+            else:
+                def post_request(size):
+                    info.response_size = size
+                    self._post_request(info)
+                callbacks.append(post_request)
+
+        if callbacks:
+            def on_decoded(size):
+                resp.on_decoded = None
+                for callback in callbacks:
+                    callback(size)
+            resp.on_decoded = on_decoded
+        return resp
+
+    def _do_request(self, method, path, payload, headers, params,
+            hedge=False):
+        codec = self.codec
         try:
-            resp = Resource.request(self, method, path=path,
-                             payload=payload, headers=headers, **params)
+            if hedge:
+                # nodes used by the requests, a hedged request is sent
+                # to another node
+                selected = []
+                def send():
+                    return self._send(method, path, payload, dict(headers),
+                            params, selected)
+                resp = self.hedging.run(send)
+            else:
+                resp = self._send(method, path, payload, headers, params)
 
         except ResourceError, e:
             msg = getattr(e, 'msg', '')
             if e.response and msg:
                 if e.response.headers.get('content-type') == 'application/json':
                     try:
-                        msg = json.loads(msg)
+                        msg = codec.loads(msg)
                     except ValueError:
                         pass
 
@@ -138,20 +399,114 @@ class CouchdbResource(Resource):
                 raise
         except:
             raise
-
         return resp
 
-def encode_params(params):
+    def _full_path(self, path):
+        full_path = urlparse.urlsplit(self.uri).path
+        if path:
+            full_path = "%s/%s" % (full_path.rstrip('/'), path.lstrip('/'))
+        return full_path
+
+    def _server_path(self, path):
+        """ path of a request relative to the server root """
+        return server_path(self._full_path(path), self.root_path)
+
+    def _pre_request(self, method, path, payload, headers, params):
+        full_path = self._full_path(path)
+
+        if isinstance(payload, unicode):
+            size = len(payload.encode('utf-8'))
+        elif isinstance(payload, str):
+            size = len(payload)
+        elif payload is None:
+            size = 0
+        else:
+            size = headers.get('Content-Length')
+            if size is not None:
+                size = int(size)
+
+        info = RequestInfo(method, full_path or '/', params, size,
+                root=self.root_path)
+        for hook in self.hooks:
+            try:
+                hook.pre_request(info)
+            except Exception:
+                logger.exception("error in request hook %r" % hook)
+        info.start = time.time()
+        return info
+
+    def _post_request(self, info):
+        info.total_time = time.time() - info.start
+        for hook in self.hooks:
+            try:
+                hook.post_request(info)
+            except Exception:
+                logger.exception("error in request hook %r" % hook)
+
+    def _send(self, method, path, payload, headers, params, selected=None):
+        if self.cluster is None:
+            return Resource.request(self, method, path=path,
+                    payload=payload, headers=headers, **params)
+
+        cluster = self.cluster
+        tried = []
+        while True:
+            node = cluster.select(exclude=tried + (selected or []))
+            if selected is not None:
+                selected.append(node)
+            failed = False
+            try:
+                try:
+                    return Resource.request(self._node_resource(node),
+                            method, path=path, payload=payload,
+                            headers=headers, **params)
+                except RequestError:
+                    failed = True
+                    tried.append(node)
+                    # only safe requests are sent again
+                    if method not in ('GET', 'HEAD') or \
+                            len(tried) >= len(cluster.nodes):
+                        raise
+            finally:
+                cluster.release(node, failed=failed)
+
+    def _node_resource(self, node):
+        """ return a copy of this resource sending requests to `node` """
+        res = self._node_resources.get(node.uri)
+        if res is None:
+            base = strip_credentials(self.cluster.uris[0])
+            if not self.uri.startswith(base):
+                raise ValueError("%s isn't an uri of the cluster" % self.uri)
+            res = copy.copy(self)
+            res.uri = node.uri + self.uri[len(base):]
+            self._node_resources[node.uri] = res
+        return res
+
+    def _report_compress(self, direction, method, path, size,
+            encoded_size):
+        if self.on_compress is None:
+            return
+        self.on_compress({
+            "direction": direction,
+            "method": method,
+            "uri": self.uri if not path else "%s/%s" % (self.uri,
+                path.lstrip('/')),
+            "size": size,
+            "encoded_size": encoded_size
+        })
+
+def encode_params(params, codec=None):
     """ encode parameters in json if needed """
+    codec = get_json_codec(codec)
     _params = {}
     if params:
         for name, value in params.items():
             if name in ('key', 'startkey', 'endkey'):
-                value = json.dumps(value)
+                value = codec.dumps(value)
             elif value is None:
                 continue
             elif not isinstance(value, basestring):
-                value = json.dumps(value)
+                value = codec.dumps(value)
             _params[name] = value
     return _params
 
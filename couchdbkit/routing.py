@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Read/write splitting between a primary database and its read replicas,
+usually kept up to date with `Server.replicate`. Writes go to the
+primary, reads are spread over the replicas by round-robin.
+
+Replicas lag behind the primary. With `read_your_writes` a session reads
+from the primary for some seconds after it writes, so it sees its own
+changes:
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.routing import RoutedDatabase
+    >>> primary = Server("http://primary:5984")["mydb"]
+    >>> replicas = [Server("http://replica%s:5984" % i)["mydb"]
+    ...     for i in range(2)]
+    >>> db = RoutedDatabase(primary, replicas, read_your_writes=5)
+    >>> session = db.session()
+    >>> session.save_doc(doc)
+    >>> session.open_doc(doc['_id']) # read from the primary
+
+Methods not routed explicitly (`info`, `compact`, ...) are run on the
+primary.
+"""
+
+import threading
+import time
+
+from .client import Database
+from .writer import BulkWriter, DEFAULT_MAX_BATCH, DEFAULT_MAX_DELAY
+
+
+def _write(name):
+    """ return a method calling `name` on the primary """
+    def _method(self, *args, **kwargs):
+        result = getattr(self.primary, name)(*args, **kwargs)
+        self.last_write = time.time()
+        return result
+    _method.__name__ = name
+    return _method
+
+
+def _read(name):
+    """ return a method calling `name` on a replica """
+    def _method(self, *args, **kwargs):
+        return getattr(self.read_db(), name)(*args, **kwargs)
+    _method.__name__ = name
+    return _method
+
+
+class _RoundRobin(object):
+
+    def __init__(self, items):
+        self.items = items
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            item = self.items[self._next % len(self.items)]
+            self._next += 1
+            return item
+
+
+class RoutedDatabase(object):
+    """ Database object sending writes to a primary database and reads
+    to replicas. """
+
+    def __init__(self, primary, replicas=None, read_your_writes=None):
+        """ constructor for RoutedDatabase
+
+        @param primary: `Database` instance or uri of the primary
+        database
+        @param replicas: list of `Database` instances or uris of the
+        replicas. Reads go to the primary if it's empty.
+        @param read_your_writes: float, number of seconds reads of a
+        session are sent to the primary after it writes. None to always
+        read from replicas.
+        """
+        self.primary = self._database(primary)
+        self.replicas = [self._database(db) for db in replicas or []]
+        self.read_your_writes = read_your_writes
+        self.last_write = None
+        self._replicas = _RoundRobin(self.replicas or [self.primary])
+
+    def _database(self, db):
+        if isinstance(db, basestring):
+            return Database(db)
+        return db
+
+    def session(self):
+        """ return a RoutedDatabase sharing the databases of this one
+        with its own read-your-writes window. Use one session by user
+        request or thread. """
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        obj.last_write = None
+        return obj
+
+    def read_db(self):
+        """ return the database the next read is sent to """
+        if self.read_your_writes is not None and \
+                self.last_write is not None and \
+                time.time() - self.last_write < self.read_your_writes:
+            return self.primary
+        return self._replicas.next()
+
+    def writer(self, max_batch=DEFAULT_MAX_BATCH,
+            max_delay=DEFAULT_MAX_DELAY, max_queue=None, **params):
+        """ return a `couchdbkit.writer.BulkWriter` saving documents to
+        the primary, see `Database.writer`. Each batch it writes starts
+        the read-your-writes window of this session. """
+        return BulkWriter(self, max_batch=max_batch, max_delay=max_delay,
+                max_queue=max_queue, **params)
+
+    def __getattr__(self, name):
+        if name == 'primary':
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.primary.uri,
+                [db.uri for db in self.replicas])
+
+    def __contains__(self, docid):
+        return self.read_db().doc_exist(docid)
+
+    def __getitem__(self, docid):
+        return self.open_doc(docid)
+
+    def __setitem__(self, docid, doc):
+        doc['_id'] = docid
+        self.save_doc(doc)
+
+    def __delitem__(self, docid):
+        self.delete_doc(docid)
+
+    def __len__(self):
+        return len(self.read_db())
+
+    def __iter__(self):
+        return iter(self.read_db())
+
+    def __nonzero__(self):
+        return True
+
+    save_doc = _write('save_doc')
+    save_docs = _write('save_docs')
+    bulk_save = save_docs
+    delete_doc = _write('delete_doc')
+    delete_docs = _write('delete_docs')
+    bulk_delete = delete_docs
+    copy_doc = _write('copy_doc')
+    update = _write('update')
+    update_doc = _write('update_doc')
+    update_docs = _write('update_docs')
+    put_attachment = _write('put_attachment')
+    delete_attachment = _write('delete_attachment')
+
+    open_doc = _read('open_doc')
+    get = open_doc
+    open_docs = _read('open_docs')
+    doc_exist = _read('doc_exist')
+    get_rev = _read('get_rev')
+    get_revs = _read('get_revs')
+    docs_exist = _read('docs_exist')
+    iter_docs_exist = _read('iter_docs_exist')
+    view = _read('view')
+    temp_view = _read('temp_view')
+    search = _read('search')
+    list = _read('list')
+    show = _read('show')
+    all_docs = _read('all_docs')
+    iter_all_docs = _read('iter_all_docs')
+    documents = _read('documents')
+    iterdocuments = documents
+    fetch_attachment = _read('fetch_attachment')
@@ -439,6 +439,33 @@ class DocumentBase(DocumentSchema):
 
     store = save
 
+    def atomic_update(self, fn, **params):
+        """ Apply `fn` to the latest version of the document and save it,
+        fetching it and applying `fn` again on conflict. See
+        `couchdbkit.client.Database.update_doc`.
+
+        @param fn: callable taking an instance of the document class. It
+        may modify it or return another instance to save.
+        @param params: params of `Database.update_doc`, like max_retries
+        """
+        cls = self.__class__
+        updated = []
+
+        def apply(doc):
+            obj = cls.wrap(doc)
+            new_obj = fn(obj)
+            if new_obj is not None:
+                obj = new_obj
+            obj.validate()
+            updated[:] = [obj]
+            return obj.to_json()
+
+        doc = self.get_db().update_doc(self._id, apply, **params)
+        obj = updated[0]
+        self._doc = obj._doc
+        self._dynamic_properties = obj._dynamic_properties
+        self._doc.update(doc)
+
     @classmethod
     def save_docs(cls, docs, use_uuids=True, all_or_nothing=False):
         """ Save multiple documents in database.
@@ -468,6 +495,16 @@ class DocumentBase(DocumentSchema):
         cls._allow_dynamic_properties = dynamic_properties
         return db.get(docid, rev=rev, wrapper=cls.wrap)
 
+    @classmethod
+    def get_many(cls, ids, db=None, dynamic_properties=True, **params):
+        """ get documents with `ids` in one request. Return a list in the
+        order of `ids` with None for documents not found.
+        """
+        if db is None:
+            db = cls.get_db()
+        cls._allow_dynamic_properties = dynamic_properties
+        return db.open_docs(ids, wrapper=cls.wrap, **params)
+
     @classmethod
     def get_or_create(cls, docid=None, db=None, dynamic_properties=True, **params):
         """ get  or create document with `docid` """
@@ -11,11 +11,14 @@ really belong anywhere else in the modules.
 from __future__ import with_statement
 
 import codecs
+from collections import deque
 import string
 from hashlib import md5
 import os
+import Queue
 import re
 import sys
+import threading
 import urllib
 
 
@@ -127,6 +130,122 @@ def validate_dbname(name):
         raise ValueError("Invalid db name: '%s'" % name)
     return True
 
+class Task(object):
+    """ call of a function run by a `WorkerPool` """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self._event = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self._event.set()
+
+    def wait(self):
+        """ wait until the call is done """
+        self._event.wait()
+
+    def get(self):
+        """ wait until the call is done and return its result or raise
+        its exception """
+        self._event.wait()
+        if self.exc_info is not None:
+            exc_type, exc_value, tb = self.exc_info
+            raise exc_type, exc_value, tb
+        return self.result
+
+
+class WorkerPool(object):
+    """ threads reused to run functions, at most `size` of them. Threads
+    are started when needed. """
+
+    def __init__(self, size, name="couchdbkit-worker"):
+        self.size = size
+        self.name = name
+        self._tasks = Queue.Queue()
+        self._threads = 0
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """ run `func` with `args` in a worker thread and return its
+        `Task`, or None if all the workers are busy """
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            elif self._threads < self.size:
+                self._threads += 1
+                thread = threading.Thread(target=self._run, name=self.name)
+                thread.daemon = True
+                thread.start()
+            else:
+                return None
+        task = Task(func, args)
+        self._tasks.put(task)
+        return task
+
+    def _run(self):
+        while True:
+            self._tasks.get().run()
+            with self._lock:
+                self._idle += 1
+
+# workers of `concurrent_map` and `concurrent_imap`
+DEFAULT_POOL_SIZE = 32
+_pool = WorkerPool(DEFAULT_POOL_SIZE)
+
+def concurrent_map(func, items, concurrency=1):
+    """ apply `func` to each item using up to `concurrency` threads.
+    Results are returned in the order of the items. If a call raise an
+    exception, no new call is started and the exception is raised again
+    once running calls are done.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    return list(concurrent_imap(func, items, concurrency=concurrency))
+
+def concurrent_imap(func, items, concurrency=1):
+    """ like `concurrent_map` but return an iterator. Results are
+    yielded in the order of the items as soon as they are available,
+    with at most `concurrency` calls running, and `items` is consumed
+    lazily. Calls run in a shared `WorkerPool`, or in the calling thread
+    when all its workers are busy.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    def start(item):
+        task = _pool.submit(func, item)
+        if task is None:
+            task = Task(func, (item, ))
+            task.run()
+        return task
+
+    def result(task):
+        task.wait()
+        if task.exc_info is not None:
+            # running calls end before the error is raised
+            for other in running:
+                other.wait()
+        return task.get()
+
+    running = deque()
+    for item in items:
+        running.append(start(item))
+        if len(running) >= concurrency:
+            yield result(running.popleft())
+    while running:
+        yield result(running.popleft())
+
 def to_bytestring(s):
     """ convert to bytestring an unicode """
     if not isinstance(s, basestring):
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Client side generation of document ids. The algorithms are the ones
+CouchDB uses for `/_uuids`, so ids can be created without asking the
+server:
+
+* ``random``: 128 random bits
+* ``sequential``: a random prefix and a monotonic suffix. Consecutive ids
+  are close to each other which gives a better locality in the database
+  b-tree on inserts.
+* ``utc_random``: the time in microseconds followed by random bits
+
+Example:
+
+    >>> from couchdbkit import Server
+    >>> server = Server(uuid_algorithm="sequential")
+    >>> server.next_uuid()
+    '4e17c12963f4bee0e6ec90da54804894'
+
+"""
+
+import os
+import random
+import threading
+import time
+
+_random = random.SystemRandom()
+
+class RandomUUIDs(object):
+    """ 32 hex chars from 128 random bits """
+
+    def next_uuid(self):
+        return os.urandom(16).encode('hex')
+
+
+class SequentialUUIDs(object):
+    """ 26 random hex chars followed by a 6 hex chars counter increased
+    by a random step. A new prefix is used when the counter overflows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._new_prefix()
+
+    def _new_prefix(self):
+        self._prefix = os.urandom(13).encode('hex')
+        self._seq = _random.randint(1, 0xffe)
+
+    def next_uuid(self):
+        with self._lock:
+            self._seq += _random.randint(1, 0xffe)
+            if self._seq >= 0xfff000:
+                self._new_prefix()
+            return "%s%06x" % (self._prefix, self._seq)
+
+
+class UTCRandomUUIDs(object):
+    """ 14 hex chars of the time in microseconds since the epoch followed
+    by 18 random hex chars. """
+
+    def next_uuid(self):
+        return "%014x%s" % (int(time.time() * 1000000),
+                os.urandom(9).encode('hex'))
+
+
+UUID_ALGORITHMS = {
+    "random": RandomUUIDs,
+    "sequential": SequentialUUIDs,
+    "utc_random": UTCRandomUUIDs
+}
+
+def get_uuid_generator(algorithm):
+    """ return an uuids generator for `algorithm`. `algorithm` could be
+    the name of a bundled algorithm or an object with a `next_uuid`
+    method """
+    if hasattr(algorithm, "next_uuid"):
+        return algorithm
+
+    try:
+        return UUID_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("unknown uuid algorithm: %r" % algorithm)
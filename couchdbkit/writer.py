@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+
+"""
+Write-behind buffer coalescing document saves into `_bulk_docs`
+requests. `BulkWriter.save_doc` queues a document and returns at once
+a `WriteFuture`. A background thread sends the queued documents when
+`max_batch` of them are waiting or the oldest one waited `max_delay`
+seconds. The documents are updated with their `_id` and `_rev` once
+saved, like with `Database.save_doc`:
+
+    >>> with db.writer(max_batch=500, max_delay=0.05) as writer:
+    ...     for event in events:
+    ...         writer.save_doc(event)
+    >>> future = writer.save_doc(doc)
+    >>> future.get()
+    {u'id': u'mydoc', u'rev': u'1-967a00dff5e02add41819138abb3284d'}
+
+`save_doc` blocks while `max_queue` documents are waiting, so producers
+can't get ahead of the database. Queued documents are written when the
+writer is closed, at the end of the `with` block or when the
+interpreter exits. Writers can be shared by threads, and by greenlets
+once the threading module is patched by gevent or eventlet.
+"""
+
+import atexit
+from collections import deque
+import logging
+import sys
+import threading
+import time
+import weakref
+
+from .exceptions import BulkSaveError, ResourceConflict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH = 500
+
+DEFAULT_MAX_DELAY = 0.05
+
+# open writers, closed at exit
+_writers = weakref.WeakSet()
+
+
+class WriteFuture(object):
+    """ result of a document queued in a `BulkWriter` """
+
+    def __init__(self, doc):
+        self.doc = doc
+        # time the document was queued
+        self.queued = time.time()
+        self.result = None
+        self.exception = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def ready(self):
+        """ return True if the document was written or failed """
+        return self._event.is_set()
+
+    def successful(self):
+        return self.ready() and self.exception is None
+
+    def get(self, timeout=None):
+        """ wait until the document is written and return the result of
+        `_bulk_docs` for it: a dict with `id` and `rev`. Raise
+        `ResourceConflict` on conflict, `BulkSaveError` for other document
+        errors and the error of the request if it failed. """
+        if not self._event.wait(timeout):
+            raise RuntimeError("document not written after %ss" % timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def add_done_callback(self, fn):
+        """ call `fn` with the future once the document is written or
+        failed, at once if it's already done. Callbacks run in the thread
+        of the writer, they can't call its `flush` or `close` method. """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self.result = result
+            self.exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("error in write callback %r" % fn)
+
+
+class BulkWriter(object):
+    """ queue documents and save them in batches with `_bulk_docs` from
+    a background thread """
+
+    def __init__(self, db, max_batch=DEFAULT_MAX_BATCH,
+            max_delay=DEFAULT_MAX_DELAY, max_queue=None, **params):
+        """ constructor for BulkWriter
+
+        @param db: `couchdbkit.client.Database` instance
+        @param max_batch: int, max number of documents by request
+        @param max_delay: float, max number of seconds a document waits
+        before its batch is sent
+        @param max_queue: int, max number of queued documents, `save_doc`
+        blocks until there is room. 10 * max_batch by default.
+        @param params: params of `Database.save_docs`, like
+        all_or_nothing
+        """
+        if max_batch < 1:
+            raise ValueError("max_batch should be at least 1")
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue or 10 * max_batch
+        self.params = params
+        self.closed = False
+        self.docs = 0
+        self.batches = 0
+        self.errors = 0
+
+        self._queue = deque()
+        self._sending = []
+        self._flush = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                name="couchdbkit-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        _writers.add(self)
+
+    def save_doc(self, doc):
+        """ queue `doc` and return its `WriteFuture`. Block while the
+        queue is full. """
+        with self._cond:
+            while not self.closed and len(self._queue) >= self.max_queue:
+                self._check_thread("save_doc with a full queue")
+                self._cond.wait()
+            if self.closed:
+                raise ValueError("writer is closed")
+            future = WriteFuture(doc)
+            self._queue.append(future)
+            self._cond.notify_all()
+        return future
+
+    def flush(self):
+        """ send the queued documents now and wait until they are
+        written """
+        self._check_thread("flush")
+        with self._cond:
+            futures = self._sending + list(self._queue)
+            self._flush = True
+            self._cond.notify_all()
+        for future in futures:
+            future._event.wait()
+
+    def close(self):
+        """ write the queued documents and stop the writer """
+        self._check_thread("close")
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        _writers.discard(self)
+
+    def stats(self):
+        """ return the number of documents written, of requests sent, of
+        documents that failed and of queued documents """
+        with self._cond:
+            return {
+                    "docs": self.docs,
+                    "batches": self.batches,
+                    "errors": self.errors,
+                    "queued": len(self._queue)
+            }
+
+    def _check_thread(self, action):
+        # the writer thread would wait for itself
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("%s can't be called from a write callback" %
+                    action)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _next_batch(self):
+        """ wait for the next batch to send, return None once closed and
+        empty """
+        with self._cond:
+            while True:
+                queue = self._queue
+                if queue:
+                    wait = queue[0].queued + self.max_delay - time.time()
+                    if len(queue) >= self.max_batch or wait <= 0 or \
+                            self._flush or self.closed:
+                        break
+                    self._cond.wait(wait)
+                elif self.closed:
+                    return None
+                else:
+                    self._flush = False
+                    self._cond.wait()
+
+            count = min(len(queue), self.max_batch)
+            batch = [queue.popleft() for i in range(count)]
+            if not queue:
+                self._flush = False
+            self._sending = batch
+            # wake producers blocked by a full queue
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            try:
+                results = self.db.save_docs([future.doc for future in batch],
+                        **self.params)
+            except BulkSaveError, e:
+                results = e.results
+        except Exception:
+            error = sys.exc_info()[1]
+            results = None
+
+        errors = 0
+        for i, future in enumerate(batch):
+            if results is None:
+                future._set(exception=error)
+                errors += 1
+                continue
+            result = results[i]
+            if 'error' not in result:
+                future._set(result)
+                continue
+            errors += 1
+            if result['error'] == 'conflict':
+                future._set(exception=ResourceConflict(result.get('reason')))
+            else:
+                future._set(exception=BulkSaveError([result], [result]))
+
+        with self._cond:
+            self.docs += len(batch) - errors
+            self.errors += errors
+            self.batches += 1
+            self._sending = []
+
+
+def _close_writers():
+    for writer in list(_writers):
+        writer.close()
+
+atexit.register(_close_writers)
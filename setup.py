@@ -48,6 +48,7 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     packages = find_packages(exclude=['tests']),
+    package_data = {'couchdbkit': ['designs/*/*/*/*']},
 
     zip_safe = False,
 
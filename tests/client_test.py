@@ -6,6 +6,11 @@
 __author__ = 'benoitc@e-engura.com (Benoît Chesneau)'
 
 import copy
+import os
+import shutil
+import tempfile
+import threading
+import time
 try:
     import unittest2 as unittest
 except ImportError:
@@ -85,6 +90,175 @@ class ClientServerTestCase(unittest.TestCase):
         self.assert_(uuid != uuid2)
         self.assert_(len(self.Server._uuids) == 998)
 
+    def testLocalUUIDS(self):
+        for algorithm in ('random', 'sequential', 'utc_random'):
+            server = Server(uuid_algorithm=algorithm)
+            uuids = [server.next_uuid() for i in range(1000)]
+            self.assert_(len(set(uuids)) == 1000)
+            self.assert_(all(len(uuid) == 32 for uuid in uuids))
+            self.assert_(len(server._uuids) == 0)
+
+        server = Server(uuid_algorithm='sequential')
+        uuids = [server.next_uuid() for i in range(1000)]
+        self.assert_(uuids == sorted(uuids) or
+                len(set(uuid[:26] for uuid in uuids)) > 1)
+        self.assertRaises(ValueError, Server, uuid_algorithm='unknown')
+
+        db = Server(uuid_algorithm='utc_random').create_db('couchdbkit_test')
+        doc = {}
+        db.save_doc(doc)
+        docs = [{}, {}]
+        db.save_docs(docs)
+        self.assert_(doc['_id'] < docs[0]['_id'])
+        self.assert_(len(db.server._uuids) == 0)
+        del self.Server['couchdbkit_test']
+
+    def testCluster(self):
+        from couchdbkit.cluster import Cluster
+        cluster = Cluster(['http://127.0.0.1:5984', 'http://localhost:5984'],
+                health_check_interval=None)
+        server = Server(cluster)
+        self.assert_(server.uri == 'http://127.0.0.1:5984')
+        db = server.create_db('couchdbkit_test')
+        for i in range(4):
+            db.save_doc({'_id': 'test%s' % i})
+        self.assert_(len(db.view('_all_docs').all()) == 4)
+        stats = cluster.stats()
+        self.assert_(stats['http://127.0.0.1:5984']['requests'] > 2)
+        self.assert_(stats['http://localhost:5984']['requests'] > 2)
+        self.assert_(all(node['outstanding'] == 0 for node in stats.values()))
+
+        # a node down is taken out, reads are sent again to another node
+        server = Server(Cluster(['http://127.0.0.1:5984',
+            'http://127.0.0.1:5989', 'http://localhost:5984'],
+            strategy='least_outstanding', health_check_interval=None))
+        db = server['couchdbkit_test']
+        for i in range(6):
+            self.assert_(db.open_doc('test1')['_id'] == 'test1')
+        down = server.cluster.nodes[1]
+        self.assert_(not down.healthy and down.failures == 1)
+        self.assert_(not server.cluster.check(down))
+        self.assert_(server.cluster.check(server.cluster.nodes[0]))
+        self.assertRaises(ValueError, Cluster, [])
+
+        # a cluster created by the server gets its transport options and
+        # is closed with it
+        with Server(['http://127.0.0.1:5984', 'http://localhost:5984'],
+                timeout=5, compress=True) as server:
+            self.assert_(server.cluster.client_opts == {'timeout': 5})
+            self.assert_(server['couchdbkit_test'].doc_exist('test1'))
+            checker = server.cluster._checker
+        self.assert_(not checker.is_alive())
+        del self.Server['couchdbkit_test']
+
+    def testHedging(self):
+        from couchdbkit.cluster import Cluster, Hedging
+        hedging = Hedging(delay=0)
+        server = Server(Cluster(['http://127.0.0.1:5984',
+            'http://localhost:5984'], health_check_interval=None),
+            hedging=hedging)
+        db = server.create_db('couchdbkit_test')
+        db.save_doc({'_id': 'test'})
+        for i in range(5):
+            self.assert_(db.open_doc('test')['_id'] == 'test')
+        stats = hedging.stats()
+        self.assert_(stats['requests'] >= 5)
+        self.assert_(stats['hedged'] > 0)
+        self.assert_(stats['delay'] == 0)
+        # the slowest requests end in the background
+        for i in range(50):
+            if all(node['outstanding'] == 0 for node in
+                    server.cluster.stats().values()):
+                break
+            time.sleep(0.02)
+        self.assert_(all(node['outstanding'] == 0 for node in
+            server.cluster.stats().values()))
+
+        # feeds, attachments and streamed views aren't hedged
+        db.put_attachment(db.open_doc('test'), 'hello', 'hello.txt')
+        requests = hedging.stats()['requests']
+        db.fetch_attachment('test', 'hello.txt')
+        [row for row in db.all_docs(stream=True)]
+        db.res.get('test', hedge=False)
+        self.assert_(hedging.stats()['requests'] == requests)
+        self.assert_(not hedging.hedges('GET', '/couchdbkit_test/_changes',
+            {}, {}))
+        self.assert_(hedging.hedges('GET', '/couchdbkit_test/test', {}, {}))
+        self.assert_(not hedging.hedges('GET', '/couchdbkit_test/test',
+            {'attachments': 'true'}, {}))
+
+        # without an idle worker the request is sent by the caller
+        hedging = Hedging(delay=0, max_workers=0)
+        db.res.hedging = hedging
+        self.assert_(db.open_doc('test')['_id'] == 'test')
+        self.assert_(hedging.stats()['requests'] == 1)
+        self.assert_(hedging.stats()['hedged'] == 0)
+
+        # the latency of a request won by the hedge counts from the first
+        # attempt
+        class Response(object):
+            def close(self):
+                pass
+        calls = []
+        def send():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.3)
+            return Response()
+        hedging = Hedging(delay=0.1)
+        hedging.run(send)
+        self.assert_(hedging.stats()['hedge_wins'] == 1)
+        self.assert_(hedging._latencies[-1] >= 0.1)
+
+        # the delay is a percentile of the previous latencies
+        hedging = Hedging(percentile=50, min_samples=3)
+        self.assert_(hedging.delay() is None)
+        for latency in (0.3, 0.1, 0.2):
+            hedging.record(latency)
+        self.assert_(hedging.delay() == 0.2)
+        del self.Server['couchdbkit_test']
+
+    def testJsonCodec(self):
+        import couchdbkit
+        from couchdbkit.jsoncodec import JsonCodec
+
+        class CountingCodec(JsonCodec):
+            calls = 0
+
+            def loads(self, data):
+                self.calls += 1
+                return JsonCodec.loads(self, data)
+
+        codec = JsonCodec()
+        self.assert_(codec.dumps({"a": u"\xe9"}) == '{"a":"\\u00e9"}')
+        self.assert_(codec.loads(memoryview('{"a":1}')) == {"a": 1})
+        self.assert_(codec.loads(bytearray('[1]')) == [1])
+        self.assertRaises(ValueError, couchdbkit.get_json_codec, 'unknown')
+
+        counting = CountingCodec()
+        couchdbkit.register_json_codec('counting', counting)
+        server = Server(json_codec='counting')
+        db = server.create_db('couchdbkit_test')
+        doc = {"_id": "test", "value": u"\xe9t\xe9"}
+        db.save_doc(doc)
+        self.assert_(db.open_doc("test")['value'] == doc['value'])
+        self.assert_(list(db.view('_all_docs', stream=True))[0]['id'] == "test")
+        self.assert_(counting.calls >= 4)
+
+        # the default codec isn't changed
+        calls = counting.calls
+        self.Server.get_db('couchdbkit_test').open_doc("test")
+        self.assert_(counting.calls == calls)
+
+        default = couchdbkit.get_json_codec()
+        try:
+            couchdbkit.set_json_codec(counting)
+            self.Server.get_db('couchdbkit_test').open_doc("test")
+            self.assert_(counting.calls == calls + 1)
+        finally:
+            couchdbkit.set_json_codec(default)
+        del self.Server['couchdbkit_test']
+
 class ClientDatabaseTestCase(unittest.TestCase):
     def setUp(self):
         self.couchdb = CouchdbResource()
@@ -180,6 +354,149 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_( "_design/a" in db)
         del self.Server['couchdbkit_test']
 
+    def testOpenDocs(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_docs([{'_id': 'test%s' % i, 'number': i} for i in range(10)])
+        db.delete_doc('test3')
+
+        ids = ['test5', 'missing', 'test1', 'test3', 'test5']
+        docs = db.open_docs(ids)
+        self.assert_(len(docs) == 5)
+        self.assert_(docs[1] is None and docs[3] is None)
+        self.assert_([docs[0]['number'], docs[2]['number'],
+            docs[4]['number']] == [5, 1, 5])
+        # repeated ids get their own copy
+        self.assert_(docs[0] == docs[4] and docs[0] is not docs[4])
+        docs[0]['number'] = 6
+        self.assert_(docs[4]['number'] == 5)
+        docs = db.open_docs(['test1', 'test1'], wrapper=lambda doc: doc)
+        self.assert_(docs[0] is not docs[1])
+
+        ids = ['test%s' % i for i in range(10)]
+        docs = db.open_docs(ids, batch_size=3, concurrency=2)
+        self.assert_([doc and doc['_id'] for doc in docs] ==
+                ids[:3] + [None] + ids[4:])
+        # batches reuse the shared worker threads
+        workers = lambda: len([t for t in threading.enumerate()
+            if t.name == "couchdbkit-worker"])
+        started = workers()
+        db.open_docs(ids, batch_size=3, concurrency=2)
+        self.assert_(workers() == started)
+        self.assert_(db.open_docs([]) == [])
+        del self.Server['couchdbkit_test']
+
+    def testDocLoader(self):
+        from couchdbkit.loader import DocLoader
+        from couchdbkit.utils import concurrent_map
+
+        loader = DocLoader(window=0.2, max_batch=8)
+        db = self.Server.create_db('couchdbkit_test', loader=loader)
+        db.save_docs([{'_id': 'test%s' % i, 'number': i} for i in range(10)])
+        db.delete_doc('test3')
+
+        def open_doc(docid):
+            try:
+                return db.open_doc(docid)
+            except ResourceNotFound, e:
+                return str(e)
+
+        ids = ['test5', 'missing', 'test1', 'test3', 'test5', 'test2']
+        docs = concurrent_map(open_doc, ids, concurrency=len(ids))
+        self.assert_([docs[0]['number'], docs[2]['number'], docs[4]['number'],
+            docs[5]['number']] == [5, 1, 5, 2])
+        self.assert_(docs[1] == "missing" and docs[3] == "deleted")
+        self.assert_(docs[0] is not docs[4])
+        self.assert_(loader.stats() == {'calls': 6, 'batches': 1})
+
+        ids = ['test%s' % i for i in range(10) if i != 3]
+        docs = concurrent_map(db.open_doc, ids, concurrency=len(ids))
+        self.assert_([doc['_id'] for doc in docs] == ids)
+        self.assert_(loader.stats()['batches'] == 3)
+
+        # params bypass the loader
+        self.assert_(db.open_doc('test1', rev=docs[1]['_rev'])['number'] == 1)
+        self.assert_(loader.stats()['calls'] == 15)
+        del self.Server['couchdbkit_test']
+
+    def testRoutedDatabase(self):
+        from couchdbkit.routing import RoutedDatabase
+        primary = self.Server.create_db('couchdbkit_test')
+        replica = self.Server.create_db('couchdbkit_test2')
+        replica.save_doc({'_id': 'replicated'})
+
+        db = RoutedDatabase(primary, [replica])
+        doc = {'_id': 'test'}
+        db.save_doc(doc)
+        self.assert_(primary.doc_exist('test'))
+        self.assert_(not replica.doc_exist('test'))
+        self.assertRaises(ResourceNotFound, db.open_doc, 'test')
+        self.assert_(db.open_doc('replicated')['_id'] == 'replicated')
+        self.assert_([row['id'] for row in db.all_docs()] == ['replicated'])
+        self.assert_(db.info()['db_name'] == 'couchdbkit_test')
+
+        # read your writes
+        db = RoutedDatabase(primary.uri, [replica.uri], read_your_writes=0.5)
+        session = db.session()
+        self.assert_('test' not in session)
+        session.save_doc({'_id': 'test2'})
+        self.assert_(session.open_doc('test2')['_id'] == 'test2')
+        self.assert_('test' in session)
+        self.assert_('test' not in db)
+        time.sleep(0.5)
+        self.assert_('test' not in session)
+        self.assert_(session.docs_exist(['test', 'replicated']) ==
+                {'test': 'missing', 'replicated': 'exists'})
+        self.assert_(session.get_revs(['test']) == {})
+
+        # failed writes don't send reads to the primary
+        session = db.session()
+        self.assertRaises(ResourceConflict, session.save_doc,
+                {'_id': 'test'})
+        self.assert_(session.last_write is None)
+
+        # batches of a writer do
+        with session.writer() as writer:
+            writer.save_doc({'_id': 'test3'})
+        self.assert_(session.last_write is not None)
+        self.assert_(session.get_revs(['test3']).keys() == ['test3'])
+        del self.Server['couchdbkit_test2']
+        del self.Server['couchdbkit_test']
+
+    def testDocumentCache(self):
+        db = self.Server.get_or_create_db('couchdbkit_test',
+                cache=LRUCache(size=2))
+        doc = {'_id': 'test', 'number': 1}
+        db.save_doc(doc)
+        db.cache.clear()
+
+        doc1 = db.open_doc('test')
+        doc2 = db.open_doc('test')
+        self.assert_(doc1 == doc2)
+        doc2['number'] = 2
+        self.assert_(db.open_doc('test')['number'] == 1)
+        self.assert_(db.cache.stats() == {'hits': 2, 'misses': 1,
+            'revalidations': 0, 'size': 1})
+
+        # updated by another client
+        db2 = self.Server['couchdbkit_test']
+        db2.save_doc(doc2)
+        self.assert_(db.open_doc('test')['number'] == 2)
+        self.assert_(db.cache.revalidations == 1)
+
+        # writes update the cache
+        db.save_doc(doc2)
+        self.assert_(db.cache.get('test')[0] == doc2['_rev'])
+        db.delete_doc(doc2)
+        self.assert_('test' not in db.cache)
+        self.assertRaises(ResourceNotFound, db.open_doc, 'test')
+
+        # lru
+        for i in range(3):
+            db.save_doc({'_id': 'test%s' % i})
+        self.assert_(len(db.cache) == 2)
+        self.assert_('test0' not in db.cache)
+        del self.Server['couchdbkit_test']
+
     def testGetRev(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = {}
@@ -187,6 +504,32 @@ class ClientDatabaseTestCase(unittest.TestCase):
         rev = db.get_rev(doc['_id'])
         self.assert_(rev == doc['_rev'])
 
+    def testDocsExist(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_docs([{'_id': 'test%s' % i} for i in range(5)])
+        db.delete_doc('test4')
+        ids = ['test%s' % i for i in range(6)]
+        self.assert_(db.docs_exist(ids) == {'test0': 'exists',
+            'test1': 'exists', 'test2': 'exists', 'test3': 'exists',
+            'test4': 'deleted', 'test5': 'missing'})
+
+        batches = list(db.iter_docs_exist(iter(ids), batch_size=4,
+            concurrency=2))
+        self.assert_([sorted(batch) for batch in batches] ==
+                [ids[:4], ids[4:]])
+        self.assert_(batches[1]['test4'] == 'deleted')
+        del self.Server['couchdbkit_test']
+
+    def testGetRevs(self):
+        db = self.Server.create_db('couchdbkit_test')
+        docs = [{'_id': 'test%s' % i} for i in range(5)]
+        db.save_docs(docs)
+        db.delete_doc('test4')
+        revs = db.get_revs(['test%s' % i for i in range(6)], chunk_size=2)
+        self.assert_(revs == dict((doc['_id'], doc['_rev'])
+            for doc in docs[:4]))
+        del self.Server['couchdbkit_test']
+
     def testForceUpdate(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = {}
@@ -374,6 +717,106 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_(len(attachment2) == doc2['_attachments']['test2.html']['length'])
         del self.Server['couchdbkit_test']
 
+    def testMultipartAttachments(self):
+        db = self.Server.create_db('couchdbkit_test')
+        import StringIO
+        attachment = "<html><head><title>test attachment</title></head><body><p>Some words</p></body></html>"
+        doc = {
+            '_id': "docwithattachment",
+            "f": "value for f",
+            "_attachments": {
+                "test.html": {
+                    "content_type": "text/html",
+                    "data": StringIO.StringIO(attachment)
+                },
+                "test.txt": {
+                    "content_type": "text/plain",
+                    "data": "some text"
+                }
+            }
+        }
+        db.save_doc(doc)
+        self.assert_(doc['_attachments']['test.html'].get('stub'))
+        self.assert_('data' not in doc['_attachments']['test.html'])
+        self.assert_(attachment == db.fetch_attachment(doc, "test.html"))
+        self.assert_("some text" == db.fetch_attachment(doc, "test.txt"))
+
+        # update with a conflict: the body is sent again
+        doc2 = {
+            '_id': "docwithattachment",
+            "_attachments": {
+                "test.html": {
+                    "content_type": "text/html",
+                    "data": "updated"
+                }
+            }
+        }
+        db.save_doc(doc2, force_update=True, multipart=True)
+        self.assert_(doc2['_rev'] != doc['_rev'])
+        self.assert_("updated" == db.fetch_attachment(doc2, "test.html"))
+        del self.Server['couchdbkit_test']
+
+    def testOpenDocMultipart(self):
+        db = self.Server.create_db('couchdbkit_test')
+        html = "<html><body><p>Some words</p></body></html>"
+        text = "some text " * 100
+        doc = {
+            '_id': "docwithattachment",
+            "_attachments": {
+                "test.html": {"content_type": "text/html", "data": html},
+                "test.txt": {"content_type": "text/plain", "data": text},
+                "sub/test.js": {"content_type": "text/javascript",
+                    "data": "var a;"}
+            }
+        }
+        db.save_doc(doc, multipart=True)
+
+        doc1 = db.open_doc("docwithattachment", multipart=True)
+        self.assert_(doc1['_rev'] == doc['_rev'])
+        atts = doc1['_attachments']
+        # read out of order
+        self.assert_(atts['test.txt']['data'].read() == text)
+        self.assert_(atts['test.html']['data'].read(5) == html[:5])
+        self.assert_(atts['test.html']['data'].read() == html[5:])
+        self.assert_(atts['sub/test.js']['data'].read() == "var a;")
+
+        path = tempfile.mkdtemp()
+        try:
+            doc2 = db.open_doc("docwithattachment", attachments_dir=path)
+            att = doc2['_attachments']['sub/test.js']
+            self.assert_(att['stub'])
+            self.assert_(att['path'] == os.path.join(path, 'sub', 'test.js'))
+            with open(att['path'], 'rb') as f:
+                self.assert_(f.read() == "var a;")
+            with open(doc2['_attachments']['test.txt']['path'], 'rb') as f:
+                self.assert_(f.read() == text)
+        finally:
+            shutil.rmtree(path)
+
+        doc3 = db.open_doc("docwithattachment", multipart=True)
+        for att in doc3['_attachments'].values():
+            att['data'].close()
+        self.assert_(db.open_doc("docwithattachment")['_rev'] == doc['_rev'])
+        del self.Server['couchdbkit_test']
+
+    def testMultipartPartsOrder(self):
+        from StringIO import StringIO
+        from couchdbkit.multipart import MultipartWriter, MultipartReader
+        doc = {'_id': 'test', '_attachments': {
+            'a.txt': {'content_type': 'text/plain', 'data': 'aaa'},
+            u'b "\xe9".txt': {'content_type': 'text/plain', 'data': 'bb'}
+        }}
+        body = MultipartWriter(doc, boundary='abc').read()
+        self.assert_('filename="b \\"\xc3\xa9\\".txt"' in body)
+
+        # parts are matched by filename, not by the order of the stubs
+        parts = body.split('\r\n--abc')
+        body = '\r\n--abc'.join([parts[0], parts[2], parts[1]] + parts[3:])
+        reader = MultipartReader(StringIO(body), 'abc')
+        atts = reader.doc['_attachments']
+        self.assert_(atts['a.txt']['data'].read() == 'aaa')
+        self.assert_(atts[u'b "\xe9".txt']['data'].read() == 'bb')
+
     def testAttachments(self):
         db = self.Server.create_db('couchdbkit_test')
         doc = { 'string': 'test', 'number': 4 }
@@ -481,6 +924,142 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_(doc['number'] == 42)
         del self.Server['couchdbkit_test']
 
+    def testSaveDocsChunked(self):
+        db = self.Server.create_db('couchdbkit_test')
+        docs = [{'number': i} for i in range(25)]
+        docs.append({'_id': 'test', 'number': 25})
+        results = db.save_docs(docs, chunk_size=4, concurrency=3)
+        self.assert_(len(results) == 26)
+        self.assert_(len(db) == 26)
+        self.assert_([res['id'] for res in results] ==
+                [doc['_id'] for doc in docs])
+        self.assert_(db.get('test')['_rev'] == docs[-1]['_rev'])
+
+        docs[3].pop('_rev')
+        docs[20].pop('_rev')
+        all_errors = []
+        try:
+            db.save_docs(docs, chunk_size=4, concurrency=3)
+        except BulkSaveError, e:
+            all_errors = e.errors
+            self.assert_(len(e.results) == 26)
+
+        self.assert_([error['id'] for error in all_errors] ==
+                [docs[3]['_id'], docs[20]['_id']])
+        self.assert_(db.get(docs[4]['_id'])['_rev'] == docs[4]['_rev'])
+        del self.Server['couchdbkit_test']
+
+    def testSaveDocsForceUpdate(self):
+        db = self.Server.create_db('couchdbkit_test')
+        docs = [{'_id': 'test%s' % i, 'number': i} for i in range(5)]
+        db.save_docs(docs)
+        stale = [dict(doc, number=10) for doc in docs]
+        db.save_docs(docs[:2])
+        db.delete_doc('test1')
+
+        db.save_docs(stale, chunk_size=2, force_update=True)
+        self.assert_(all(db.get(doc['_id'])['number'] == 10
+            for doc in docs))
+        self.assert_(db.get('test0')['_rev'].startswith('3-'))
+        self.assert_(db.get('test2')['_rev'].startswith('2-'))
+        del self.Server['couchdbkit_test']
+
+    def testUpdateDoc(self):
+        db = self.Server.create_db('couchdbkit_test')
+
+        def incr(doc):
+            doc['count'] = doc.get('count', 0) + 1
+        self.assertRaises(ResourceNotFound, db.update_doc, 'counter', incr)
+        doc = db.update_doc('counter', incr, create=True)
+        self.assert_(doc['count'] == 1)
+
+        calls = []
+        def incr_with_conflict(doc):
+            if not calls:
+                # a concurrent change
+                db.update_doc('counter', incr)
+            calls.append(doc['count'])
+            doc['count'] += 1
+        doc = db.update_doc('counter', incr_with_conflict)
+        self.assert_(calls == [1, 2])
+        self.assert_(db.get('counter')['count'] == 3)
+        self.assert_(db.get('counter')['_rev'] == doc['_rev'])
+
+        def always_conflict(doc):
+            db.update_doc('counter', incr)
+            return doc
+        self.assertRaises(ResourceConflict, db.update_doc, 'counter',
+                always_conflict, max_retries=2, backoff=0)
+        self.assert_(db.update_stats() == {'updates': 6, 'conflicts': 4,
+            'retries': 3, 'failures': 1})
+        del self.Server['couchdbkit_test']
+
+    def testUpdateDocs(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_docs([{'_id': 'test%s' % i, 'count': i} for i in range(4)])
+
+        calls = []
+        def incr(doc):
+            if not calls:
+                db.update_doc('test2', lambda doc: dict(doc, count=10))
+            calls.append(doc['_id'])
+            doc['count'] += 1
+        results = db.update_docs(['test%s' % i for i in range(4)], incr)
+        self.assert_([res['id'] for res in results] ==
+                ['test%s' % i for i in range(4)])
+        self.assert_(calls == ['test0', 'test1', 'test2', 'test3', 'test2'])
+        self.assert_([db.get('test%s' % i)['count'] for i in range(4)] ==
+                [1, 2, 11, 4])
+
+        stats = db.update_stats()
+        try:
+            db.update_docs(['test0', 'missing'], incr)
+        except BulkSaveError, e:
+            self.assert_([error['id'] for error in e.errors] == ['missing'])
+        else:
+            self.fail("BulkSaveError not raised")
+        self.assert_(db.get('test0')['count'] == 2)
+        self.assert_(db.update_stats()['updates'] == stats['updates'] + 1)
+        self.assert_(db.update_stats()['failures'] == stats['failures'] + 1)
+        del self.Server['couchdbkit_test']
+
+    def testWriter(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_doc({'_id': 'conflict'})
+        with db.writer(max_batch=10, max_delay=0.05, max_queue=20) as writer:
+            docs = [{'number': i} for i in range(25)]
+            futures = [writer.save_doc(doc) for doc in docs]
+            conflict = writer.save_doc({'_id': 'conflict'})
+            writer.flush()
+            self.assert_(all(future.ready() for future in futures))
+
+            # sent after max_delay
+            late = writer.save_doc({'_id': 'late'})
+            self.assert_(late.get(timeout=5)['id'] == 'late')
+
+            last = writer.save_doc({'_id': 'last'})
+
+        self.assert_(last.get()['rev'] == db.get('last')['_rev'])
+        self.assert_([future.get()['rev'] for future in futures] ==
+                [doc['_rev'] for doc in docs])
+        self.assertRaises(ResourceConflict, conflict.get)
+        self.assert_(writer.stats()['docs'] == 27)
+        self.assert_(writer.stats()['errors'] == 1)
+        self.assert_(writer.stats()['batches'] >= 4)
+        self.assertRaises(ValueError, writer.save_doc, {})
+
+        # callbacks run in the writer thread, which can't wait for itself
+        errors = []
+        def callback(future):
+            try:
+                writer.flush()
+            except RuntimeError, e:
+                errors.append(e)
+        with db.writer() as writer:
+            writer.save_doc({}).add_done_callback(callback)
+        self.assert_(len(errors) == 1)
+        del self.Server['couchdbkit_test']
+
     def testDeleteMultipleDocs(self):
         db = self.Server.create_db('couchdbkit_test')
         docs = [
@@ -668,6 +1247,129 @@ class ClientViewTestCase(unittest.TestCase):
 
         del self.Server['couchdbkit_test']
 
+    def testViewStream(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_docs([{'_id': 'test%s' % i, 'number': i} for i in range(10)])
+
+        results = db.all_docs(stream=True, include_docs=True)
+        rows = list(results)
+        self.assert_(len(rows) == 10)
+        self.assert_(results.total_rows == 10)
+        self.assert_(results.offset == 0)
+        self.assert_([row['doc']['number'] for row in rows] == range(10))
+        self.assert_(list(results(limit=2)) == rows[:2])
+        self.assert_(list(db.all_docs().iter_stream()) ==
+                db.all_docs().all())
+
+        # keys aren't lost after the first request
+        results = db.all_docs(stream=True, keys=['test1', 'test3'])
+        self.assert_([row['id'] for row in results] == ['test1', 'test3'])
+        self.assert_([row['id'] for row in results] == ['test1', 'test3'])
+        results = db.all_docs(keys=['test1', 'test3'])
+        self.assert_(len(results.fetch_raw().json_body['rows']) == 2)
+        self.assert_(len(results.fetch_raw().json_body['rows']) == 2)
+        del self.Server['couchdbkit_test']
+
+    def testViewCache(self):
+        db = self.Server.get_or_create_db('couchdbkit_test',
+                view_cache=LRUCache())
+        db.save_docs([{'_id': 'test%s' % i} for i in range(5)])
+
+        rows = db.all_docs().all()
+        self.assert_(db.all_docs().all() == rows)
+        self.assert_(db.view_cache.stats() == {'hits': 1, 'misses': 1,
+            'revalidations': 0, 'size': 1})
+        self.assert_(len(db.all_docs(limit=2)) == 2)
+        self.assert_(db.view_cache.misses == 2)
+
+        db.save_doc({'_id': 'test5'})
+        self.assert_(len(db.all_docs()) == 6)
+        self.assert_(db.view_cache.revalidations == 1)
+        del self.Server['couchdbkit_test']
+
+    def testViewExplain(self):
+        import logging
+
+        class Handler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        handler = Handler()
+        logger = logging.getLogger('couchdbkit.slow_query')
+        logger.addHandler(handler)
+        try:
+            db = self.Server.create_db('couchdbkit_test')
+            db.save_docs([{'_id': 'test%s' % i} for i in range(5)])
+
+            results = db.all_docs(include_docs=True)
+            self.assert_(results.explain() is None)
+            self.assert_(len(results.all()) == 5)
+            info = results.explain()
+            self.assert_(info['path'] == '_all_docs')
+            self.assert_(info['params'] == {'include_docs': True})
+            self.assert_(info['rows'] == 5)
+            self.assert_(not info['cached'])
+            for phase in ('request', 'download', 'decode', 'wrap'):
+                self.assert_(info[phase] >= 0)
+            self.assert_(abs(info['total'] - (info['request'] +
+                info['download'] + info['decode'] + info['wrap'])) < 1e-9)
+
+            results = db.all_docs(stream=True)
+            self.assert_(len(list(results)) == 5)
+            self.assert_(results.explain()['rows'] == 5)
+            self.assert_(not handler.records)
+
+            # every query is slower than 0 seconds
+            db = self.Server.get_db('couchdbkit_test',
+                    slow_query_threshold=0)
+            db.all_docs(limit=2).all()
+            self.assert_(len(handler.records) == 1)
+            record = handler.records[0]
+            self.assert_(record.view_query['rows'] == 2)
+            self.assert_(record.view_query['params'] == {'limit': 2})
+            db.all_docs(limit=0).count()
+            self.assert_(len(handler.records) == 2)
+
+            # stopped iterations are logged too
+            for row in db.all_docs():
+                break
+            self.assert_(len(handler.records) == 3)
+
+            # iterating cached rows again keeps the timing of the execution
+            results = db.all_docs(include_docs=True)
+            results.all()
+            wrap = results.explain()['wrap']
+            results.all()
+            self.assert_(results.explain()['wrap'] == wrap)
+            self.assert_(len(handler.records) == 4)
+        finally:
+            logger.removeHandler(handler)
+        del self.Server['couchdbkit_test']
+
+    def testPaginate(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_docs([{'_id': 'test%02d' % i} for i in range(10)])
+
+        pages = list(db.all_docs().paginate(4))
+        self.assert_([len(rows) for rows, cursor in pages] == [4, 4, 2])
+        self.assert_(pages[-1][1] is None)
+        ids = [row['id'] for rows, cursor in pages for row in rows]
+        self.assert_(ids == ['test%02d' % i for i in range(10)])
+
+        # resume from the cursor of the first page
+        rows, cursor = db.all_docs().paginate(4, cursor=pages[0][1]).next()
+        self.assert_(rows == pages[1][0])
+        self.assertRaises(ValueError,
+                db.all_docs().paginate(4, cursor="invalid").next)
+
+        ids = [row['id'] for row in db.iter_all_docs(batch=3)]
+        self.assert_(ids == ['test%02d' % i for i in range(10)])
+        del self.Server['couchdbkit_test']
+
     def testCount(self):
         db = self.Server.create_db('couchdbkit_test')
         # save 2 docs
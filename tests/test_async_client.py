@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+#
+__author__ = 'benoitc@e-engura.com (Benoît Chesneau)'
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import gevent
+    from couchdbkit.async_client import AsyncServer, AsyncDatabase
+except ImportError:
+    gevent = None
+
+from couchdbkit import *
+
+
+@unittest.skipIf(gevent is None, "gevent isn't installed")
+class AsyncClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = AsyncServer()
+        self.db = self.server.create_db('couchdbkit_test').get()
+
+    def tearDown(self):
+        try:
+            self.server.delete_db('couchdbkit_test').get()
+        except:
+            pass
+
+    def testCreateDb(self):
+        self.assert_(isinstance(self.db, AsyncDatabase))
+        self.assert_('couchdbkit_test' in self.server.all_dbs().get())
+        # the socket module is patched by the application, not by the client
+        from gevent import monkey
+        self.assert_(not monkey.is_module_patched('socket'))
+
+    def testSaveAndOpenDocs(self):
+        docs = [{'_id': 'test%s' % i, 'i': i} for i in range(10)]
+        jobs = [self.db.save_doc(doc) for doc in docs]
+        gevent.joinall(jobs)
+        for doc in docs:
+            self.assert_('_rev' in doc)
+
+        jobs = [self.db.open_doc(doc['_id']) for doc in docs]
+        gevent.joinall(jobs)
+        self.assert_([job.value['i'] for job in jobs] == range(10))
+
+    def testDocLoader(self):
+        from couchdbkit.loader import DocLoader
+        loader = DocLoader(window=0.05, green=True)
+        db = self.server.get_db('couchdbkit_test', loader=loader)
+        db.save_docs([{'_id': 'test%s' % i, 'i': i} for i in range(10)]).get()
+
+        jobs = [db.open_doc('test%s' % (i % 5)) for i in range(10)]
+        gevent.joinall(jobs)
+        self.assert_([job.value['i'] for job in jobs] == range(5) * 2)
+        self.assert_(loader.stats() == {'calls': 10, 'batches': 1})
+        self.assertRaises(ResourceNotFound, db.open_doc('missing').get)
+
+    def testErrors(self):
+        self.assertRaises(ResourceNotFound, self.db.open_doc('missing').get)
+        doc = {'_id': 'test'}
+        self.db.save_doc(doc).get()
+        self.assertRaises(ResourceConflict,
+                self.db.save_doc({'_id': 'test'}).get)
+
+    def testView(self):
+        self.db.save_docs([{'_id': 'test%s' % i} for i in range(5)]).get()
+        results = self.db.all_docs()
+        self.assert_(results.count().get() == 5)
+        self.assert_([row['id'] for row in results] ==
+                ['test%s' % i for i in range(5)])
+        self.assert_(len(results(limit=2).all().get()) == 2)
+
+        # rows are streamed in the pool, stopping early frees it
+        rows = iter(results)
+        self.assert_(rows.next()['id'] == 'test0')
+        rows.close()
+        gevent.sleep(0)
+        self.assert_(self.server.pool.free_count() == self.server.pool.size)
+        missing = self.server.get_db('couchdbkit_missing').all_docs()
+        self.assertRaises(ResourceNotFound, list, iter(missing))
+
+    def testAttachments(self):
+        doc = {'_id': 'test'}
+        self.db.save_doc(doc).get()
+        self.assert_(self.db.put_attachment(doc, "hello", "hello.txt").get())
+        content = self.db.fetch_attachment(doc, "hello.txt").get()
+        self.assert_(content == "hello")
+
+
+if __name__ == '__main__':
+    unittest.main()
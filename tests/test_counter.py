@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+#
+
+import threading
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from couchdbkit import *
+from couchdbkit.counter import ShardedCounter, CounterShard, map_total
+from couchdbkit.memory import MemoryBackend, MemoryResource
+
+
+class ShardedCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        backend = MemoryBackend()
+        backend.add_view("counters/total", map_total, "_sum")
+        server = Server(resource_instance=MemoryResource(backend=backend))
+        self.db = server.create_db("couchdbkit_test")
+        ShardedCounter.push_design(self.db)
+
+    def testPushDesign(self):
+        ddoc = self.db.open_doc("_design/counters")
+        self.assert_(ddoc['views']['total']['reduce'] == "_sum")
+
+    def testIncrement(self):
+        counter = ShardedCounter("views", self.db, shards=4)
+        other = ShardedCounter("other", self.db, shards=4)
+        self.assert_(counter.value() == 0)
+        for i in range(20):
+            counter.increment()
+        other.increment(5)
+        counter.decrement(2)
+        self.assert_(counter.value() == 18)
+        self.assert_(other.value() == 5)
+
+        shards = self.db.view("_all_docs", startkey="counter.views.",
+                endkey=u"counter.views.\ufff0", include_docs=True,
+                schema=CounterShard).all()
+        self.assert_(1 < len(shards) <= 4)
+        self.assert_(sum(shard.count for shard in shards) == 18)
+
+    def testConcurrentIncrements(self):
+        counter = ShardedCounter("views", self.db, shards=2, pick="thread",
+                backoff=0)
+        # another writer of the same shards
+        stale = ShardedCounter("views", self.db, shards=2, pick="thread")
+
+        def run(counter):
+            for i in range(25):
+                counter.increment()
+        threads = [threading.Thread(target=run, args=(c, ))
+                for c in (counter, counter, stale, stale)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assert_(counter.value() == 100)
+
+    def testCache(self):
+        counter = ShardedCounter("views", self.db, cache_ttl=60)
+        counter.increment()
+        self.assert_(counter.value() == 1)
+        ShardedCounter("views", self.db).increment()
+        # cached, with the increments of this object
+        counter.increment()
+        self.assert_(counter.value() == 2)
+        counter.cache_ttl = 0
+        self.assert_(counter.value() == 3)
+
+
+class ShardedCounterServerTestCase(unittest.TestCase):
+    """ the shipped design document, run by the CouchDB server """
+
+    def setUp(self):
+        self.Server = Server()
+        self.db = self.Server.create_db("couchdbkit_test")
+
+    def tearDown(self):
+        try:
+            del self.Server['couchdbkit_test']
+        except:
+            pass
+
+    def testValue(self):
+        ShardedCounter.push_design(self.db)
+        ddoc = self.db.open_doc("_design/counters")
+        self.assert_("emit(doc.counter, doc.count)" in
+                ddoc['views']['total']['map'])
+
+        counter = ShardedCounter("views", self.db, shards=4)
+        other = ShardedCounter("other", self.db, shards=4)
+        self.assert_(counter.value() == 0)
+        for i in range(10):
+            counter.increment()
+        other.increment(5)
+        counter.decrement(3)
+        self.assert_(counter.value() == 7)
+        self.assert_(other.value() == 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
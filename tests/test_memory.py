@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -
+#
+# This file is part of couchdbkit released under the MIT license.
+# See the NOTICE for more information.
+#
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from couchdbkit import *
+from couchdbkit.changes import ChangesStream
+from couchdbkit.memory import MemoryBackend, MemoryResource, collation_key
+
+BY_TYPE = """
+def fun(doc):
+    if 'type' in doc:
+        yield doc['type'], doc.get('score', 0)
+"""
+
+
+class MemoryBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.server = Server(resource_instance=MemoryResource(
+            backend=self.backend))
+        self.db = self.server.create_db("couchdbkit_test")
+
+    def testDatabases(self):
+        self.assert_("couchdbkit_test" in self.server)
+        self.assertEqual(self.server.all_dbs(), ["couchdbkit_test"])
+        self.assertRaises(PreconditionFailed, self.server.res.put,
+                "/couchdbkit_test/")
+        # resources created from the server share its backend
+        other = Server(resource_instance=self.server.res)
+        self.assert_("couchdbkit_test" in other)
+        self.server.delete_db("couchdbkit_test")
+        self.assertEqual(other.all_dbs(), [])
+
+    def testPrefix(self):
+        from couchdbkit.instrument import RequestStats
+        stats = RequestStats()
+        server = Server("http://127.0.0.1:5984/couchdb",
+                resource_instance=MemoryResource(backend=self.backend,
+                    hooks=[stats]))
+        db = server["couchdbkit_test"]
+        db.save_doc({"_id": "test"})
+        self.assertEqual(db.open_doc("test")["_id"], "test")
+        self.assertEqual(stats.stats()["GET doc"]["count"], 1)
+
+    def testResponse(self):
+        import restkit
+        from couchdbkit.memory import MemoryResponse
+        # MemoryResponse gives the restkit response constructor the parser
+        # methods of this version
+        self.assertEqual(restkit.version_info, (4, 2, 2))
+        resp = MemoryResponse('GET', "http://127.0.0.1:5984/db", 200,
+                {"Content-Type": "application/json"}, '{"ok": true}')
+        self.assertEqual(resp.status, "200 OK")
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers["content-length"], "12")
+        self.assertEqual(resp.final_url, "http://127.0.0.1:5984/db")
+        self.assertEqual(resp.json_body, {"ok": True})
+        self.assertRaises(restkit.errors.AlreadyRead, resp.body_string)
+        resp = MemoryResponse('HEAD', "http://127.0.0.1:5984/db", 200, {},
+                '{"ok": true}')
+        self.assertEqual(resp.body_string(), "")
+
+    def testDocuments(self):
+        doc = {"_id": "test", "value": 1}
+        self.db.save_doc(doc)
+        self.assert_(doc['_rev'].startswith("1-"))
+        doc['value'] = 2
+        self.db.save_doc(doc)
+        self.assert_(doc['_rev'].startswith("2-"))
+        self.assertEqual(self.db.open_doc("test")['value'], 2)
+        self.assertRaises(ResourceConflict, self.db.save_doc,
+                {"_id": "test"})
+
+        self.db.delete_doc(doc)
+        self.assertFalse(self.db.doc_exist("test"))
+        self.assertRaises(ResourceNotFound, self.db.open_doc, "test")
+        # deleted documents can be created again
+        self.db.save_doc({"_id": "test"})
+        self.assert_(self.db.doc_exist("test"))
+
+        self.db.copy_doc("test", "copy")
+        self.assert_(self.db.doc_exist("copy"))
+
+    def testConflicts(self):
+        doc = {"_id": "test", "value": 1}
+        self.db.save_doc(doc)
+        rev = doc['_rev']
+        self.db.save_doc({"_id": "test", "_rev": rev, "value": 2})
+        self.db.save_docs([{"_id": "test", "_rev": rev, "value": 3}],
+                all_or_nothing=True)
+
+        doc = self.db.open_doc("test", conflicts=True)
+        self.assertEqual(len(doc['_conflicts']), 1)
+        conflict = self.db.open_doc("test", rev=doc['_conflicts'][0])
+        self.assertNotEqual(conflict['value'], doc['value'])
+
+    def testUpdateDocsErrors(self):
+        self.db.save_docs([{'_id': 'a'}, {'_id': 'b'}])
+        def update(doc):
+            if doc['_id'] == 'b':
+                doc['_invalid'] = True
+        self.assertRaises(BulkSaveError, self.db.update_docs, ['a', 'b'],
+                update)
+        self.assertEqual(self.db.update_stats(), {"updates": 1,
+            "conflicts": 0, "retries": 0, "failures": 1})
+
+    def testBulkAndAllDocs(self):
+        docs = [{"_id": "doc%d" % i, "value": i} for i in range(5)]
+        self.db.save_docs(docs)
+        self.db.delete_doc("doc3")
+
+        rows = self.db.all_docs(include_docs=True).all()
+        self.assertEqual([row['id'] for row in rows],
+                ["doc0", "doc1", "doc2", "doc4"])
+        self.assertEqual(rows[1]['doc']['value'], 1)
+
+        rows = self.db.all_docs(startkey="doc1", limit=2).all()
+        self.assertEqual([row['id'] for row in rows], ["doc1", "doc2"])
+
+        rows = self.db.all_docs(keys=["doc1", "doc3", "missing"]).all()
+        self.assertEqual(rows[1]['value']['deleted'], True)
+        self.assertEqual(rows[2]['error'], "not_found")
+
+    def testChanges(self):
+        self.db.save_docs([{"_id": "doc%d" % i} for i in range(3)])
+        self.db.delete_doc("doc1")
+        changes = list(ChangesStream(self.db))
+        self.assertEqual([change['id'] for change in changes],
+                ["doc0", "doc2", "doc1"])
+        self.assert_(changes[-1]['deleted'])
+
+        changes = list(ChangesStream(self.db, since=changes[0]['seq']))
+        self.assertEqual(len(changes), 2)
+
+        changes = list(ChangesStream(self.db, filter="_doc_ids",
+            doc_ids=["doc2"]))
+        self.assertEqual([change['id'] for change in changes], ["doc2"])
+
+    def testAttachments(self):
+        doc = {"_id": "test"}
+        self.db.save_doc(doc)
+        self.db.put_attachment(doc, "hello", "hello.txt", "text/plain")
+        self.assertEqual(self.db.fetch_attachment("test", "hello.txt"),
+                "hello")
+
+        doc = self.db.open_doc("test")
+        self.assert_(doc['_attachments']['hello.txt']['stub'])
+        # stubs are kept when the document is saved again
+        doc['value'] = 1
+        self.db.save_doc(doc)
+        self.assertEqual(self.db.fetch_attachment("test", "hello.txt"),
+                "hello")
+
+        doc = self.db.open_doc("test", multipart=True)
+        self.assertEqual(doc['_attachments']['hello.txt']['data'].read(),
+                "hello")
+
+        self.db.delete_attachment(self.db.open_doc("test"), "hello.txt")
+        self.assertRaises(ResourceNotFound, self.db.fetch_attachment,
+                "test", "hello.txt")
+
+    def testViews(self):
+        design = {
+            "_id": "_design/test",
+            "language": "python",
+            "views": {
+                "by_type": {"map": BY_TYPE, "reduce": "_sum"}
+            }
+        }
+        self.db.save_doc(design)
+        self.db.save_docs([
+            {"type": "post", "score": 1},
+            {"type": "post", "score": 2},
+            {"type": "comment", "score": 4}])
+
+        self.assertEqual(self.db.view("test/by_type").first()['value'], 7)
+        rows = self.db.view("test/by_type", group=True).all()
+        self.assertEqual([(row['key'], row['value']) for row in rows],
+                [("comment", 4), ("post", 3)])
+
+        rows = self.db.view("test/by_type", key="post", reduce=False,
+                include_docs=True).all()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['doc']['type'], "post")
+
+        # the index is updated
+        self.db.save_doc({"type": "post", "score": 3})
+        self.assertEqual(self.db.view("test/by_type", key="post").first()
+                ['value'], 6)
+
+    def testRegisteredView(self):
+        def by_value(doc):
+            yield doc.get('value'), None
+        self.backend.add_view("test/by_value", by_value, "_count")
+        self.db.save_doc({"_id": "_design/test", "views": {
+            "by_value": {"map": "function(doc) {}"}}})
+        self.db.save_docs([{"value": [1, "b"]}, {"value": [1, "a"]},
+            {"value": None}])
+
+        rows = self.db.view("test/by_value", reduce=False).all()
+        self.assertEqual([row['key'] for row in rows],
+                [None, [1, "a"], [1, "b"]])
+        rows = self.db.view("test/by_value", group_level=1,
+                startkey=[1]).all()
+        self.assertEqual(rows, [{"key": [1], "value": 2}])
+
+    def testCollation(self):
+        values = [{"a": 1}, [1], "B", "b", "a", 2, 1.5, True, False, None]
+        self.assertEqual(sorted(values, key=collation_key), values[::-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,9 @@ except ImportError:
     import unittest
 
 from restkit.errors import RequestFailed, RequestError
+from couchdbkit.exceptions import ResourceNotFound
 from couchdbkit.resource import CouchdbResource
+from couchdbkit.utils import json
 
 
 class ServerTestCase(unittest.TestCase):
@@ -47,6 +49,115 @@ class ServerTestCase(unittest.TestCase):
         self.couchdb.delete('/couchdkbit_test')
         self.assert_(len(res) > 0)
 
+    def testCompress(self):
+        reports = []
+        couchdb = CouchdbResource(compress=True, compress_min_size=100,
+                on_compress=reports.append)
+        couchdb.put('/couchdkbit_test')
+        doc = {"_id": "big", "text": "compress me " * 100}
+        res = couchdb.put('/couchdkbit_test/big', payload=doc).json_body
+        self.assert_(res['ok'] == True)
+        self.assert_(reports[0]['direction'] == "request")
+        self.assert_(reports[0]['encoded_size'] < reports[0]['size'])
+
+        # options are kept on resources derived from this one
+        db = couchdb('couchdkbit_test')
+        doc1 = db.get('big').json_body
+        self.assert_(doc1['text'] == doc['text'])
+        self.assert_(reports[-1]['direction'] == "response")
+        self.assert_(reports[-1]['encoded_size'] < reports[-1]['size'])
+
+        with db.get('big').body_stream() as body:
+            self.assert_(json.loads(body.read())['text'] == doc['text'])
+        self.assert_(reports[-1]['direction'] == "response")
+        self.assert_(len(reports) == 3)
+
+        # small bodies are sent as is
+        db.put('small', payload={"a": 1})
+        self.assert_(len(reports) == 3)
+        couchdb.delete('/couchdkbit_test')
+
+    def testHooks(self):
+        from couchdbkit.instrument import RequestHook, RequestStats, \
+                endpoint
+
+        class Recorder(RequestHook):
+            def __init__(self):
+                self.pre = []
+                self.post = []
+
+            def pre_request(self, info):
+                self.pre.append(info)
+
+            def post_request(self, info):
+                self.post.append(info)
+
+        recorder = Recorder()
+        stats = RequestStats()
+        couchdb = CouchdbResource(hooks=[recorder, stats])
+        couchdb.put('/couchdkbit_test').json_body
+        db = couchdb('couchdkbit_test')
+        db.put('doc1', payload={"a": 1}).json_body
+        db.get('doc1').json_body
+        self.assert_(len(recorder.pre) == 3)
+        self.assert_(len(recorder.post) == 3)
+        info = recorder.post[-1]
+        self.assert_(info.method == 'GET')
+        self.assert_(info.path == '/couchdkbit_test/doc1')
+        self.assert_(info.endpoint == 'doc')
+        self.assert_(info.status == 200)
+        self.assert_(info.response_size > 0)
+        self.assert_(recorder.post[1].request_size == len('{"a":1}'))
+        self.assert_(0 <= info.ttfb <= info.total_time)
+
+        # the response isn't read yet
+        resp = db.get('doc1')
+        self.assert_(len(recorder.post) == 3)
+        resp.body_string()
+        self.assert_(len(recorder.post) == 4)
+
+        self.assertRaises(ResourceNotFound, db.get, 'missing')
+        self.assert_(isinstance(recorder.post[-1].exception,
+            ResourceNotFound))
+        self.assert_(recorder.post[-1].status == 404)
+
+        counters = stats.stats()
+        self.assert_(counters['GET doc']['count'] == 3)
+        self.assert_(counters['GET doc']['errors'] == 1)
+        self.assert_(counters['GET doc']['buckets'][-1] == ("+Inf", 3))
+        self.assert_(counters['PUT db']['count'] == 1)
+        text = stats.prometheus()
+        self.assert_('couchdbkit_request_duration_seconds_count'
+                '{method="GET",endpoint="doc"} 3' in text)
+        self.assert_('couchdbkit_request_errors_total'
+                '{method="GET",endpoint="doc"} 1' in text)
+
+        self.assert_(endpoint('/') == 'server')
+        self.assert_(endpoint('/_all_dbs') == '_all_dbs')
+        self.assert_(endpoint('/db/_bulk_docs') == '_bulk_docs')
+        self.assert_(endpoint('/db/_design/d/_view/v') == '_view')
+        self.assert_(endpoint('/db/_design/d') == 'doc')
+        self.assert_(endpoint('/db/doc/file.txt') == 'attachment')
+        self.assert_(endpoint('/db/_changes') == '_changes')
+        # CouchDB served under a prefix
+        self.assert_(endpoint('/couchdb/db/doc', '/couchdb') == 'doc')
+        self.assert_(endpoint('/couchdb/db/_design/d/_view/v', '/couchdb/')
+                == '_view')
+        self.assert_(endpoint('/couchdb', '/couchdb') == 'server')
+        prefixed = CouchdbResource("http://127.0.0.1:5984/couchdb")
+        self.assert_(prefixed("db").root_path == '/couchdb')
+        self.assert_(prefixed("db")._server_path("doc") == '/db/doc')
+
+        # sizes are counted in bytes
+        rev = db.get('doc1').json_body['_rev']
+        db.put('doc1/text.txt', payload="\xc3\xa9t\xc3\xa9", rev=rev,
+                headers={"Content-Type": "text/plain"}).json_body
+        body = db.get('doc1/text.txt').body_string(charset="utf-8")
+        self.assert_(len(body.encode('utf-8')) > len(body))
+        self.assert_(recorder.post[-1].response_size ==
+                len(body.encode('utf-8')))
+        couchdb.delete('/couchdkbit_test')
+
     def testRequestFailed(self):
         bad = CouchdbResource('http://localhost:10000')
         self.assertRaises(RequestError, bad.get)
@@ -164,6 +164,27 @@ class DocumentTestCase(unittest.TestCase):
 
         self.server.delete_db('couchdbkit_test')
 
+    def testAtomicUpdate(self):
+        db = self.server.create_db('couchdbkit_test')
+        class Test(Document):
+            count = IntegerProperty(default=0)
+        Test._db = db
+
+        doc = Test()
+        doc.save()
+        stale = Test.get(doc._id)
+        # concurrent change
+        doc.count = 5
+        doc.save()
+
+        def incr(obj):
+            obj.count += 1
+        stale.atomic_update(incr)
+        self.assert_(stale.count == 6)
+        self.assert_(stale._rev == db.get(doc._id)['_rev'])
+        self.assert_(db.get(doc._id)['count'] == 6)
+        self.server.delete_db('couchdbkit_test')
+
     def testBulkSave(self):
         db = self.server.create_db('couchdbkit_test')
         class Test(Document):
@@ -615,6 +636,20 @@ class DocumentTestCase(unittest.TestCase):
 
         self.server.delete_db('couchdbkit_test')
 
+    def testGetMany(self):
+        db = self.server.create_db('couchdbkit_test')
+        class Test(Document):
+            string = StringProperty()
+        Test._db = db
+
+        Test(_id="a", string="a").save()
+        Test(_id="b", string="b").save()
+        docs = Test.get_many(["b", "missing", "a"])
+        self.assert_(docs[1] is None)
+        self.assert_(isinstance(docs[0], Test))
+        self.assert_([docs[0].string, docs[2].string] == ["b", "a"])
+        self.server.delete_db('couchdbkit_test')
+
     def testGetOrCreate(self):
         self.server.create_db('couchdbkit_test')
         db = self.server['couchdbkit_test']